@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the buffer based MPI gathers in gbmbkgpy.utils.mpi against the
+pickled gather/bcast that was used before for the response grid and the PPC.
+
+Run for example with:
+    mpiexec -n 4 python mpi_gather_benchmark.py
+    mpiexec -n 16 python mpi_gather_benchmark.py
+    mpiexec -n 64 python mpi_gather_benchmark.py
+"""
+import argparse
+import time
+
+import numpy as np
+from mpi4py import MPI
+
+from gbmbkgpy.utils.mpi import (
+    split_range,
+    gatherv_array,
+    allgatherv_array,
+    allgatherv_shared,
+)
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+size = comm.Get_size()
+
+
+def timed(func, repeat):
+    times = []
+    for _ in range(repeat):
+        comm.Barrier()
+        t0 = time.perf_counter()
+        func()
+        comm.Barrier()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def pickled_response_gather(local, chunk_size=4000):
+    # old ResponsePrecalculation: gather + bcast of 4000 point chunks
+    result = []
+    for start in range(0, len(local), max(1, chunk_size // size)):
+        part = comm.gather(local[start : start + max(1, chunk_size // size)], root=0)
+        if rank == 0:
+            part = np.concatenate(part)
+        result.append(comm.bcast(part, root=0))
+    return np.concatenate(result)
+
+
+def pickled_ppc_gather(local):
+    # old DataExporter._ppc_data: one gather per sample and np.append on rank 0
+    result = None
+    for sample in local:
+        gathered = comm.gather(sample, root=0)
+        if rank == 0:
+            gathered = np.array(gathered)
+            result = gathered if result is None else np.append(result, gathered, axis=0)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid_points", type=int, default=40000)
+    parser.add_argument("--ein", type=int, default=100)
+    parser.add_argument("--echans", type=int, default=8)
+    parser.add_argument("--ppc_samples", type=int, default=500)
+    parser.add_argument("--time_bins", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    # response grid
+    lower, upper = split_range(args.grid_points, rank, size)
+    local = np.random.random((upper - lower, args.ein, args.echans))
+
+    results = {
+        "response pickled gather+bcast": timed(
+            lambda: pickled_response_gather(local), args.repeat
+        ),
+        "response Allgatherv": timed(lambda: allgatherv_array(local), args.repeat),
+        "response shared window": timed(
+            lambda: allgatherv_shared(local).free(), args.repeat
+        ),
+    }
+
+    # ppc counts
+    lower, upper = split_range(args.ppc_samples, rank, size)
+    local = np.random.poisson(
+        10, (upper - lower, args.time_bins, args.echans)
+    ).astype(np.uint32)
+
+    results["ppc pickled gather per sample"] = timed(
+        lambda: pickled_ppc_gather(local), args.repeat
+    )
+    results["ppc Gatherv"] = timed(lambda: gatherv_array(local), args.repeat)
+
+    if rank == 0:
+        print(f"MPI ranks: {size}")
+        for name, t in results.items():
+            print(f"{name:35s} {t:8.3f} s")
+
+
+if __name__ == "__main__":
+    main()
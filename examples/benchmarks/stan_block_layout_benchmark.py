@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the block layout of the Stan likelihood (one block of all time
+bins per detector and echan, StanModelConstructor(block_layout=True)) against
+the flattened layout. Both models are generated with profile=True and the
+time per gradient of the reduce_sum profile block is compared after a short
+warmup with the same seed.
+
+The model is set up from a config file like the stan examples, the continuum
+sources need cr_per_det=True. Run for example with:
+    python stan_block_layout_benchmark.py config_stan_saa.yml --threads 16
+"""
+import argparse
+import os
+import time
+
+import yaml
+
+from gbmbkgpy.stan.grainsize import read_profile_time
+from gbmbkgpy.stan.stan import StanDataConstructor, StanModelConstructor
+from gbmbkgpy.utils.model_generator import BackgroundModelGenerator
+
+
+def run(model_generator, block_layout, threads, iter_warmup, output_dir):
+    stan_model_const = StanModelConstructor(
+        model_generator=model_generator,
+        profile=True,
+        cr_per_det=True,
+        block_layout=block_layout,
+    )
+    model = stan_model_const.compiled_model()
+
+    stan_data = StanDataConstructor(
+        model_generator=model_generator,
+        threads_per_chain=threads,
+        grainsize="auto",
+        block_layout=block_layout,
+    )
+
+    data_file = os.path.join(output_dir, f"data_block_{block_layout}.json")
+
+    t0 = time.perf_counter()
+    stan_data.save_data_json(data_file)
+    dt_data = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    fit = model.sample(
+        data=data_file,
+        chains=1,
+        seed=1,
+        threads_per_chain=threads,
+        iter_warmup=iter_warmup,
+        iter_sampling=1,
+        save_profile=True,
+        output_dir=output_dir,
+        show_progress=False,
+    )
+    dt_sample = time.perf_counter() - t0
+
+    return (
+        dt_data,
+        dt_sample,
+        read_profile_time(fit.runset.profile_files[0]),
+        os.path.getsize(data_file) / 1e6,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("config_file")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--iter-warmup", type=int, default=50)
+    parser.add_argument("--output-dir", default="block_layout_benchmark")
+    args = parser.parse_args()
+
+    with open(args.config_file) as f:
+        config = yaml.safe_load(f)
+
+    model_generator = BackgroundModelGenerator()
+    model_generator.from_config_dict(config)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    for name, block_layout in [("flattened", False), ("block", True)]:
+        dt_data, dt_sample, per_gradient, size = run(
+            model_generator,
+            block_layout,
+            args.threads,
+            args.iter_warmup,
+            args.output_dir,
+        )
+
+        print(
+            f"{name:10s} data {dt_data:8.2f} s {size:10.1f} MB "
+            f"sampling {dt_sample:8.2f} s reduce_sum {per_gradient:.3e} s per gradient"
+        )
+
+
+if __name__ == "__main__":
+    main()
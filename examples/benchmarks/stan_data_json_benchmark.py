@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the streaming CmdStan JSON writer in gbmbkgpy.stan.data_writer
+against the serialization of the full data dict with cmdstanpy, which is
+what happens when construct_data_dict() is passed to CmdStanModel.sample.
+
+The data has the shapes of a reference day (12 NaI detectors, 8 echans,
+free Earth, CGB and one free point source). Run for example with:
+    python stan_data_json_benchmark.py --num-time-bins 5000
+"""
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+from cmdstanpy import write_stan_json
+
+from gbmbkgpy.stan.data_writer import CmdStanJSONWriter
+
+
+def reference_data(num_time_bins, num_dets, num_echans, num_Ein, dtype):
+    rng = np.random.default_rng(0)
+
+    rows = num_time_bins * num_dets * num_echans
+
+    data = dict(
+        num_dets=num_dets,
+        num_echans=num_echans,
+        num_time_bins=num_time_bins,
+        rsp_num_Ein=num_Ein,
+        counts=rng.poisson(100, rows),
+        time_bins=np.cumsum(np.full((num_time_bins, 2), 15.0), axis=0),
+        Ebins_in=rng.random((2, num_Ein)),
+        num_cont_comp=2,
+        base_counts_array_cont=rng.random((2, rows)),
+        num_free_ps_comp=1,
+        grainsize=1,
+    )
+
+    responses = dict(
+        base_response_array_earth=(rows, num_Ein),
+        base_response_array_cgb=(rows, num_Ein),
+        base_response_array_free_ps=(1, rows, num_Ein),
+    )
+
+    def chunks(shape, chunk_rows=num_dets * num_echans * 1000):
+        # like StanDataConstructor.iter_response_chunks
+        for start in range(0, shape[-2], chunk_rows):
+            stop = min(start + chunk_rows, shape[-2])
+            yield slice(start, stop), rng.random((stop - start, shape[-1])).astype(
+                dtype
+            )
+
+    return data, responses, chunks
+
+
+def run_dict(path, data, responses, chunks):
+    data = dict(data)
+    for name, shape in responses.items():
+        array = np.empty(shape)
+        for rows, chunk in chunks(shape):
+            array[..., rows, :] = chunk
+        data[name] = array
+
+    write_stan_json(path, data)
+
+
+def run_streaming(path, data, responses, chunks):
+    with CmdStanJSONWriter(path) as writer:
+        for name, value in data.items():
+            writer.write(name, value)
+
+        for name, shape in responses.items():
+            out = writer.create_array(name, shape, None)
+            for rows, chunk in chunks(shape):
+                if len(shape) == 2:
+                    out[rows] = chunk
+                else:
+                    out[0, rows] = chunk
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-time-bins", type=int, default=5000)
+    parser.add_argument("--num-dets", type=int, default=12)
+    parser.add_argument("--num-echans", type=int, default=8)
+    parser.add_argument("--num-Ein", type=int, default=100)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, func, dtype in [
+            ("cmdstanpy dict", run_dict, np.float64),
+            ("streaming float64", run_streaming, np.float64),
+            ("streaming float32", run_streaming, np.float32),
+        ]:
+            data, responses, chunks = reference_data(
+                args.num_time_bins, args.num_dets, args.num_echans, args.num_Ein, dtype
+            )
+
+            path = os.path.join(tmp, "data.json")
+
+            t0 = time.perf_counter()
+            func(path, data, responses, chunks)
+            dt = time.perf_counter() - t0
+
+            size = os.path.getsize(path) / 1e6
+            os.remove(path)
+
+            print(f"{name:20s} {dt:8.2f} s {size:10.1f} MB")
+
+    # max rss of the whole benchmark, dominated by the dict path
+    print(f"max rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
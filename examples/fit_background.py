@@ -183,6 +183,7 @@ data_exporter.save_data(
     file_path=os.path.join(output_dir, result_file_name),
     result_dir=output_dir,
     save_ppc=config["export"]["save_ppc"],
+    compression=config["export"].get("compression", "lzf"),
 )
 
 if rank == 0:
@@ -0,0 +1,56 @@
+#!/user/bin/env python3
+import numpy as np
+import yaml
+
+from gbmbkgpy.io.export import StanDataExporter
+from gbmbkgpy.stan.stan import StanDataConstructor, StanModelConstructor
+from gbmbkgpy.utils.model_generator import BackgroundModelGenerator
+
+config_file = "config_stan_saa.yml"
+
+# Load the config.yml
+with open(config_file) as f:
+    config = yaml.safe_load(f)
+
+############## Generate the GBM-background-model ##################
+model_generator = BackgroundModelGenerator()
+
+model_generator.from_config_dict(config)
+
+stan_model_const = StanModelConstructor(model_generator=model_generator)
+
+# Sample with a model without generated quantities, the output only
+# contains the parameters
+model = stan_model_const.compiled_model(sampling_only=True)
+
+threads_per_chain = 64
+
+stan_data = StanDataConstructor(
+    model_generator=model_generator, threads_per_chain=threads_per_chain
+)
+
+data_file = stan_data.save_data_json("stan_data.json")
+
+fit = model.sample(
+    data=data_file,
+    output_dir="./",
+    chains=1,
+    seed=int(np.random.rand() * 10000),
+    threads_per_chain=threads_per_chain,
+    iter_warmup=300,
+    iter_sampling=300,
+    show_progress=True,
+)
+
+# Predictions of all sources and the ppc for 100 of the draws
+generated_quantities = stan_model_const.generate_quantities(
+    fit, data_file, num_draws=100, output_dir="./gq"
+)
+
+exporter = StanDataExporter.from_generated_quantities(
+    model_generator,
+    generated_quantities,
+    fit,
+    stan_data.param_lookup,
+    ppc_thin=100,
+)
@@ -0,0 +1,46 @@
+#!/user/bin/env python3
+import yaml
+
+from gbmbkgpy.stan.driver import ParallelChains
+from gbmbkgpy.stan.stan import StanDataConstructor, StanModelConstructor
+from gbmbkgpy.utils.model_generator import BackgroundModelGenerator
+
+config_file = "config_stan_saa.yml"
+
+# Load the config.yml
+with open(config_file) as f:
+    config = yaml.safe_load(f)
+
+############## Generate the GBM-background-model ##################
+model_generator = BackgroundModelGenerator()
+
+model_generator.from_config_dict(config)
+
+stan_model_const = StanModelConstructor(model_generator=model_generator)
+
+model = stan_model_const.compiled_model()
+
+# 4 chains with 32 threads each on a 128 core node
+chains = 4
+threads_per_chain = 32
+
+stan_data = StanDataConstructor(
+    model_generator=model_generator, threads_per_chain=threads_per_chain
+)
+
+# The data is written once and read by all chains
+data_file = stan_data.save_data_json("stan_data.json")
+
+driver = ParallelChains(
+    model,
+    data_file,
+    chains=chains,
+    threads_per_chain=threads_per_chain,
+    output_dir="./chains",
+)
+
+driver.run(iter_warmup=300, iter_sampling=300)
+
+# All chains in one arviz object
+result = driver.to_arviz(posterior_predictive="ppc")
+result.to_netcdf("fit_parallel.nc")
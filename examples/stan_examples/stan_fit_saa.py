@@ -33,10 +33,8 @@ stan_model_const = StanModelConstructor(model_generator=model_generator)
 
 stan_model_const.create_stan_file("automatic_stan_model.stan")
 
-# Create Stan Model
-model = CmdStanModel(
-    stan_file="automatic_stan_model.stan", cpp_options={"STAN_THREADS": "TRUE"}
-)
+# Create Stan Model, compiled only once per generated stan code
+model = stan_model_const.compiled_model(cpp_options={"STAN_THREADS": "TRUE"})
 
 
 # Number of threads per Chain
@@ -48,11 +46,12 @@ stan_data = StanDataConstructor(
     model_generator=model_generator, threads_per_chain=threads_per_chain
 )
 
-data_dict = stan_data.construct_data_dict()
+# Write the data once as CmdStan json, cmdstanpy then only passes the path
+data_file = stan_data.save_data_json("stan_data.json")
 
 # Sample
 fit = model.sample(
-    data=data_dict,
+    data=data_file,
     output_dir="./",
     chains=1,
     seed=int(np.random.rand() * 10000),
@@ -68,9 +67,9 @@ fit = model.sample(
 ar = av.from_cmdstanpy(
     fit,
     posterior_predictive="ppc",
-    observed_data={"counts": data_dict["counts"]},
+    observed_data={"counts": stan_data.counts.flatten()},
     constant_data={
-        "time_bins": data_dict["time_bins"],
+        "time_bins": stan_data.used_time_bins,
         "dets": model_generator.data.detectors,
         "echans": model_generator.data.echans,
     },
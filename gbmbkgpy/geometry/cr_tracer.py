@@ -0,0 +1,107 @@
+import os
+
+import numpy as np
+
+from gbmbkgpy.io.package_data import get_path_of_external_data_dir
+from gbmbkgpy.utils.mpi import check_mpi
+
+using_mpi, rank, size, comm = check_mpi()
+
+# Increase if the construction of the tracers changes, old cache files
+# are then ignored
+CR_TRACER_CACHE_VERSION = 1
+
+_memory_cache = {}
+
+
+class TracerTable(object):
+    def __init__(self, time, values):
+        """
+        Cosmic ray tracer as a table of values on a time grid, evaluated by
+        linear interpolation. Times outside of the grid get the first/last
+        value.
+        :param time: sorted time grid (MET)
+        :param values: tracer values at the grid points
+        """
+        self._time = np.asarray(time, dtype=float)
+        self._values = np.asarray(values, dtype=float)
+
+        assert self._time.shape == self._values.shape, "Time and values must have the same shape"
+
+    def __call__(self, time):
+        return np.interp(time, self._time, self._values)
+
+    @property
+    def time(self):
+        return self._time
+
+    @property
+    def values(self):
+        return self._values
+
+
+def cr_tracer_cache_file(tracer_type, date, side=None):
+    """
+    Path of the cached tracer of one day
+    :param tracer_type: "MCL" or "BGO"
+    :param date: string like '180407'
+    :param side: side of the BGO detector for the BGO tracer
+    """
+    name = f"{tracer_type.lower()}_{date}"
+
+    if side is not None:
+        name += f"_b{side}"
+
+    return (
+        get_path_of_external_data_dir()
+        / "cr_tracer"
+        / f"{name}_v{CR_TRACER_CACHE_VERSION}.npz"
+    )
+
+
+def load_cr_tracer(tracer_type, date, side, create):
+    """
+    Tracer of one day from the cache of this process, the cache file or
+    created with create(date, side) and saved in the cache. Has to be
+    called on all ranks: rank 0 decides if the tracer is created, as create
+    can contain collective calls, and only rank 0 writes the cache file.
+    :param create: function that returns the time grid and the values
+    :returns: TracerTable
+    """
+    key = (tracer_type, date, side)
+
+    if key in _memory_cache:
+        return _memory_cache[key]
+
+    cache_file = cr_tracer_cache_file(tracer_type, date, side)
+
+    exists = None
+
+    if rank == 0:
+        exists = cache_file.exists()
+
+    if using_mpi:
+        exists = comm.bcast(exists, root=0)
+
+    if exists:
+        with np.load(cache_file) as f:
+            time, values = f["time"], f["values"]
+
+    else:
+        time, values = create(date, side)
+
+        if rank == 0:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+            # several jobs can create the same tracer at the same time
+            tmp_file = cache_file.with_name(
+                f"{cache_file.stem}.tmp{os.getpid()}.npz"
+            )
+            np.savez(tmp_file, time=time, values=values)
+            os.replace(tmp_file, cache_file)
+
+    tracer = TracerTable(time, values)
+
+    _memory_cache[key] = tracer
+
+    return tracer
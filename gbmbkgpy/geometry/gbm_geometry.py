@@ -1,5 +1,4 @@
 import numpy as np
-from scipy.interpolate import interp1d
 import scipy.interpolate as interpolate
 import astropy.time as astro_time
 import astropy.io.fits as fits
@@ -7,7 +6,13 @@ import astropy.units as u
 
 from gbmgeometry import PositionInterpolator, gbm_detector_list, GBMTime
 
-from gbmbkgpy.geometry.geometry import Geometry
+from gbmbkgpy.geometry.cr_tracer import TracerTable, load_cr_tracer
+from gbmbkgpy.geometry.geometry import ICRS_TO_GALACTIC, Geometry, cart_to_lon_lat
+from gbmbkgpy.geometry.position_interpolator import (
+    PoshistInterpolator,
+    quaternion_to_sc_matrix,
+    sun_direction_icrs,
+)
 from gbmbkgpy.utils.progress_bar import progress_bar
 from gbmbkgpy.io.downloading import (download_gbm_file,
                                      download_trigdata_file,
@@ -54,6 +59,118 @@ def get_ang(X1, X2):
     return np.arccos(tmp)
 
 
+_bgo_tracer_echans = np.arange(85, 105, 1)
+
+# step of the table of the bgo tracer spline in seconds
+_bgo_tracer_step = 10.0
+
+
+def _bgo_cr_tracer_table(date, side, echans=_bgo_tracer_echans):
+    """
+    Rate of the high energy channels of a BGO detector, rebinned to 100 s,
+    smoothed with a spline and tabulated every 10 s
+    :returns: time grid, tracer values
+    """
+    # download bgo data
+    datafile_path = download_gbm_file(date, "cspec", f"b{side}")
+
+    # read in data
+    with fits.open(datafile_path) as f:
+        counts = f["SPECTRUM"].data["COUNTS"][:, echans].sum(axis=1)
+        bin_start = f["SPECTRUM"].data["TIME"]
+        bin_stop = f["SPECTRUM"].data["ENDTIME"]
+
+    # bin in 100 second bins
+    total_time_bins = np.vstack((bin_start, bin_stop)).T
+    min_bin_width = 100
+
+    this_rebinner = Rebinner(total_time_bins, min_bin_width)
+    rebinned_time_bins = this_rebinner.time_rebinned
+    (rebinned_counts,) = this_rebinner.rebin(counts)
+
+    rates = rebinned_counts / (rebinned_time_bins[:, 1] - rebinned_time_bins[:, 0])
+
+    # Add first time and last time with corresponding rate to rate_list
+    rates = np.concatenate((rates[:1], rates, rates[-1:]))
+
+    times = np.concatenate(
+        (bin_start[:1], np.mean(rebinned_time_bins, axis=1), bin_stop[-1:])
+    )
+    interp_tracer = interpolate.UnivariateSpline(times, rates, s=1000, k=3)
+
+    time_grid = np.append(
+        np.arange(times[0], times[-1], _bgo_tracer_step), times[-1]
+    )
+    values = interp_tracer(time_grid)
+
+    return time_grid, values - values.min()
+
+
+def _read_mcl(filepath):
+    with fits.open(filepath) as fits_file:
+        lat_time = np.mean(
+            np.vstack((fits_file["SC_DATA"].data["START"],
+                       fits_file["SC_DATA"].data["STOP"])),
+            axis=0,
+        )
+        mc_l = fits_file["SC_DATA"].data["L_MCILWAIN"]
+
+        tstart = fits_file["PRIMARY"].header["TSTART"]
+        tstop = fits_file["PRIMARY"].header["TSTOP"]
+
+    return lat_time, mc_l, tstart, tstop
+
+
+def _mcl_cr_tracer_table(date, side=None):
+    """
+    McIlwain L-parameter of the LAT spacecraft files covering the day,
+    minus its minimum
+    :returns: time grid, tracer values
+    """
+    year = "20%s" % date[:2]
+    month = date[2:-2]
+    dd = date[-2:]
+
+    day = astro_time.Time("%s-%s-%s" % (year, month, dd))
+
+    min_met = GBMTime(day).met
+
+    max_met = GBMTime(day + u.Quantity(1, u.day)).met
+
+    gbm_time = GBMTime(day)
+
+    mission_week = np.floor(gbm_time.mission_week.value)
+
+    lat_time, mc_l, tstart, tstop = _read_mcl(download_lat_spacecraft(mission_week))
+
+    times = [lat_time]
+    values = [mc_l]
+
+    # do we need the week before?
+    if tstart >= min_met:
+        lat_time_before, mc_l_before, _, _ = _read_mcl(
+            download_lat_spacecraft(mission_week - 1)
+        )
+        times.insert(0, lat_time_before)
+        values.insert(0, mc_l_before)
+
+    # do we need the next week?
+    if tstop <= max_met:
+        lat_time_after, mc_l_after, _, _ = _read_mcl(
+            download_lat_spacecraft(mission_week + 1)
+        )
+        times.append(lat_time_after)
+        values.append(mc_l_after)
+
+    lat_time = np.concatenate(times)
+    mc_l = np.concatenate(values).astype(float)
+
+    # get mc_l diff
+    mc_l -= np.min(mc_l)
+
+    return lat_time, mc_l
+
+
 class GBMGeometry(Geometry):
 
     def __init__(self, date, cr_tracer_type="MCL", bgo_side=None):
@@ -257,164 +374,73 @@ class GBMGeometry(Geometry):
 
     def earth_pos_cart(self, time):
         """
-        Earth position in sat frame for a given time as 3D-vector
+        Earth position in sat frame for given times as 3D-vectors
+        :param time: times of interest (array or float)
+        :returns: unit vectors (n, 3)
         """
+        sc_pos = np.atleast_2d(self._position_interpolator.sc_pos(time))
 
-        # get gbm_geometry object at given time
-        det_geom = self._get_gbm_geom_det(time)
-
-        # get earth position in sat frame
-        earth_az_zen = det_geom.earth_az_zen_sat
+        earth_icrs = -sc_pos / np.linalg.norm(sc_pos, axis=1)[:, np.newaxis]
 
-        # calc vector
-        earth_cart = ang2cart(*earth_az_zen)
-
-        return earth_cart
+        return np.einsum("nij,nj->ni", self._sc_matrix(time), earth_icrs)
 
     def sun_pos_cart(self, time):
         """
-        Sun position in sat frame for a given time as 3D-vector
+        Sun position in sat frame for given times as 3D-vectors
+        :param time: times of interest (array or float)
+        :returns: unit vectors (n, 3)
         """
-        # get gbm_geometry object at given time
-        det_geom = self._get_gbm_geom_det(time)
+        return np.einsum("nij,nj->ni", self._sc_matrix(time), sun_direction_icrs(time))
 
-        # get earth position in sat frame
-        sun_az_zen = [det_geom.sun_position.lon.deg,
-                      det_geom.sun_position.lat.deg]
-
-        # calc vector
-        sun_cart = ang2cart(*sun_az_zen)
-
-        return sun_cart
-
-    def _create_bgo_cr_tracer_interp(self, date, side, echans=np.arange(85,105,1)):
-
-
-        # download bgo data
-        datafile_path = download_gbm_file(date, "cspec", f"b{side}")
+    def earth_occultation(self, time, points_sat):
+        """
+        Check which directions in the sat frame are occulted by the earth
+        :param time: times of interest (array or float)
+        :param points_sat: unit vectors (m, 3) in sat frame
+        :returns: bool array (n, m)
+        """
+        sc_pos = np.atleast_2d(self._position_interpolator.sc_pos(time))
 
-        # read in data
-        with fits.open(datafile_path) as f:
-            counts = f["SPECTRUM"].data["COUNTS"][:, echans[0]]
-            for echan in echans[1:]:
-                counts += f["SPECTRUM"].data["COUNTS"][:, echan]
-            bin_start = f["SPECTRUM"].data["TIME"]
-            bin_stop = f["SPECTRUM"].data["ENDTIME"]
+        # angular radius of the earth seen from the sat
+        earth_radius = 6371.0
+        fermi_radius = np.linalg.norm(sc_pos, axis=1)
+        min_vis = np.pi / 2 - np.arccos(earth_radius / fermi_radius)
 
-        # bin in 100 second bins
-        total_time_bins = np.vstack((bin_start, bin_stop)).T
-        min_bin_width = 100
+        cos_sep = np.dot(self.earth_pos_cart(time), np.asarray(points_sat).T)
 
-        this_rebinner = Rebinner(total_time_bins, min_bin_width)
-        rebinned_time_bins = this_rebinner.time_rebinned
-        (rebinned_counts,) = this_rebinner.rebin(counts)
+        return np.arccos(np.clip(cos_sep, -1, 1)) < min_vis[:, np.newaxis]
 
-        rates = rebinned_counts / (rebinned_time_bins[:, 1] - rebinned_time_bins[:, 0])
+    def satellite_to_galactic_cart(self, time, points_sat):
+        """
+        Galactic coordinates of directions in the sat frame at many times
+        :param time: times of interest (array or float)
+        :param points_sat: unit vectors (m, 3) in sat frame
+        :returns: l in (-180, 180], b (degree), arrays (n, m)
+        """
+        # the inverse of the rotation matrix is its transpose
+        icrs = np.einsum("nji,mj->nmi", self._sc_matrix(time), points_sat)
 
-        # Add first time and last time with corresponding rate to rate_list
-        rates = np.concatenate((rates[:1], rates, rates[-1:]))
+        return cart_to_lon_lat(np.dot(icrs, ICRS_TO_GALACTIC.T))
 
-        times = np.concatenate(
-            (bin_start[:1], np.mean(rebinned_time_bins, axis=1), bin_stop[-1:])
+    def _sc_matrix(self, time):
+        return quaternion_to_sc_matrix(
+            np.atleast_2d(self._position_interpolator.quaternion(time))
         )
-        interp_tracer = interpolate.UnivariateSpline(
-                times, rates, s=1000, k=3
-            )
 
-        def final_tracer(x):
-            return interp_tracer(x)-interp_tracer(x).min()
+    def _create_bgo_cr_tracer_interp(self, date, side, echans=_bgo_tracer_echans):
+        """
+        create the bgo tracer, cached per date and side
+        """
+        if np.array_equal(echans, _bgo_tracer_echans):
+            self._interp_tracer = load_cr_tracer("BGO", date, side, _bgo_cr_tracer_table)
+        else:
+            self._interp_tracer = TracerTable(*_bgo_cr_tracer_table(date, side, echans))
 
-        self._interp_tracer = final_tracer
-    
     def _create_mcl_cr_tracer_interp(self, date):
         """
-        create mcl interpolation function
+        create mcl interpolation function, cached per date
         """
-
-        # read the file
-        year = "20%s" % date[:2]
-        month = date[2:-2]
-        dd = date[-2:]
-
-        day = astro_time.Time("%s-%s-%s" % (year, month, dd))
-
-        min_met = GBMTime(day).met
-
-        max_met = GBMTime(day + u.Quantity(1, u.day)).met
-
-        gbm_time = GBMTime(day)
-
-        mission_week = np.floor(gbm_time.mission_week.value)
-
-        filepath = download_lat_spacecraft(mission_week)
-
-        # Init all arrays as empty arrays
-        lat_time = np.array([])
-        mc_l = np.array([])
-
-        # lets check that this file has the right info
-
-        week_before = False
-        week_after = False
-
-        with fits.open(filepath) as fits_file:
-
-            # do we need the week before?
-            if fits_file["PRIMARY"].header["TSTART"] >= min_met:
-                # we need to get week before
-                week_before = True
-
-                before_filepath = download_lat_spacecraft(mission_week-1)
-
-            # do we need the next week?
-            if fits_file["PRIMARY"].header["TSTOP"] <= max_met:
-
-                # we need to get week after
-
-                week_after = True
-
-                after_filepath = download_lat_spacecraft(mission_week+1)
-
-            # first lets get the primary file
-
-            lat_time = np.mean(
-                np.vstack((fits_file["SC_DATA"].data["START"],
-                           fits_file["SC_DATA"].data["STOP"])),
-                axis=0,
-            )
-            mc_l = fits_file["SC_DATA"].data["L_MCILWAIN"]
-
-        # if we need to append anything to make up for the
-        # dates not being included in the files
-        # do it here...
-        if week_before:
-            with fits.open(before_filepath) as fits_file:
-                lat_time_before = np.mean(
-                    np.vstack((fits_file["SC_DATA"].data["START"],
-                               fits_file["SC_DATA"].data["STOP"])),
-                    axis=0,
-                )
-                mc_l_before = fits_file["SC_DATA"].data["L_MCILWAIN"]
-
-            mc_l = np.append(mc_l_before, mc_l)
-            lat_time = np.append(lat_time_before, lat_time)
-
-        if week_after:
-            with fits.open(after_filepath) as fits_file:
-                lat_time_after = np.mean(
-                    np.vstack((fits_file["SC_DATA"].data["START"],
-                               fits_file["SC_DATA"].data["STOP"])),
-                    axis=0,
-                )
-                mc_l_after = fits_file["SC_DATA"].data["L_MCILWAIN"]
-
-            mc_l = np.append(mc_l, mc_l_after)
-            lat_time = np.append(lat_time, lat_time_after)
-
-        # get mc_l diff
-        mc_l -= np.min(mc_l)
-
-        self._interp_tracer = interp1d(lat_time, mc_l)
+        self._interp_tracer = load_cr_tracer("MCL", date, None, _mcl_cr_tracer_table)
 
     def cr_tracer(self, time):
         """
@@ -433,9 +459,7 @@ class GBMGeometryPosHist(GBMGeometry):
         poshist_path = download_gbm_file(date, "poshist")
 
         # construct position interpolator object
-        self._position_interpolator = PositionInterpolator.from_poshist(
-            poshist_file=poshist_path
-        )
+        self._position_interpolator = PoshistInterpolator.from_poshist(poshist_path)
 
         super().__init__(date,cr_tracer_type=cr_tracer_type,bgo_side=bgo_side)
 
@@ -1,21 +1,68 @@
 import numpy as np
 
-import astropy.units as u
-from astropy.coordinates import SkyCoord
+# Rotation matrix from ICRS to galactic coordinates (Hipparcos catalogue,
+# ESA 1997, Vol. 1, Sec. 1.5.3). It agrees with the galactic frame of
+# astropy to 1e-7 rad.
+ICRS_TO_GALACTIC = np.array(
+    [
+        [-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+        [0.4941094278755837, -0.4448296299600112, 0.7469822444972189],
+        [-0.8676661490190047, -0.1980763734312015, 0.4559837761750669],
+    ]
+)
 
 
-class Geometry:
+def lon_lat_to_cart(lon, lat):
+    """
+    Unit vectors of longitudes and latitudes in degree
+    :returns: array shape lon.shape + (3,)
+    """
+    lon = np.deg2rad(lon)
+    lat = np.deg2rad(lat)
+
+    return np.stack(
+        (np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)), axis=-1
+    )
+
+
+def cart_to_lon_lat(vec):
+    """
+    Longitude in (-180, 180] and latitude in degree of vectors (..., 3)
+    """
+    vec = np.asarray(vec)
+
+    lon = np.rad2deg(np.arctan2(vec[..., 1], vec[..., 0]))
+    lat = np.rad2deg(
+        np.arcsin(np.clip(vec[..., 2] / np.linalg.norm(vec, axis=-1), -1, 1))
+    )
+
+    return lon, lat
 
-    def galactic_to_satellite(self, time, l, b):
-        coord = SkyCoord(l=l*u.degree,
-                         b=b*u.degree,
-                         frame='galactic')
-        coord_icrs = coord.transform_to("icrs")
 
-        ra = coord_icrs.ra.deg
-        ra[l > 180] -= 360
+def icrs_to_galactic(ra, dec):
+    """
+    :param ra: ra in icrs (degree) (array or float)
+    :param dec: dec in icrs (degree) (array or float)
+    :returns: l in (-180, 180], b (degree)
+    """
+    return cart_to_lon_lat(np.dot(lon_lat_to_cart(ra, dec), ICRS_TO_GALACTIC.T))
+
+
+def galactic_to_icrs(l, b):
+    """
+    :param l: galactic longitude (degree) (array or float)
+    :param b: galactic latitude (degree) (array or float)
+    :returns: ra in [0, 360), dec (degree)
+    """
+    ra, dec = cart_to_lon_lat(np.dot(lon_lat_to_cart(l, b), ICRS_TO_GALACTIC))
+
+    return np.mod(ra, 360), dec
+
+
+class Geometry:
 
-        dec = coord_icrs.dec.deg
+    def galactic_to_satellite(self, time, l, b):
+        ra, dec = galactic_to_icrs(np.atleast_1d(l), np.atleast_1d(b))
 
         return self.icrs_to_satellite(time,
                                       ra,
@@ -30,17 +77,16 @@ class Geometry:
                                                    az,
                                                    el)
 
-        coord = SkyCoord(ra=ra_icrs*u.degree,
-                         dec=dec_icrs*u.degree,
-                         frame='icrs')
-        coord_gal = coord.transform_to("galactic")
-
-        l = coord_gal.l.deg
-        l[l > 180] -= 360
+        return icrs_to_galactic(ra_icrs, dec_icrs)
 
-        b = coord_gal.b.deg
-
-        return l, b
+    def satellite_to_galactic_cart(self, time, points_sat):
+        """
+        Galactic coordinates of directions in the sat frame at many times
+        :param time: times of interest (array or float)
+        :param points_sat: unit vectors (m, 3) in sat frame
+        :returns: l in (-180, 180], b (degree), arrays (n, m)
+        """
+        raise RuntimeError("Has to be implemented in sub-class")
 
     def cr_tracer(self, time):
         """
@@ -80,3 +126,13 @@ class Geometry:
         """
 
         raise RuntimeError("Has to be implemented in sub-class")
+
+    def earth_occultation(self, time, points_sat):
+        """
+        Check which directions in the sat frame are occulted by the earth
+        :param time: times of interest (array or float)
+        :param points_sat: unit vectors (m, 3) in sat frame
+        :returns: bool array (n, m)
+        """
+
+        raise RuntimeError("Has to be implemented in sub-class")
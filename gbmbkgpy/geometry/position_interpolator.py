@@ -0,0 +1,161 @@
+import numpy as np
+import astropy.io.fits as fits
+import astropy.time as astro_time
+
+# TT - UTC at the MET epoch 2001-01-01 00:00:00 UTC. MET counts SI seconds
+# including leap seconds, so TT = epoch + MET without a leap second table.
+_met_epoch_jd_utc = 2451910.5
+_tt_minus_utc_at_epoch = 64.184
+
+
+def met_to_jd_tt(met):
+    """
+    Julian date (TT) of Fermi MET
+    """
+    return _met_epoch_jd_utc + (np.asarray(met, dtype=float) + _tt_minus_utc_at_epoch) / 86400.0
+
+
+def sun_direction_icrs(met):
+    """
+    Geocentric direction of the sun in ICRS (J2000 equator and equinox) as
+    unit vectors. Low precision solar coordinates of the Astronomical
+    Almanac, referred to the J2000 equinox, accurate to about 0.01 deg.
+    :param met: Fermi MET (array or float)
+    :returns: unit vectors (n, 3)
+    """
+    n = np.atleast_1d(met_to_jd_tt(met)) - 2451545.0
+
+    mean_longitude = 280.460 + 0.9856474 * n
+    mean_anomaly = np.deg2rad(357.528 + 0.9856003 * n)
+
+    # ecliptic longitude of date, minus the general precession since J2000
+    ecl_longitude = np.deg2rad(
+        mean_longitude
+        + 1.915 * np.sin(mean_anomaly)
+        + 0.020 * np.sin(2 * mean_anomaly)
+        - 1.3970 * n / 36525.0
+    )
+
+    obliquity = np.deg2rad(23.4392911)
+
+    direction = np.empty((len(n), 3))
+    direction[:, 0] = np.cos(ecl_longitude)
+    direction[:, 1] = np.cos(obliquity) * np.sin(ecl_longitude)
+    direction[:, 2] = np.sin(obliquity) * np.sin(ecl_longitude)
+
+    return direction
+
+
+def quaternion_to_sc_matrix(quaternions):
+    """
+    Rotation matrices from ICRS to the satellite frame, the rows are the
+    satellite x, y and z axes in ICRS
+    :param quaternions: quaternions (n, 4) or (4,)
+    :returns: matrices (n, 3, 3) or (3, 3)
+    """
+    q1, q2, q3, q4 = np.moveaxis(np.asarray(quaternions, dtype=float), -1, 0)
+
+    sc_matrix = np.empty(q1.shape + (3, 3))
+
+    sc_matrix[..., 0, 0] = q1 ** 2 - q2 ** 2 - q3 ** 2 + q4 ** 2
+    sc_matrix[..., 0, 1] = 2.0 * (q1 * q2 + q4 * q3)
+    sc_matrix[..., 0, 2] = 2.0 * (q1 * q3 - q4 * q2)
+    sc_matrix[..., 1, 0] = 2.0 * (q1 * q2 - q4 * q3)
+    sc_matrix[..., 1, 1] = -(q1 ** 2) + q2 ** 2 - q3 ** 2 + q4 ** 2
+    sc_matrix[..., 1, 2] = 2.0 * (q2 * q3 + q4 * q1)
+    sc_matrix[..., 2, 0] = 2.0 * (q1 * q3 + q4 * q2)
+    sc_matrix[..., 2, 1] = 2.0 * (q2 * q3 - q4 * q1)
+    sc_matrix[..., 2, 2] = -(q1 ** 2) - q2 ** 2 + q3 ** 2 + q4 ** 2
+
+    return sc_matrix
+
+
+class PoshistInterpolator(object):
+    def __init__(self, time, quats, sc_pos):
+        """
+        Interpolation of the orientation and position of Fermi on preloaded
+        arrays. The quaternions are interpolated linearly and normalized
+        (NLERP, the poshist has one entry per second), the position linearly.
+        All methods work on arrays of times.
+        :param time: MET of the entries, sorted
+        :param quats: quaternions (n, 4)
+        :param sc_pos: positions (n, 3) in km
+        """
+        self._time = np.ascontiguousarray(time, dtype=float)
+        self._quats = np.ascontiguousarray(quats, dtype=float)
+        self._sc_pos = np.ascontiguousarray(sc_pos, dtype=float)
+
+        # neighbouring quaternions with opposite signs describe the same
+        # rotation, flip them so the interpolation takes the short way
+        flip = np.cumsum(np.sum(self._quats[1:] * self._quats[:-1], axis=1) < 0) % 2
+        self._quats[1:][flip == 1] *= -1
+
+    @classmethod
+    def from_poshist(cls, poshist_file):
+        """
+        Interpolator of a poshist file
+        """
+        with fits.open(poshist_file) as poshist:
+            data = poshist["GLAST POS HIST"].data
+
+            time = np.array(data["SCLK_UTC"], dtype=float)
+
+            quats = np.column_stack(
+                [data["QSJ_1"], data["QSJ_2"], data["QSJ_3"], data["QSJ_4"]]
+            )
+
+            # the poshist positions are in m
+            sc_pos = np.column_stack([data["POS_X"], data["POS_Y"], data["POS_Z"]]) / 1000.0
+
+        return cls(time, quats, sc_pos)
+
+    def _weights(self, t):
+        t = np.asarray(t, dtype=float)
+
+        assert np.all(t >= self._time[0]) and np.all(t <= self._time[-1]), (
+            "Time outside of the poshist"
+        )
+
+        idx = np.clip(np.searchsorted(self._time, t, side="right") - 1, 0, len(self._time) - 2)
+
+        w = (t - self._time[idx]) / (self._time[idx + 1] - self._time[idx])
+
+        return idx, w[..., np.newaxis]
+
+    def quaternion(self, t):
+        """
+        Normalized quaternions at the times t, shape t.shape + (4,)
+        """
+        idx, w = self._weights(t)
+
+        quats = (1 - w) * self._quats[idx] + w * self._quats[idx + 1]
+
+        return quats / np.linalg.norm(quats, axis=-1, keepdims=True)
+
+    def sc_pos(self, t):
+        """
+        Position of Fermi in km (ECI), shape t.shape + (3,)
+        """
+        idx, w = self._weights(t)
+
+        return (1 - w) * self._sc_pos[idx] + w * self._sc_pos[idx + 1]
+
+    def sc_matrix(self, t):
+        """
+        Rotation matrices from ICRS to the satellite frame, shape t.shape + (3, 3)
+        """
+        return quaternion_to_sc_matrix(self.quaternion(t))
+
+    def utc(self, t):
+        """
+        UTC of the times t in fits format
+        """
+        time = astro_time.Time(
+            "2001-01-01 00:00:00", scale="utc"
+        ) + astro_time.TimeDelta(t, format="sec")
+
+        return time.utc.fits
+
+    @property
+    def time(self):
+        return self._time
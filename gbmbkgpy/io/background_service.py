@@ -0,0 +1,382 @@
+import argparse
+import collections
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+import h5py
+import numpy as np
+
+from gbmbkgpy.io.result_file import ResultFile
+
+_query_datasets = ("observed_counts", "model_counts", "stat_err")
+
+
+def _select(values, selection, name):
+    if selection is None:
+        return list(values)
+
+    selection = [str(s) for s in selection]
+
+    for s in selection:
+        assert s in values, f"{name} {s} is not available"
+
+    return selection
+
+
+class BackgroundQuery(object):
+    """
+    Base class of the background queries. query returns a dict with
+    time_bins (n, 2), detectors, echans and the arrays observed_counts,
+    model_counts and stat_err with shape (n, n_detectors, n_echans).
+    Queries are serialized with a lock, so one object can be shared
+    between the threads of the http server.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def query(self, start, stop, detectors=None, echans=None):
+        with self._lock:
+            return self._query(start, stop, detectors, echans)
+
+    def _query(self, start, stop, detectors, echans):
+        raise RuntimeError("Has to be implemented in sub-class")
+
+    def query_json(self, start, stop, detectors=None, echans=None):
+        """
+        Query with the arrays converted to lists, missing values are None
+        """
+        result = self.query(start, stop, detectors, echans)
+
+        return {
+            key: np.where(np.isnan(value), None, value).tolist()
+            if isinstance(value, np.ndarray) and value.dtype.kind == "f"
+            else value
+            for key, value in result.items()
+        }
+
+
+class ResultFileBackground(BackgroundQuery):
+    def __init__(self, result_files, cache_size=4):
+        """
+        Background of saved result files. Only the time ranges and the
+        detectors of the files are read at the start; the files are opened
+        on demand and the cache_size last used files are kept open.
+        Files of the same day with the same time bins but different
+        detectors/echans are combined.
+        :param result_files: list of result files or directories with
+        result files (*.hdf5, *.h5)
+        :param cache_size: number of open result files
+        """
+        super().__init__()
+
+        self._cache_size = cache_size
+        self._cache = collections.OrderedDict()
+
+        self._files = []
+
+        for path in result_files:
+            path = Path(path)
+
+            if path.is_dir():
+                paths = sorted(list(path.glob("*.hdf5")) + list(path.glob("*.h5")))
+            else:
+                paths = [path]
+
+            for p in paths:
+                with h5py.File(p, "r") as f:
+                    if "time_bins_start" not in f or "model_counts" not in f:
+                        continue
+
+                    self._files.append(
+                        dict(
+                            path=p,
+                            time_range=(
+                                float(f["time_bins_start"][0]),
+                                float(f["time_bins_stop"][-1]),
+                            ),
+                            detectors=[str(d) for d in f.attrs["detectors"]],
+                            echans=[str(e) for e in f.attrs["echans"]],
+                        )
+                    )
+
+        assert len(self._files) > 0, "No result files found"
+
+        self._files.sort(key=lambda f: f["time_range"])
+
+    def _open(self, path):
+        if path in self._cache:
+            self._cache.move_to_end(path)
+            return self._cache[path]
+
+        result = ResultFile(path)
+        self._cache[path] = result
+
+        if len(self._cache) > self._cache_size:
+            _, oldest = self._cache.popitem(last=False)
+            oldest.close()
+
+        return result
+
+    def close(self):
+        for result in self._cache.values():
+            result.close()
+        self._cache.clear()
+
+    def _query(self, start, stop, detectors, echans):
+        files = [
+            f
+            for f in self._files
+            if f["time_range"][0] < stop and f["time_range"][1] > start
+        ]
+
+        detectors = _select(
+            dict.fromkeys(d for f in files for d in f["detectors"]),
+            detectors,
+            "Detector",
+        )
+        echans = _select(
+            dict.fromkeys(e for f in files for e in f["echans"]), echans, "Echan"
+        )
+
+        # files with the same time range share the time bins
+        days = collections.OrderedDict()
+        for f in files:
+            days.setdefault(f["time_range"], []).append(f)
+
+        time_bins = []
+        arrays = {name: [] for name in _query_datasets}
+
+        for day_files in days.values():
+            day_time_bins = None
+
+            for f in day_files:
+                dets = [d for d in f["detectors"] if d in detectors]
+                file_echans = [e for e in f["echans"] if e in echans]
+
+                if len(dets) == 0 or len(file_echans) == 0:
+                    continue
+
+                window = self._open(f["path"]).read_window(
+                    start, stop, detectors=dets, datasets=_query_datasets, sources=False
+                )
+
+                if day_time_bins is None:
+                    day_time_bins = window["time_bins"]
+                    day_arrays = {
+                        name: np.full(
+                            (len(day_time_bins), len(detectors), len(echans)), np.nan
+                        )
+                        for name in _query_datasets
+                    }
+                else:
+                    assert np.array_equal(
+                        day_time_bins, window["time_bins"]
+                    ), "Result files of the same day with different time bins"
+
+                det_idx = [detectors.index(d) for d in window["detectors"]]
+                file_echan_idx = [f["echans"].index(e) for e in file_echans]
+                echan_idx = [echans.index(e) for e in file_echans]
+
+                for name in _query_datasets:
+                    day_arrays[name][:, np.array(det_idx)[:, None], echan_idx] = window[
+                        name
+                    ][:, :, file_echan_idx]
+
+            if day_time_bins is not None:
+                time_bins.append(day_time_bins)
+                for name in _query_datasets:
+                    arrays[name].append(day_arrays[name])
+
+        if len(time_bins) == 0:
+            time_bins = [np.empty((0, 2))]
+            for name in _query_datasets:
+                arrays[name].append(np.empty((0, len(detectors), len(echans))))
+
+        result = dict(
+            time_bins=np.concatenate(time_bins),
+            detectors=detectors,
+            echans=echans,
+        )
+
+        for name in _query_datasets:
+            result[name] = np.concatenate(arrays[name])
+
+        return result
+
+
+class ModelBackground(BackgroundQuery):
+    def __init__(self, model, max_samples=200, seed=None):
+        """
+        Background of a fitted ModelDet or ModelCombine. The model is only
+        evaluated in the requested time window. The statistical error is
+        the width of the 68% band of the model counts of at most
+        max_samples posterior samples; it is 0 if the model has no samples.
+        :param model: ModelDet or ModelCombine
+        :param max_samples: maximal number of posterior samples for the error
+        :param seed: seed for the subsampling of the posterior
+        """
+        super().__init__()
+
+        self._max_samples = max_samples
+        self._seed = seed
+
+        model_dets = getattr(model, "model_dets", [model])
+
+        self._model_dets = collections.OrderedDict(
+            (str(m.data.det if hasattr(m.data, "det") else m.data.name), m)
+            for m in model_dets
+        )
+
+    def _query(self, start, stop, detectors, echans):
+        from gbmbkgpy.modeling.ppc import PPCEngine
+
+        detectors = _select(self._model_dets.keys(), detectors, "Detector")
+
+        num_echan = self._model_dets[detectors[0]].data.num_echan
+        echans = _select([str(e) for e in range(num_echan)], echans, "Echan")
+        echan_idx = np.array([int(e) for e in echans])
+
+        # the data time bins of the first detector in the window
+        data = self._model_dets[detectors[0]].data
+        mask = (data.time_bins[:, 1] > start) & (data.time_bins[:, 0] < stop)
+        time_bins = data.time_bins[mask]
+
+        shape = (len(time_bins), len(detectors), len(echans))
+
+        result = dict(time_bins=time_bins, detectors=detectors, echans=echans)
+        for name in _query_datasets:
+            result[name] = np.zeros(shape)
+
+        if len(time_bins) == 0:
+            return result
+
+        for i, det in enumerate(detectors):
+            model = self._model_dets[det]
+
+            result["model_counts"][:, i] = model.get_model_counts(time_bins=time_bins)[
+                :, echan_idx
+            ]
+
+            if np.array_equal(model.data.time_bins[mask], time_bins):
+                result["observed_counts"][:, i] = model.data.counts[mask][:, echan_idx]
+            else:
+                result["observed_counts"][:, i] = np.nan
+
+            if getattr(model, "_raw_samples", None) is not None:
+                engine = PPCEngine(model, time_bins=time_bins, seed=self._seed)
+
+                expected = engine.expected_counts(
+                    engine.subsample(model.raw_samples, self._max_samples), echan_idx
+                )
+
+                low, high = np.percentile(expected, [16, 84], axis=0)
+                result["stat_err"][:, i] = high - low
+
+        return result
+
+
+class BackgroundRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET /background?start=<met>&stop=<met>&detectors=n0,n1&echans=0,1
+    returns the result of the query as json
+    """
+
+    background = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        if url.path != "/background":
+            self._send(404, {"error": f"Unknown path {url.path}"})
+            return
+
+        args = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        try:
+            result = self.background.query_json(
+                float(args["start"]),
+                float(args["stop"]),
+                detectors=args["detectors"].split(",") if "detectors" in args else None,
+                echans=args["echans"].split(",") if "echans" in args else None,
+            )
+        except (KeyError, ValueError, AssertionError) as e:
+            self._send(400, {"error": str(e)})
+            return
+
+        self._send(200, result)
+
+    def _send(self, status, content):
+        body = json.dumps(content).encode()
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(background, host="127.0.0.1", port=8000):
+    """
+    Http server for a BackgroundQuery, start it with serve_forever()
+    """
+    handler = type(
+        "Handler", (BackgroundRequestHandler,), {"background": background}
+    )
+
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Background of saved result files for a time window",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "result_files", nargs="+", help="Result files or directories with result files"
+    )
+    parser.add_argument("--start", type=float, help="Start of the window (MET)")
+    parser.add_argument("--stop", type=float, help="Stop of the window (MET)")
+    parser.add_argument("--detectors", type=str, help="Comma separated detectors")
+    parser.add_argument("--echans", type=str, help="Comma separated echans")
+    parser.add_argument("--serve", action="store_true", help="Start the http server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache_size", type=int, default=4, help="Open result files")
+    args = parser.parse_args(argv)
+
+    background = ResultFileBackground(args.result_files, cache_size=args.cache_size)
+
+    if args.serve:
+        server = make_server(background, args.host, args.port)
+        print(f"Serving the background on http://{args.host}:{server.server_port}")
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            background.close()
+        return
+
+    assert args.start is not None and args.stop is not None, "Give --start and --stop"
+
+    result = background.query_json(
+        args.start,
+        args.stop,
+        detectors=args.detectors.split(",") if args.detectors else None,
+        echans=args.echans.split(",") if args.echans else None,
+    )
+
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import os
+import re
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from astropy.io import fits
+
+from gbmbkgpy.io.file_index import get_file_index
+from gbmbkgpy.io.package_data import get_path_of_external_data_dir
+from gbmbkgpy.utils.mpi import check_mpi
+
+using_mpi, rank, size, comm = check_mpi()
+
+GBM_DAILY_URL = "https://heasarc.gsfc.nasa.gov/FTP/fermi/data/gbm/daily"
+
+GBM_DETECTORS = [
+    "n0",
+    "n1",
+    "n2",
+    "n3",
+    "n4",
+    "n5",
+    "n6",
+    "n7",
+    "n8",
+    "n9",
+    "na",
+    "nb",
+    "b0",
+    "b1",
+]
+
+_href_pattern = re.compile(r'href="([^"?/]+)"', re.IGNORECASE)
+
+
+def gbm_file_type(data_type):
+    return "fit" if data_type == "poshist" else "pha"
+
+
+def gbm_file_path(date, data_type, detector="all"):
+    """
+    Path of a daily GBM file in $GBMDATA. The files are saved as v00
+    independent of the version that was downloaded.
+    :param date: string like '180407'
+    :param data_type: string like 'ctime', 'cspec', 'poshist'
+    :param detector: string like 'n1', 'n2' or 'all' for poshist
+    """
+    return (
+        get_path_of_external_data_dir()
+        / data_type
+        / date
+        / f"glg_{data_type}_{detector}_{date}_v00.{gbm_file_type(data_type)}"
+    )
+
+
+def gbm_daily_url(date, base_url=None):
+    """
+    Url of the directory with the daily GBM files of one day
+    """
+    if base_url is None:
+        base_url = GBM_DAILY_URL
+
+    return f"{base_url}/20{date[:2]}/{date[2:-2]}/{date[-2:]}/current/"
+
+
+def list_directory(url, timeout=60):
+    """
+    Names of the files in the html listing of a directory
+    """
+    with urlopen(url, timeout=timeout) as response:
+        html = response.read().decode(errors="ignore")
+
+    return set(_href_pattern.findall(html))
+
+
+def latest_versions(file_names, date, data_type):
+    """
+    Latest version of every detector in a directory listing
+    :param file_names: file names in the daily directory
+    :returns: dict detector -> file name of the latest version
+    """
+    pattern = re.compile(
+        rf"^glg_{data_type}_(\w+?)_{date}_v(\d+)\.{gbm_file_type(data_type)}$"
+    )
+
+    latest = {}
+    for file_name in file_names:
+        match = pattern.match(file_name)
+
+        if match is None:
+            continue
+
+        det, version = match.group(1), int(match.group(2))
+
+        if det not in latest or version > latest[det][0]:
+            latest[det] = (version, file_name)
+
+    return {det: file_name for det, (version, file_name) in latest.items()}
+
+
+def verify_fits_checksum(file_path):
+    """
+    Check the CHECKSUM and DATASUM keywords of all HDUs of a fits file
+    :returns: True if all checksums are fine or not present
+    """
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+
+        try:
+            with fits.open(file_path, checksum=True) as f:
+                for hdu in f:
+                    hdu.data
+        except (OSError, ValueError):
+            return False
+
+    return not any("verification failed" in str(w.message) for w in caught)
+
+
+def _download_part(url, part_path, timeout, chunk_size):
+    """
+    Download url to part_path, continues a partial file with a range request
+    """
+    offset = part_path.stat().st_size if part_path.exists() else 0
+
+    request = Request(url)
+    if offset > 0:
+        request.add_header("Range", f"bytes={offset}-")
+
+    try:
+        response = urlopen(request, timeout=timeout)
+    except HTTPError as e:
+        # the part file is not a prefix of the file anymore, start again
+        if e.code == 416:
+            part_path.unlink()
+        raise
+
+    with response:
+        total = None
+
+        if offset > 0 and response.status == 206:
+            content_range = response.headers.get("Content-Range", "")
+            if "/" in content_range and not content_range.endswith("*"):
+                total = int(content_range.rsplit("/", 1)[1])
+            mode = "ab"
+        else:
+            # the server ignored the range request
+            offset = 0
+            mode = "wb"
+
+        if total is None and response.headers.get("Content-Length") is not None:
+            total = offset + int(response.headers["Content-Length"])
+
+        with open(part_path, mode) as f:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+    if total is not None and part_path.stat().st_size != total:
+        raise IOError(f"Incomplete download of {url}")
+
+
+def fetch_file(url, final_path, timeout=60, chunk_size=1 << 20, retries=3):
+    """
+    Download a file into a .part file next to the final path and move it to
+    the final path after the size and the fits checksums are verified. An
+    interrupted download continues where it stopped.
+    :param url: url of the file
+    :param final_path: path of the downloaded file
+    :param retries: number of attempts
+    :returns: final_path
+    """
+    final_path = Path(final_path)
+    final_path.parent.mkdir(parents=True, exist_ok=True)
+
+    part_path = final_path.with_name(f"{final_path.name}.part")
+
+    for attempt in range(retries):
+        try:
+            _download_part(url, part_path, timeout, chunk_size)
+        except HTTPError as e:
+            if e.code == 404 or attempt == retries - 1:
+                raise
+            continue
+        except (IOError, OSError):
+            if attempt == retries - 1:
+                raise
+            continue
+
+        if verify_fits_checksum(part_path):
+            break
+
+        part_path.unlink()
+
+        if attempt == retries - 1:
+            raise IOError(f"Checksum verification failed for {url}")
+
+    os.replace(part_path, final_path)
+
+    return final_path
+
+
+def prefetch(
+    dates,
+    data_types=("ctime", "poshist"),
+    detectors=None,
+    max_workers=8,
+    base_url=None,
+    timeout=60,
+    check=False,
+):
+    """
+    Download the daily GBM files of several days in parallel. The latest
+    version of every file is found with one directory listing per day and
+    data type, files that are already in the index of $GBMDATA are skipped.
+    :param dates: list of dates like '180407'
+    :param data_types: list of 'ctime', 'cspec', 'poshist'
+    :param detectors: list of detectors for ctime/cspec, default all 14
+    :param max_workers: number of parallel downloads
+    :param base_url: url of the daily data, default the HEASARC archive
+    :param check: check that the files of the index still exist, removed
+    files are downloaded again
+    :returns: dict (date, data_type, detector) -> path of the downloaded
+    files, dict (date, data_type, detector) -> error of the failed ones
+    """
+    for data_type in data_types:
+        assert data_type in ["ctime", "cspec", "poshist"], "Wrong data_type..."
+
+    if detectors is None:
+        detectors = GBM_DETECTORS
+
+    index = get_file_index()
+
+    downloaded = {}
+    failed = {}
+
+    # the index is loaded on all ranks
+    missing_files = {}
+    for date in dates:
+        for data_type in data_types:
+            dets = ["all"] if data_type == "poshist" else detectors
+
+            for det in dets:
+                if index.lookup(date, data_type, det, version=0, check=check) is None:
+                    missing_files.setdefault(date, []).append((data_type, det))
+
+    if rank == 0:
+        tasks = []
+
+        for date, missing in missing_files.items():
+            url = gbm_daily_url(date, base_url)
+
+            try:
+                file_names = list_directory(url, timeout=timeout)
+            except (HTTPError, IOError) as e:
+                for data_type, det in missing:
+                    failed[(date, data_type, det)] = e
+                continue
+
+            versions = {
+                data_type: latest_versions(file_names, date, data_type)
+                for data_type in data_types
+            }
+
+            for data_type, det in missing:
+                file_name = versions[data_type].get(det)
+
+                if file_name is None:
+                    failed[(date, data_type, det)] = FileNotFoundError(
+                        f"No version of {data_type} {det} in {url}"
+                    )
+                    continue
+
+                tasks.append(
+                    (
+                        (date, data_type, det),
+                        f"{url}{file_name}",
+                        gbm_file_path(date, data_type, det),
+                    )
+                )
+
+        print(f"Download {len(tasks)} files with {max_workers} parallel downloads")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(fetch_file, url, path, timeout): key
+                for key, url, path in tasks
+            }
+
+            for future in as_completed(futures):
+                key = futures[future]
+                try:
+                    downloaded[key] = future.result()
+                except Exception as e:
+                    failed[key] = e
+
+        for key, e in failed.items():
+            print(f"Download of {key} failed: {e}")
+
+    if using_mpi:
+        comm.Barrier()
+        downloaded, failed = comm.bcast((downloaded, failed), root=0)
+
+    for path in downloaded.values():
+        index.add(path)
+
+    return downloaded, failed
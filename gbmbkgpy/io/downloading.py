@@ -1,8 +1,17 @@
 import os
 import shutil
+from pathlib import Path
 from urllib.error import HTTPError
 from astropy.utils.data import download_file
 
+from gbmbkgpy.io.bulk_download import (
+    fetch_file,
+    gbm_daily_url,
+    gbm_file_path,
+    latest_versions,
+    list_directory,
+)
+from gbmbkgpy.io.file_index import get_file_index
 from gbmbkgpy.io.file_utils import file_existing_and_readable
 from gbmbkgpy.utils.mpi import check_mpi
 from gbmbkgpy.io.package_data import get_path_of_data_dir, get_path_of_external_data_dir
@@ -120,60 +129,50 @@ def download_lat_spacecraft(mission_week):
     return final_path
 
 
-def download_gbm_file(date, data_type, detector="all"):
+def download_gbm_file(date, data_type, detector="all", check=False):
     """
     Download CTIME / CSPEC or POSHIST files
 
     :param date: string like '180407'
     :param data_type: string like 'ctime', 'cspec', 'poshist'
     :param detector: string like 'n1', 'n2' or 'all' for poshist
+    :param check: check that a file of the index still exists and download
+    it again if it was removed, e.g. after opening it failed
     :return:
     """
 
     assert data_type in ['ctime', 'cspec', 'poshist'], "Wrong data_type..."
 
-    year = "20%s" % date[:2]
-    month = date[2:-2]
-    day = date[-2:]
+    # the index is the same on all ranks, so either all ranks return here
+    # or all ranks wait at the barrier below
+    index = get_file_index()
 
-    data_path = get_path_of_external_data_dir()
-
-    file_path = data_path / data_type / date
-
-    # poshist files are not stored in a sub folder of the date
-    if data_type == "poshist":
-        file_type = "fit"
-    else:
-        file_type = "pha"
+    path = index.lookup(date, data_type, detector, version=0, check=check)
+    if path is not None:
+        return Path(path)
 
-    final_path = (file_path /
-                  f"glg_{data_type}_{detector}_{date}_v00.{file_type}")
+    final_path = gbm_file_path(date, data_type, detector)
 
     if rank == 0:
-        file_path.mkdir(parents=True, exist_ok=True)
-
         if not final_path.exists():
-            base_url = (f"https://heasarc.gsfc.nasa.gov/FTP/fermi/data/"
-                        f"gbm/daily/{year}/{month}/{day}/current/"
-                        f"glg_{data_type}_{detector}_{date}_v0")
+            url = gbm_daily_url(date)
 
-            path_to_file = None
-            for version in ["0", "1", "2", "3", "4"]:
-                try:
-                    path_to_file = download_file(f"{base_url}{version}.{file_type}")
-                except HTTPError:
-                    pass
-                if path_to_file is not None:
-                    break
+            # one listing of the daily directory instead of trying all versions
+            file_name = latest_versions(list_directory(url), date, data_type).get(
+                detector
+            )
 
-            if path_to_file is None:
-                print(f"No version found for the url {base_url}?.{file_type}")
+            assert file_name is not None, (
+                f"No version found for glg_{data_type}_{detector}_{date} in {url}"
+            )
 
-            shutil.move(path_to_file, final_path)
+            fetch_file(f"{url}{file_name}", final_path)
 
     if using_mpi:
         comm.Barrier()
 
+    index.add(final_path)
+
     return final_path
 
 
@@ -1,34 +1,120 @@
+import collections
+import copy
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
-import copy
 import arviz
 
-from gbmbkgpy.utils.pha import SPECTRUM, PHAII
+from gbmbkgpy.utils.pha import PHAII, write_phaii
 import h5py
 from gbmbkgpy.utils.progress_bar import progress_bar
+from gbmbkgpy.io.result_file import (
+    time_major_chunks,
+    write_result_dataset,
+    write_time_bins,
+)
 from gbmbkgpy.utils.binner import Rebinner
+from gbmbkgpy.utils.mpi import check_mpi, split_range, gatherv_array
+from gbmbkgpy.modeling.model import ModelDet
+from gbmbkgpy.modeling.ppc import PPCEngine
+from gbmbkgpy.utils.statistics.streaming_quantiles import StreamingPercentiles
 
 NO_REBIN = 1e-9
 
-try:
-    # see if we have mpi and/or are upalsing parallel
+using_mpi, rank, size, comm = check_mpi()
 
-    from mpi4py import MPI
 
-    if MPI.COMM_WORLD.Get_size() > 1:  # need parallel capabilities
-        using_mpi = True
+# percentiles of the ppc that are saved in the result files,
+# these are the 68%, 95% and 99% bands around the median
+PPC_PERCENTILES = [0.5, 2.5, 16.0, 50.0, 84.0, 97.5, 99.5]
 
-        comm = MPI.COMM_WORLD
-        rank = comm.Get_rank()
-        size = comm.Get_size()
 
-    else:
+def save_ppc_percentiles(
+    f,
+    percentiles,
+    levels,
+    num_samples,
+    exact=True,
+    ppc_counts=None,
+    compression="lzf",
+):
+    """
+    Save the percentile bands of the ppc and optionally a thinned subset
+    of the realizations to an open hdf5 file
+    :param f: h5py File
+    :param percentiles: percentiles of the ppc (len(levels), n_time_bins, ...)
+    :param levels: percentile levels in [0, 100]
+    :param num_samples: number of ppc realizations
+    :param exact: False if the percentiles are streaming estimates
+    :param ppc_counts: thinned realizations of the ppc
+    :param compression: compression of the datasets, see compression_options
+    """
+    dset = write_result_dataset(
+        f, "ppc_percentiles", percentiles, compression, time_axis=1
+    )
+    dset.attrs["levels"] = levels
+    dset.attrs["exact"] = exact
+    dset.attrs["num_samples"] = num_samples
+
+    if ppc_counts is not None:
+        write_result_dataset(f, "ppc_counts", ppc_counts, compression, time_axis=1)
+
+
+class _LegacyModelPPC(object):
+    def __init__(self, model, time_bins, chunk_size=50, seed=None):
+        """
+        Posterior predictive checks of the model of a model generator, with
+        the interface of the PPCEngine. This model has no precalculated
+        sources, so the counts are evaluated sample by sample with a copy
+        of the model.
+        :param model: model with free_parameters and get_counts
+        :param time_bins: time bins for the ppc
+        :param chunk_size: number of samples evaluated at once
+        :param seed: seed for the random number generator
+        """
+        self._model = copy.deepcopy(model)
+        self._time_bins = time_bins
+
+        assert chunk_size > 0, "chunk_size must be positive"
+        self._chunk_size = int(chunk_size)
+
+        self._rng = np.random.default_rng(seed)
+
+    def subsample(self, samples, max_samples):
+        if max_samples is None or len(samples) <= max_samples:
+            return samples
 
-        using_mpi = False
-        rank = 0
-except:
-    using_mpi = False
-    rank = 0
+        idx = np.sort(self._rng.choice(len(samples), max_samples, replace=False))
+        return samples[idx]
+
+    def _expected_counts(self, sample):
+        for i, parameter in enumerate(self._model.free_parameters.values()):
+            parameter.value = sample[i]
+
+        return self._model.get_counts(self._time_bins)
+
+    def iter_ppc_counts(self, samples):
+        samples = np.atleast_2d(samples)
+
+        for start in range(0, len(samples), self._chunk_size):
+            chunk = slice(start, min(start + self._chunk_size, len(samples)))
+
+            expected = np.array([self._expected_counts(s) for s in samples[chunk]])
+
+            yield chunk, self._rng.poisson(expected)
+
+    def ppc_counts(self, samples):
+        return np.concatenate([counts for _, counts in self.iter_ppc_counts(samples)])
+
+    @property
+    def time_bins(self):
+        return self._time_bins
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
 
 
 class DataExporter(object):
@@ -78,15 +164,22 @@ class DataExporter(object):
             self._time_bins = model_generator.data.time_bins
             self._saa_mask = model_generator.saa_calc.saa_mask
 
-        self._ppc_model = None
+        self._ppc_engine = None
         self._ppc_time_bins = None
 
-    def save_data(self, file_path, result_dir, save_ppc=True):
+    def save_data(
+        self, file_path, result_dir, save_ppc=True, ppc_thin=None, compression="lzf"
+    ):
         """
         Function to save the data needed to create the plots.
+        :param save_ppc: save the percentile bands of the rebinned ppc
+        :param ppc_thin: additionally save this number of rebinned ppc realizations
+        :param compression: "lzf", "gzip", "blosc", "zstd" or None
         """
         # Calculate the PPC
-        ppc_counts, ppc_counts_binned = self._ppc_data(result_dir)
+        stat_percentiles, ppc_percentiles, ppc_counts_binned = self._ppc_data(
+            result_dir, ppc_thin=ppc_thin
+        )
 
         if rank == 0:
             print("Save fit result to: {}".format(file_path))
@@ -98,8 +191,7 @@ class DataExporter(object):
             source_list = self.get_counts_of_sources()
 
             # Get the statistical error from the posterior samples
-            low = np.percentile(ppc_counts, 50 - 50 * 0.68, axis=0)
-            high = np.percentile(ppc_counts, 50 + 50 * 0.68, axis=0)
+            low, high = stat_percentiles.percentiles
             stat_err = high - low
 
             with h5py.File(file_path, "w") as f:
@@ -119,48 +211,31 @@ class DataExporter(object):
 
                 f.create_dataset("day_start_times", data=self._data.day_start_times)
                 f.create_dataset("day_stop_times", data=self._data.day_stop_times)
-                f.create_dataset(
-                    "saa_mask",
-                    data=self._saa_mask,
-                    compression="lzf",
-                )
-                f.create_dataset(
-                    "time_bins_start",
-                    data=self._time_bins[:, 0],
-                    compression="lzf",
-                )
-                f.create_dataset(
-                    "time_bins_stop",
-                    data=self._time_bins[:, 1],
-                    compression="lzf",
-                )
-                f.create_dataset(
-                    "observed_counts",
-                    data=self._data.counts,
-                    compression="lzf",
-                )
+                write_result_dataset(f, "saa_mask", self._saa_mask, compression)
+                write_time_bins(f, self._time_bins, compression)
 
-                f.create_dataset(
-                    "model_counts",
-                    data=model_counts,
-                    compression="lzf",
-                )
-                f.create_dataset("stat_err", data=stat_err, compression="lzf")
+                write_result_dataset(f, "observed_counts", self._data.counts, compression)
+                write_result_dataset(f, "model_counts", model_counts, compression)
+                write_result_dataset(f, "stat_err", stat_err, compression)
 
                 group_sources = f.create_group("sources")
                 for source in source_list:
-                    group_sources.create_dataset(
-                        source["label"],
-                        data=source["data"],
-                        compression="lzf",
+                    write_result_dataset(
+                        group_sources, source["label"], source["data"], compression
                     )
 
                 if save_ppc:
                     f.create_dataset(
                         "ppc_time_bins", data=self._ppc_time_bins, compression="lzf"
                     )
-                    f.create_dataset(
-                        "ppc_counts", data=ppc_counts_binned, compression="lzf"
+                    save_ppc_percentiles(
+                        f,
+                        ppc_percentiles.percentiles,
+                        ppc_percentiles.percentile_levels,
+                        ppc_percentiles.n,
+                        exact=ppc_percentiles.exact,
+                        ppc_counts=ppc_counts_binned,
+                        compression=compression,
                     )
 
             print("File sucessfully saved!")
@@ -210,11 +285,16 @@ class DataExporter(object):
 
         return source_list
 
-    def _ppc_data(self, result_dir):
+    def _ppc_data(self, result_dir, ppc_thin=None, buffer_size=100):
         """
-        Add ppc plot
+        Calculate the statistics of the posterior predictive checks. The
+        poisson realizations are fed batch by batch into streaming percentile
+        estimators, so not all of them have to be kept in memory.
         :param result_dir: path to result directory
-        :param echan: Which echan
+        :param ppc_thin: number of rebinned realizations that are kept
+        :param buffer_size: number of realizations with exact percentiles
+        :return: percentiles of the unbinned ppc for the stat_err, percentiles
+        of the rebinned ppc and the thinned rebinned realizations (or None)
         """
 
         data_rebinner = Rebinner(self._time_bins, min_bin_width=60, mask=self._saa_mask)
@@ -226,175 +306,231 @@ class DataExporter(object):
         analyzer = pymultinest.analyse.Analyzer(1, result_dir)
         mn_posteriour_samples = analyzer.get_equal_weighted_posterior()[:, :-1]
 
-        counts = []
-        counts_binned = []
+        # Choose N_samples random samples, if multinest returns less then 500
+        # posterior samples the use the maximal possible number
+        engine = self._get_ppc_engine()
+
+        ppc_samples = engine.subsample(mn_posteriour_samples, 500)
 
-        # Make a mask with 500 random True to choose N_samples random samples,
-        # if multinest returns less then 500 posterior samples the use the maximal possible number
-        N_samples = (
-            500 if len(mn_posteriour_samples) > 500 else len(mn_posteriour_samples)
+        stat_percentiles = StreamingPercentiles(
+            [50 - 50 * 0.68, 50 + 50 * 0.68],
+            (len(self._time_bins), self._data.num_echan),
+            buffer_size=buffer_size,
         )
 
-        random_mask = np.zeros(len(mn_posteriour_samples), dtype=int)
-        random_mask[:N_samples] = 1
-        np.random.shuffle(random_mask)
-        random_mask = random_mask.astype(bool)
+        binned_percentiles = StreamingPercentiles(
+            PPC_PERCENTILES,
+            (len(self._ppc_time_bins), self._data.num_echan),
+            buffer_size=buffer_size,
+        )
+
+        # keep every n-th realization for the thinned subset
+        if ppc_thin is not None and ppc_thin > 0:
+            thin_step = max(1, int(np.ceil(len(ppc_samples) / ppc_thin)))
+            ppc_counts_binned = []
+        else:
+            thin_step = None
+            ppc_counts_binned = None
 
         # For these N_samples random samples calculate the corresponding rates for all time bins
         # with the parameters of this sample
         if using_mpi:
 
-            points_per_rank = float(N_samples) / float(size)
-            points_lower_index = int(np.floor(points_per_rank * rank))
-            points_upper_index = int(np.floor(points_per_rank * (rank + 1)))
-
-            hidden = False if rank == 0 else True
-
-            with progress_bar(
-                len(
-                    mn_posteriour_samples[random_mask][
-                        points_lower_index:points_upper_index
-                    ]
-                ),
-                title="Calculating PPC",
-                hidden=hidden,
-            ) as p:
-
-                for i, sample in enumerate(
-                    mn_posteriour_samples[random_mask][
-                        points_lower_index:points_upper_index
-                    ]
-                ):
-                    synth_counts = self.get_synthetic_data(sample).astype(np.uint32)
-                    counts.append(synth_counts)
-
-                    rebinned_counts = data_rebinner.rebin(synth_counts)[0]
+            points_lower_index, points_upper_index = split_range(
+                len(ppc_samples), rank, size
+            )
 
-                    counts_binned.append(rebinned_counts)
+            # all ranks have to take part in the same number of gathers
+            num_chunks = int(
+                np.ceil(np.ceil(len(ppc_samples) / size) / engine.chunk_size)
+            )
 
-                    p.increase()
+            hidden = False if rank == 0 else True
 
-            # Now combine and brodcast the results in small packages,
-            # because mpi can't handle arrays that big
-            ppc_counts = None
-            ppc_counts_binned = None
+        else:
+            points_lower_index = 0
+            points_upper_index = len(ppc_samples)
 
-            with progress_bar(len(counts), title="Gather PCC", hidden=hidden) as p:
-                for i, cnts in enumerate(counts):
+            num_chunks = int(np.ceil(len(ppc_samples) / engine.chunk_size))
 
-                    counts_g = comm.gather(cnts, root=0)
+            hidden = False
 
-                    counts_binned_g = comm.gather(counts_binned[i], root=0)
+        chunks = self._ppc_counts(
+            engine,
+            data_rebinner,
+            ppc_samples[points_lower_index:points_upper_index],
+            num_chunks,
+        )
 
-                    if rank == 0:
+        num_seen = 0
 
-                        counts_g = np.array(counts_g)
+        with progress_bar(num_chunks, title="Calculating PPC", hidden=hidden) as p:
 
-                        counts_binned_g = np.array(counts_binned_g)
+            for counts, counts_binned in chunks:
 
-                        if ppc_counts is None:
+                if using_mpi:
+                    counts = gatherv_array(counts, root=0)
+                    counts_binned = gatherv_array(counts_binned, root=0)
 
-                            ppc_counts = counts_g
+                if rank == 0:
+                    stat_percentiles.update(counts)
+                    binned_percentiles.update(counts_binned)
 
-                            ppc_counts_binned = counts_binned_g
+                    if thin_step is not None:
+                        keep = (num_seen + np.arange(len(counts_binned))) % thin_step == 0
+                        ppc_counts_binned.append(counts_binned[keep])
 
-                        else:
+                    num_seen += len(counts_binned)
 
-                            ppc_counts = np.append(ppc_counts, counts_g, axis=0)
+                p.increase()
 
-                            ppc_counts_binned = np.append(
-                                ppc_counts_binned, counts_binned_g, axis=0
-                            )
+        if rank == 0 and ppc_counts_binned is not None:
+            ppc_counts_binned = np.concatenate(ppc_counts_binned)
 
-                    p.increase()
+        return stat_percentiles, binned_percentiles, ppc_counts_binned
 
-        else:
-            with progress_bar(
-                len(mn_posteriour_samples[random_mask]),
-                title="Calculation PPC",
-            ) as p:
+    def _ppc_counts(self, engine, data_rebinner, samples, num_chunks):
+        """
+        Poisson realizations of the model for the given samples in chunks,
+        unbinned and rebinned with the data_rebinner. Yields empty chunks
+        until num_chunks are reached.
+        """
+        chunks = engine.iter_ppc_counts(samples)
 
-                for i, sample in enumerate(mn_posteriour_samples[random_mask]):
-                    synth_counts = self.get_synthetic_data(sample)
-                    counts.append(synth_counts)
+        for _ in range(num_chunks):
+            try:
+                _, counts = next(chunks)
+                counts = counts.astype(np.uint32)
 
-                    rebinned_counts = data_rebinner.rebin(synth_counts)[0]
+            except StopIteration:
+                counts = np.zeros(
+                    (0, len(engine.time_bins), self._data.num_echan), dtype=np.uint32
+                )
 
-                    counts_binned.append(rebinned_counts)
+            # rebin all samples at once, the rebinner sums along the time axis
+            if len(counts) > 0:
+                counts_binned = np.moveaxis(
+                    data_rebinner.rebin(np.moveaxis(counts, 0, 1))[0], 1, 0
+                )
+            else:
+                counts_binned = np.zeros(
+                    (0, data_rebinner.n_bins, self._data.num_echan), dtype=np.uint32
+                )
 
-                    p.increase()
+            yield counts, counts_binned
 
-            ppc_counts = np.array(counts)
-            ppc_counts_binned = np.array(counts_binned)
+    def _get_ppc_engine(self):
+        if self._ppc_engine is None:
+            if isinstance(self._model, ModelDet):
+                self._ppc_engine = PPCEngine(self._model, time_bins=self._time_bins)
+            else:
+                self._ppc_engine = _LegacyModelPPC(self._model, self._time_bins)
 
-        return ppc_counts, ppc_counts_binned
+        return self._ppc_engine
 
     def get_synthetic_data(self, synth_parameters):
         """
-        Creates a ContinousData object with synthetic data based on the total counts from the synth_model
-        If no synth_model is passed it makes a deepcopy of the existing model
+        Creates synthetic data based on the total counts of the model with
+        the given parameters
         :param synth_parameters:
         :return:
         """
-        if self._ppc_model is None:
+        return self._get_ppc_engine().ppc_counts(synth_parameters)[0]
 
-            self._ppc_model = copy.deepcopy(self._model)
 
-        for i, parameter in enumerate(self._ppc_model.free_parameters.values()):
-            parameter.value = synth_parameters[i]
+class PHAExporter(DataExporter):
+    def __init__(self, *args, **kwargs):
+        super(PHAExporter, self).__init__(*args, **kwargs)
 
-        synth_counts = np.random.poisson(
-            self._ppc_model.get_counts(self._data.time_bins)
-        )
+    def save_pha(
+        self, path, result_dir, chunk_size=None, max_workers=None, overwrite=False
+    ):
+        """
+        Save the model rates of all time bins with the statistical error
+        from the posterior samples as PHAII files, one per detector. All
+        echans are evaluated at once and the files are written in parallel.
+        :param path: path of the PHAII file, with several detectors the
+        detector name is appended to the file name
+        :param chunk_size: write the rows to the files in chunks of this size
+        :param max_workers: number of files written at the same time
+        """
+        # all ranks take part in the calculation of the ppc
+        stat_percentiles, _, _ = self._ppc_data(result_dir)
 
-        return synth_counts
+        if rank != 0:
+            return
 
+        time_bin_widths = self._time_bins[:, 1] - self._time_bins[:, 0]
 
-class PHAExporter(DataExporter):
-    def __init__(self, *args, **kwargs):
-        super(PHAExporter, self).__init__(*args, **kwargs)
+        # Get the model counts of all echans
+        model_counts = self._model.get_counts(time_bins=self._time_bins)
 
-    def save_pha(self, path, result_dir):
-        model_counts = np.zeros(
-            (len(self._total_time_bin_widths), len(self._echan_names))
-        )
-        stat_err = np.zeros_like(model_counts)
+        # Get the statistical error from the posterior samples
+        low, high = stat_percentiles.percentiles
+        stat_err = high - low
 
-        # Get the model counts
-        for echan in self._echan_names:
-            model_counts[:, echan] = self._model.get_counts(
-                self._total_time_bins, echan, saa_mask=self._saa_mask
+        # one detector has no detector axis
+        if model_counts.ndim == 2:
+            model_counts = model_counts[:, np.newaxis]
+            stat_err = stat_err[:, np.newaxis]
+
+        detectors = list(getattr(self._data, "detectors", [None]))
+        echans = np.arange(model_counts.shape[-1])
+
+        root, ext = os.path.splitext(path)
+
+        def write(det_idx):
+            det = detectors[det_idx]
+
+            write_phaii(
+                path if len(detectors) == 1 else f"{root}_{det}{ext}",
+                tstart=self._time_bins[:, 0],
+                telapse=time_bin_widths,
+                channel=echans,
+                rate=model_counts[:, det_idx] / time_bin_widths[:, np.newaxis],
+                exposure=time_bin_widths,
+                stat_err=stat_err[:, det_idx] / time_bin_widths[:, np.newaxis],
+                instrument_name=(
+                    "GBM" if det is None else "GBM_{}".format(det_name_lookup[det])
+                ),
+                telescope_name="Fermi",
+                chunk_size=chunk_size,
+                overwrite=overwrite,
             )
-        model_rates = model_counts / self._total_time_bin_widths
 
-        # Get the statistical error from the posterior samples
-        for echan in self._echan_names:
-            counts = self._ppc_data(result_dir, echan)[:, 2:-2]
-            rates = counts / self._total_time_bin_widths
-
-            low = np.percentile(rates, 50 - 50 * 0.68, axis=0)[0]
-            high = np.percentile(rates, 50 + 50 * 0.68, axis=0)[0]
-
-            stat_err[:, echan] = high - low
-
-        spectrum = SPECTRUM(
-            tstart=self._total_time_bins[:, 1],
-            telapse=self._total_time_bin_widths,
-            channel=self._echan_names,
-            rate=model_rates,
-            quality=np.zeros_like(model_rates, dtype=int),
-            grouping=np.ones_like(self._echan_names),
-            exposure=self._total_time_bin_widths,
-            backscale=None,
-            respfile=None,
-            ancrfile=None,
-            back_file=None,
-            sys_err=None,
-            stat_err=stat_err,
-            is_poisson=False,
-        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(write, range(len(detectors))))
 
-        spectrum.hdu.dump(path)
+
+def _generated_quantities_draws(generated_quantities):
+    """
+    Draws of a standalone generated quantities run with shape (n_draws,
+    n_columns) and the column names in the form name.i.j. cmdstanpy<1.0
+    has the generated_quantities array, later versions the draws method
+    and column names like name[i,j].
+    """
+    if hasattr(generated_quantities, "generated_quantities"):
+        draws = generated_quantities.generated_quantities
+    else:
+        draws = generated_quantities.draws(concat_chains=True)
+
+    column_names = [
+        name.replace("[", ".").replace("]", "").replace(",", ".")
+        for name in generated_quantities.column_names
+    ]
+
+    return draws, column_names
+
+
+def _variable_columns(column_names, name):
+    """
+    Indices of the columns of the variable (or element) name
+    """
+    return [
+        i
+        for i, column in enumerate(column_names)
+        if column == name or column.startswith(f"{name}.")
+    ]
 
 
 class StanDataExporter(object):
@@ -407,7 +543,12 @@ class StanDataExporter(object):
         source_counts,
         parameter_names,
         best_fit_parameters,
+        ppc_thin=None,
     ):
+        """
+        :param ppc_thin: number of ppc realizations that are saved in addition
+        to the percentile bands
+        """
         self._data = model_generator.data
         self._model = model_generator.model
 
@@ -441,11 +582,19 @@ class StanDataExporter(object):
 
         self._sources = source_counts
 
-        self._ppc_counts = ppc_counts
+        # All realizations are in memory, so the percentiles are exact
+        self._ppc_percentiles = np.percentile(ppc_counts, PPC_PERCENTILES, axis=0)
+        self._num_ppc_samples = len(ppc_counts)
+
+        if ppc_thin is not None and ppc_thin > 0:
+            thin_step = max(1, int(np.ceil(len(ppc_counts) / ppc_thin)))
+            self._ppc_counts = ppc_counts[::thin_step]
+        else:
+            self._ppc_counts = None
 
         # Get the statistical error from the posterior samples
-        low = np.percentile(ppc_counts, 50 - 50 * 0.68, axis=0)
-        high = np.percentile(ppc_counts, 50 + 50 * 0.68, axis=0)
+        low = self._ppc_percentiles[PPC_PERCENTILES.index(50 - 50 * 0.68)]
+        high = self._ppc_percentiles[PPC_PERCENTILES.index(50 + 50 * 0.68)]
         self._stat_err = high - low
 
         self._parameter_names = parameter_names
@@ -453,8 +602,15 @@ class StanDataExporter(object):
 
     @classmethod
     def from_generated_quantities(
-        cls, model_generator, generated_quantities, stan_fit, param_lookup
+        cls, model_generator, generated_quantities, stan_fit, param_lookup, ppc_thin=None
     ):
+        """
+        Exporter of a standalone generated quantities run
+        :param generated_quantities: CmdStanGQ, e.g. of
+        StanModelConstructor.generate_quantities
+        :param stan_fit: CmdStanMCMC of the sampling
+        :param param_lookup: param_lookup of the StanDataConstructor
+        """
         mask_zero_counts = model_generator.data.counts[2:-2].flatten() != 0
 
         ndets = len(model_generator.data.detectors)
@@ -462,26 +618,16 @@ class StanDataExporter(object):
         ntime_bins = len(
             model_generator.data.time_bins[2:-2][mask_zero_counts[:: ndets * nechans]]
         )
-        nsamples = generated_quantities.generated_quantities.shape[0]
+        draws, column_names = _generated_quantities_draws(generated_quantities)
+        nsamples = draws.shape[0]
 
-        tot_column_idx = [
-            i
-            for i, name in enumerate(generated_quantities.column_names)
-            if name.startswith("tot")
-        ]
-        ppc_column_idx = [
-            i
-            for i, name in enumerate(generated_quantities.column_names)
-            if name.startswith("ppc")
-        ]
-
-        model_counts = generated_quantities.generated_quantities[
-            :, tot_column_idx
-        ].reshape((nsamples, ntime_bins, ndets, nechans))
+        model_counts = draws[:, _variable_columns(column_names, "tot")].reshape(
+            (nsamples, ntime_bins, ndets, nechans)
+        )
 
-        ppc_counts = generated_quantities.generated_quantities[
-            :, ppc_column_idx
-        ].reshape((nsamples, ntime_bins, ndets, nechans))
+        ppc_counts = draws[:, _variable_columns(column_names, "ppc")].reshape(
+            (nsamples, ntime_bins, ndets, nechans)
+        )
 
         source_counts = {}
 
@@ -489,32 +635,26 @@ class StanDataExporter(object):
             model_generator.model.global_sources.keys(), start=1
         ):
 
-            column_idx = [
-                i
-                for i, name in enumerate(generated_quantities.column_names)
-                if name.startswith(f"f_fixed_global.{source_idx}")
-            ]
+            column_idx = _variable_columns(
+                column_names, f"f_fixed_global.{source_idx}"
+            )
 
             if len(column_idx) > 0:
 
-                source_counts[source_name] = generated_quantities.generated_quantities[
-                    :, column_idx
-                ].reshape((nsamples, ntime_bins, ndets, nechans))
+                source_counts[source_name] = draws[:, column_idx].reshape(
+                    (nsamples, ntime_bins, ndets, nechans)
+                )
 
         for source_idx, source_name in enumerate(
             model_generator.model.continuum_sources.keys(), start=1
         ):
 
-            column_idx = [
-                i
-                for i, name in enumerate(generated_quantities.column_names)
-                if name.startswith(f"f_cont.{source_idx}")
-            ]
+            column_idx = _variable_columns(column_names, f"f_cont.{source_idx}")
 
             if len(column_idx) > 0:
-                source_counts[source_name] = generated_quantities.generated_quantities[
-                    :, column_idx
-                ].reshape((nsamples, ntime_bins, ndets, nechans))
+                source_counts[source_name] = draws[:, column_idx].reshape(
+                    (nsamples, ntime_bins, ndets, nechans)
+                )
 
         # Get the best fit values from the stan fit
         best_fit_parameters = np.zeros(len(param_lookup))
@@ -533,7 +673,7 @@ class StanDataExporter(object):
                 # to param.i.d.e
                 stan_param_name = (
                     param_info["stan_param_name"]
-                    .replace["[", ""]
+                    .replace("[", "")
                     .replace("]", "")
                     .replace(",", ".")
                 )
@@ -550,10 +690,11 @@ class StanDataExporter(object):
             source_counts,
             parameter_names,
             best_fit_parameters,
+            ppc_thin=ppc_thin,
         )
 
     @classmethod
-    def from_arviz_file(cls, model_generator, arviz_file):
+    def from_arviz_file(cls, model_generator, arviz_file, ppc_thin=None):
 
         arviz_result = arviz.from_netcdf(arviz_file)
 
@@ -616,15 +757,17 @@ class StanDataExporter(object):
             model_generator=model_generator,
             mask_zero_counts=[],
             model_counts=model_counts,
-            ppcs=ppcs,
-            sources=sources,
+            ppc_counts=ppcs,
+            source_counts=sources,
             parameter_names=[],
             best_fit_parameters=[],
+            ppc_thin=ppc_thin,
         )
 
-    def save_data(self, file_path, save_ppc=True):
+    def save_data(self, file_path, save_ppc=True, compression="lzf"):
         """
         Function to save the data needed to create the plots.
+        :param compression: "lzf", "gzip", "blosc", "zstd" or None
         """
         if rank == 0:
             print("Save fit result to: {}".format(file_path))
@@ -646,48 +789,30 @@ class StanDataExporter(object):
 
                 f.create_dataset("day_start_times", data=self._data.day_start_times)
                 f.create_dataset("day_stop_times", data=self._data.day_stop_times)
-                f.create_dataset(
-                    "saa_mask",
-                    data=self._saa_mask,
-                    compression="lzf",
-                )
-                f.create_dataset(
-                    "time_bins_start",
-                    data=self._time_bins[:, 0],
-                    compression="lzf",
-                )
-                f.create_dataset(
-                    "time_bins_stop",
-                    data=self._time_bins[:, 1],
-                    compression="lzf",
-                )
-                f.create_dataset(
-                    "observed_counts",
-                    data=self._observed_counts,
-                    compression="lzf",
-                )
+                write_result_dataset(f, "saa_mask", self._saa_mask, compression)
+                write_time_bins(f, self._time_bins, compression)
 
-                f.create_dataset(
-                    "model_counts",
-                    data=self._mean_model_counts,
-                    compression="lzf",
-                )
-                f.create_dataset("stat_err", data=self._stat_err, compression="lzf")
+                write_result_dataset(f, "observed_counts", self._observed_counts, compression)
+                write_result_dataset(f, "model_counts", self._mean_model_counts, compression)
+                write_result_dataset(f, "stat_err", self._stat_err, compression)
 
                 group_sources = f.create_group("sources")
                 for source_name, source in self._sources.items():
-                    group_sources.create_dataset(
-                        source_name,
-                        data=np.mean(source, axis=0),
-                        compression="lzf",
+                    write_result_dataset(
+                        group_sources, source_name, np.mean(source, axis=0), compression
                     )
 
                 if save_ppc:
                     f.create_dataset(
                         "ppc_time_bins", data=self._time_bins, compression="lzf"
                     )
-                    f.create_dataset(
-                        "ppc_counts", data=self._ppc_counts, compression="lzf"
+                    save_ppc_percentiles(
+                        f,
+                        self._ppc_percentiles,
+                        PPC_PERCENTILES,
+                        self._num_ppc_samples,
+                        ppc_counts=self._ppc_counts,
+                        compression=compression,
                     )
 
             print("File sucessfully saved!")
@@ -728,6 +853,99 @@ valid_det_names = [
 ]
 
 
+# number of energy channels of the data types
+_n_channels = {"ctime": 8, "cspec": 128, "trigdat": 8}
+
+
+def _array_hash(*arrays):
+    sha = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        sha.update(str((a.dtype, a.shape)).encode())
+        sha.update(a.tobytes())
+    return sha.hexdigest()
+
+
+def _read_result_header(result_file):
+    """
+    Attributes, time bins and saa mask of a result file
+    """
+    with h5py.File(result_file, "r") as f:
+        time_bins_start = f["time_bins_start"][()]
+        time_bins_stop = f["time_bins_stop"][()]
+        saa_mask = f["saa_mask"][()]
+
+        return dict(
+            file=str(result_file),
+            dates=list(f.attrs["dates"]),
+            data_type=f.attrs["data_type"],
+            trigger=f.attrs.get("trigger", None),
+            trigger_time=f.attrs.get("trigger_time", 0.0),
+            detectors=list(f.attrs["detectors"]),
+            echans=list(f.attrs["echans"]),
+            n_bins=len(time_bins_stop),
+            time_bins=np.vstack((time_bins_start, time_bins_stop)).T,
+            time_bins_hash=_array_hash(time_bins_start, time_bins_stop),
+            saa_mask=saa_mask,
+            saa_mask_hash=_array_hash(saa_mask),
+        )
+
+
+def _read_result_hashes(result_file):
+    """
+    Header of a result file with only the hashes of the time bins and the
+    saa mask, which is returned to the calling process
+    """
+    result = _read_result_header(result_file)
+    del result["time_bins"], result["saa_mask"]
+
+    return result
+
+
+def _copy_result_counts(result_file, det_idx, echan_idx, outputs):
+    """
+    Copy the counts of a result file into the combined arrays or datasets.
+    The datasets are read in blocks of their time chunks, so only one block
+    is in memory and every chunk is decompressed once.
+    :param det_idx: index in the combined arrays of each detector of the file
+    :param echan_idx: index in the combined arrays of each echan of the file
+    :param outputs: dict with the combined observed_counts, model_counts and
+    stat_err
+    """
+    with h5py.File(result_file, "r") as f:
+        for name, output in outputs.items():
+            dset = f[name]
+
+            chunks = dset.chunks
+            if chunks is None:
+                chunks = time_major_chunks(dset.shape, dset.dtype.itemsize)
+
+            for start in range(0, dset.shape[0], chunks[0]):
+                stop = min(start + chunks[0], dset.shape[0])
+                block = dset[start:stop]
+
+                for i, d in enumerate(det_idx):
+                    for j, e in enumerate(echan_idx):
+                        output[start:stop, d, e] = block[:, i, j]
+
+
+def _bounded_map(executor, fn, items, max_pending):
+    """
+    executor.map that submits at most max_pending calls ahead, so only a few
+    results wait in memory for the calling process
+    """
+    pending = collections.deque()
+
+    for item in items:
+        pending.append(executor.submit(fn, item))
+
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while len(pending) > 0:
+        yield pending.popleft().result()
+
+
 class PHAWriter(object):
     """
     Class to load multiple result files for the same date or the same trigger
@@ -762,108 +980,165 @@ class PHAWriter(object):
         self._stat_err = stat_err
         self._det_echan_loaded = det_echan_loaded
 
-    @classmethod
-    def from_result_files(cls, result_file_list):
-        detectors = []
-        echans = []
-        det_echan_loaded = []
+        # combined hdf5 file the counts are read from
+        self._file = None
 
-        for i, file in enumerate(result_file_list):
-            with h5py.File(file, "r") as f:
-                dates_f = f.attrs["dates"]
-                data_type_f = f.attrs["data_type"]
-                trigger_f = f.attrs.get("trigger", None)
-                trigger_time_f = f.attrs.get("trigger_time", 0.0)
-                detectors_f = f.attrs["detectors"]
-                echans_f = f.attrs["echans"]
-                time_bins_start_f = f["time_bins_start"][()]
-                time_bins_stop_f = f["time_bins_stop"][()]
-                saa_mask_f = f["saa_mask"][()]
-
-                observed_counts_f = f["observed_counts"][()]
-                model_counts_f = f["model_counts"][()]
-                stat_err_f = f["stat_err"][()]
+    def __enter__(self):
+        return self
 
-            if i == 0:
-                dates = dates_f
-                data_type = data_type_f
-                trigger = trigger_f
-                trigger_time = trigger_time_f
-                time_bins = np.vstack((time_bins_start_f, time_bins_stop_f)).T
-                saa_mask = saa_mask_f
-                observed_counts = np.zeros((len(time_bins_stop_f), 14, 8))
-                model_counts = np.zeros((len(time_bins_stop_f), 14, 8))
-                stat_err = np.zeros_like(model_counts)
+    def __exit__(self, *args):
+        self.close()
 
-            else:
-                assert dates == dates_f
-                assert data_type == data_type_f
-                assert trigger == trigger_f
-                assert trigger_time == trigger_time_f
-                assert np.array_equal(
-                    time_bins, np.vstack((time_bins_start_f, time_bins_stop_f)).T
+    def close(self):
+        """
+        Close the combined hdf5 file of the counts, if there is one
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    @classmethod
+    def from_result_files(cls, result_file_list, output_path=None, max_workers=None):
+        """
+        Combine result files with disjoint detector/echan combinations. The
+        headers of the files are read and checked in parallel by a pool of
+        processes. The counts of each file are then copied block by block
+        into a preallocated array of shape (n_time_bins, 14, n_channels), or
+        straight into the chunked datasets of a combined hdf5 file if
+        output_path is given. In this case the PHAWriter reads the counts
+        from the combined file, which stays open until close() is called.
+        :param result_file_list: list of result files
+        :param output_path: path of a combined hdf5 file that is created
+        :param max_workers: number of processes that read the headers
+        """
+        # the header of the first file defines the time grid and data type
+        header = _read_result_header(result_file_list[0])
+
+        n_bins = header["n_bins"]
+        n_channels = _n_channels[header["data_type"]]
+        shape = (n_bins, len(valid_det_names), n_channels)
+
+        names = ["observed_counts", "model_counts", "stat_err"]
+
+        if output_path is not None:
+            out_file = h5py.File(output_path, "w")
+            # one chunk per detector/echan column
+            chunks = (min(n_bins, 65536), 1, 1)
+            outputs = {
+                name: out_file.create_dataset(
+                    name, shape, dtype="f8", chunks=chunks, compression="lzf"
                 )
-                assert np.array_equal(saa_mask, saa_mask_f)
+                for name in names
+            }
+        else:
+            out_file = None
+            outputs = {name: np.zeros(shape) for name in names}
 
-            for det_tmp_idx, det in enumerate(detectors_f):
+        detectors = []
+        echans = []
+        det_echan_loaded = []
 
-                if det not in detectors:
-                    detectors.append(det)
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
 
-                det_idx = valid_det_names.index(det)
+        try:
+            # h5py serializes all calls within one process, so the headers
+            # are read in separate processes while the counts of the
+            # finished files are copied
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                for result in _bounded_map(
+                    executor, _read_result_hashes, result_file_list, 2 * max_workers
+                ):
 
-                for echan_idx, echan in enumerate(echans_f):
+                    assert result["dates"] == header["dates"]
+                    assert result["data_type"] == header["data_type"]
+                    assert result["trigger"] == header["trigger"]
+                    assert result["trigger_time"] == header["trigger_time"]
+                    assert (
+                        result["time_bins_hash"] == header["time_bins_hash"]
+                    ), "{} has a different time binning".format(result["file"])
+                    assert (
+                        result["saa_mask_hash"] == header["saa_mask_hash"]
+                    ), "{} has a different saa mask".format(result["file"])
 
-                    det_echan = "{}_{}".format(det, echan)
+                    for det in result["detectors"]:
 
-                    if echan not in echans:
-                        echans.append(echan)
+                        if det not in detectors:
+                            detectors.append(det)
 
-                    assert (
-                        det_echan not in det_echan_loaded
-                    ), "{}-{} already loaded, you have to resolve the conflict by hand".format(
-                        det, echan
-                    )
+                        for echan in result["echans"]:
 
-                    echan = int(echan)
+                            det_echan = "{}_{}".format(det, echan)
 
-                    # Combine the observed counts
-                    observed_counts[:, det_idx, echan] = observed_counts_f[
-                        :, det_tmp_idx, echan_idx
-                    ]
+                            if echan not in echans:
+                                echans.append(echan)
 
-                    # Combine the model counts
-                    model_counts[:, det_idx, echan] = model_counts_f[
-                        :, det_tmp_idx, echan_idx
-                    ]
+                            assert (
+                                det_echan not in det_echan_loaded
+                            ), "{}-{} already loaded, you have to resolve the conflict by hand".format(
+                                det, echan
+                            )
 
-                    # Combine the statistical error of the fit
-                    stat_err[:, det_idx, echan] = stat_err_f[:, det_tmp_idx, echan_idx]
+                            # Append the det_echan touple to avoid overloading
+                            det_echan_loaded.append(det_echan)
 
-                    # Append the det_echan touple to avoid overloading
-                    det_echan_loaded.append(det_echan)
+                    # Combine the observed counts, model counts and
+                    # the statistical error of the fit
+                    _copy_result_counts(
+                        result["file"],
+                        [valid_det_names.index(det) for det in result["detectors"]],
+                        [int(echan) for echan in result["echans"]],
+                        outputs,
+                    )
+
+        except BaseException:
+            # do not leave a half written combined file
+            if out_file is not None:
+                out_file.close()
+                os.remove(output_path)
+            raise
 
         echans.sort()
         detectors.sort()
         det_echan_loaded.sort()
 
-        return cls(
-            dates,
-            trigger,
-            trigger_time,
-            data_type,
+        if out_file is not None:
+            out_file.close()
+
+        pha_writer = cls(
+            header["dates"],
+            header["trigger"],
+            header["trigger_time"],
+            header["data_type"],
             echans,
             detectors,
-            time_bins,
-            saa_mask,
-            observed_counts,
-            model_counts,
-            stat_err,
+            header["time_bins"],
+            header["saa_mask"],
+            outputs["observed_counts"],
+            outputs["model_counts"],
+            outputs["stat_err"],
             det_echan_loaded,
         )
 
+        if output_path is not None:
+            # add the attributes and the time bins to the combined file
+            pha_writer.save_combined_hdf5(output_path, mode="a")
+
+            # the counts stay in the combined file and are read when needed
+            pha_writer._file = h5py.File(output_path, "r")
+            pha_writer._observed_counts = pha_writer._file["observed_counts"]
+            pha_writer._model_counts = pha_writer._file["model_counts"]
+            pha_writer._stat_err = pha_writer._file["stat_err"]
+
+        return pha_writer
+
     @classmethod
-    def from_arviz_result_files(cls, result_file_list):
+    def from_arviz_result_files(cls, result_file_list, data_type="ctime"):
+        """
+        Combine arviz result files with disjoint detector/echan combinations
+        :param result_file_list: list of netcdf files
+        :param data_type: data type of the fits, defines the number of channels
+        """
         detectors = []
         echans = []
         det_echan_loaded = []
@@ -897,8 +1172,13 @@ class PHAWriter(object):
 
             if i == 0:
                 time_bins = time_bins_f
-                observed_counts = np.zeros((ntime_bins, 14, 8))
-                model_counts = np.zeros((nsamples, ntime_bins, 14, 8))
+                n_channels = _n_channels[data_type]
+                observed_counts = np.zeros(
+                    (ntime_bins, len(valid_det_names), n_channels)
+                )
+                model_counts = np.zeros(
+                    (nsamples, ntime_bins, len(valid_det_names), n_channels)
+                )
 
             else:
                 assert np.array_equal(time_bins, time_bins_f)
@@ -952,7 +1232,6 @@ class PHAWriter(object):
         dates = ["dummy"]
         trigger = ["trigger"]
         trigger_time = 0.0
-        data_type = "ctime"
         saa_mask = np.ones(ntime_bins, dtype=bool)
 
         return cls(
@@ -1014,9 +1293,12 @@ class PHAWriter(object):
             stat_err,
         )
 
-    def save_combined_hdf5(self, output_path):
-
-        with h5py.File(output_path, "w") as f:
+    def save_combined_hdf5(self, output_path, mode="w"):
+        """
+        Save the combined arrays in a hdf5 file. In mode "a" the count
+        datasets that already exist in the file are kept.
+        """
+        with h5py.File(output_path, mode) as f:
 
             f.attrs["dates"] = self._dates
 
@@ -1042,19 +1324,13 @@ class PHAWriter(object):
                 compression="lzf",
             )
 
-            f.create_dataset(
-                "observed_counts",
-                data=self._observed_counts,
-                compression="lzf",
-            )
-
-            f.create_dataset(
-                "model_counts",
-                data=self._model_counts,
-                compression="lzf",
-            )
-
-            f.create_dataset("stat_err", data=self._stat_err, compression="lzf")
+            for name, data in [
+                ("observed_counts", self._observed_counts),
+                ("model_counts", self._model_counts),
+                ("stat_err", self._stat_err),
+            ]:
+                if name not in f:
+                    f.create_dataset(name, data=data, compression="lzf")
 
     def write_pha(
         self,
@@ -1064,9 +1340,11 @@ class PHAWriter(object):
         trigger_time=None,
         file_name=None,
         overwrite=False,
+        max_workers=None,
     ):
         """
         Creates saves a background file for each detector
+        :param max_workers: number of detectors that are written at the same time
         """
 
         if trigger_time is not None:
@@ -1080,37 +1358,48 @@ class PHAWriter(object):
         idx_max_time = time_bins[:, 1] <= active_time_end
         idx_valid_bin = idx_min_time * idx_max_time
 
-        for det in self._detectors:
+        # the loaded echans, the dead time is calculated with all channels
+        echans = np.array([int(e) for e in self._echans])
+
+        if file_name is None:
+
+            if self._trigger is None:
+
+                file_name = "_".join(self._dates)
+
+            else:
+
+                file_name = self._trigger
+
+        def write(det):
             det_idx = valid_det_names.index(det)
 
             tstart = time_bins[idx_valid_bin][0, 0]
 
-            telapse = (
-                time_bins[idx_valid_bin][-1, 1] - time_bins[idx_valid_bin][0, 0],
-            )
+            telapse = time_bins[idx_valid_bin][-1, 1] - time_bins[idx_valid_bin][0, 0]
 
             observed_counts = np.sum(
                 self._observed_counts[idx_valid_bin, det_idx, :], axis=0
             )
 
-            observed_rate = observed_counts / telapse
+            observed_rate = observed_counts[echans] / telapse
 
             model_counts = np.sum(self._model_counts[idx_valid_bin, det_idx, :], axis=0)
 
-            model_rate = model_counts / telapse
+            model_rate = model_counts[echans] / telapse
 
             stat_err = (
                 np.sqrt(
                     np.sum(np.square(self._stat_err[idx_valid_bin, det_idx, :]), axis=0)
-                )
+                )[echans]
                 / telapse
             )
 
             # Calculate the dead time of the detector:
-            # Each event in the echans 0-6 gives a dead time of 2.6 μs
-            # Each event in the over flow channel 7 gives a dead time of 10 μs
+            # Each event in the regular echans gives a dead time of 2.6 μs
+            # Each event in the last (over flow) channel gives a dead time of 10 μs
             dead_time = (
-                np.sum(observed_counts[0:7]) * 2.6 * 1e-6 + observed_counts[7] * 1e-5
+                np.sum(observed_counts[:-1]) * 2.6 * 1e-6 + observed_counts[-1] * 1e-5
             )
 
             # Write observed spectrum to PHA file
@@ -1119,10 +1408,10 @@ class PHAWriter(object):
                 telescope_name="Fermi",
                 tstart=tstart,
                 telapse=telapse,
-                channel=self._echans,
+                channel=echans,
                 rate=observed_rate,
                 quality=np.zeros_like(observed_rate, dtype=int),
-                grouping=np.ones_like(self._echans),
+                grouping=np.ones_like(echans),
                 exposure=telapse - dead_time,
                 backscale=1.0,
                 respfile=None,
@@ -1139,10 +1428,10 @@ class PHAWriter(object):
                 telescope_name="Fermi",
                 tstart=tstart,
                 telapse=telapse,
-                channel=self._echans,
+                channel=echans,
                 rate=model_rate,
                 quality=np.zeros_like(model_rate, dtype=int),
-                grouping=np.ones_like(self._echans),
+                grouping=np.ones_like(echans),
                 exposure=telapse - dead_time,
                 backscale=1.0,
                 respfile=None,
@@ -1153,16 +1442,6 @@ class PHAWriter(object):
                 is_poisson=False,
             )
 
-            if file_name is None:
-
-                if self._trigger is None:
-
-                    file_name = "_".join(self._dates)
-
-                else:
-
-                    file_name = self._trigger
-
             obs_file_path = os.path.join(output_dir, "{}_{}.pha".format(file_name, det))
             bkg_file_path = os.path.join(
                 output_dir, "{}_{}_bak.pha".format(file_name, det)
@@ -1170,3 +1449,7 @@ class PHAWriter(object):
 
             observed_spectrum.writeto(obs_file_path, overwrite=overwrite)
             background_spectrum.writeto(bkg_file_path, overwrite=overwrite)
+
+        # one file per detector, written in parallel
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(write, self._detectors))
@@ -0,0 +1,253 @@
+import os
+import re
+import sqlite3
+
+from gbmbkgpy.io.package_data import get_path_of_external_data_dir
+from gbmbkgpy.utils.mpi import check_mpi
+
+using_mpi, rank, size, comm = check_mpi()
+
+GBM_DATA_TYPES = ("ctime", "cspec", "poshist")
+
+_file_pattern = re.compile(
+    r"^glg_(ctime|cspec|poshist)_(\w+?)_(\d{6})_v(\d+)\.(pha|fit)$"
+)
+
+
+class GBMDataIndex(object):
+    def __init__(self, data_dir=None, db_file=None):
+        """
+        Index of the daily GBM files in $GBMDATA, so the existence of a file
+        is checked without touching the file system. The index is built
+        once by scanning the data dir, with MPI only on rank 0 and then
+        broadcasted, so all ranks see the same files.
+        Files that are added by other processes are only seen after
+        refresh(). Files that were removed are dropped from the index when
+        they are looked up.
+        :param data_dir: data dir, default $GBMDATA
+        :param db_file: optional sqlite file to keep the index between
+        processes, it is used instead of the scan if it exists
+        """
+        if data_dir is None:
+            data_dir = get_path_of_external_data_dir()
+
+        self._data_dir = data_dir
+        self._db_file = db_file
+
+        self._files = None
+
+    def _scan(self):
+        """
+        (date, data_type, detector) -> {version: path} of all files in the data dir
+        """
+        files = {}
+
+        for data_type in GBM_DATA_TYPES:
+            type_dir = os.path.join(self._data_dir, data_type)
+
+            if not os.path.isdir(type_dir):
+                continue
+
+            with os.scandir(type_dir) as date_dirs:
+                for date_dir in date_dirs:
+                    if not date_dir.is_dir():
+                        continue
+
+                    with os.scandir(date_dir.path) as entries:
+                        for entry in entries:
+                            match = _file_pattern.match(entry.name)
+
+                            if match is None:
+                                continue
+
+                            key = (match.group(3), match.group(1), match.group(2))
+
+                            files.setdefault(key, {})[int(match.group(4))] = entry.path
+
+        return files
+
+    def _read_db(self):
+        files = {}
+
+        with sqlite3.connect(self._db_file) as con:
+            for date, data_type, det, version, path in con.execute(
+                "SELECT date, data_type, detector, version, path FROM files"
+            ):
+                files.setdefault((date, data_type, det), {})[version] = path
+
+        return files
+
+    def _write_db(self):
+        with sqlite3.connect(self._db_file) as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS files (date TEXT, data_type TEXT, "
+                "detector TEXT, version INTEGER, path TEXT, "
+                "PRIMARY KEY (date, data_type, detector, version))"
+            )
+            con.execute("DELETE FROM files")
+            con.executemany(
+                "INSERT INTO files VALUES (?, ?, ?, ?, ?)",
+                [
+                    (*key, version, path)
+                    for key, versions in self._files.items()
+                    for version, path in versions.items()
+                ],
+            )
+
+    def _load(self, rescan=False):
+        files = None
+        scanned = False
+
+        if rank == 0:
+            if (
+                not rescan
+                and self._db_file is not None
+                and os.path.exists(self._db_file)
+            ):
+                files = self._read_db()
+            else:
+                files = self._scan()
+                scanned = True
+
+        if using_mpi:
+            files = comm.bcast(files, root=0)
+
+        self._files = files
+
+        # the db only changes with a new scan
+        if rank == 0 and scanned and self._db_file is not None:
+            self._write_db()
+
+    def refresh(self):
+        """
+        Scan the data dir again
+        """
+        self._load(rescan=True)
+
+    def lookup(self, date, data_type, detector="all", version=None, check=False):
+        """
+        Path of a file in the index. With check it has to be called on all
+        ranks.
+        :param date: string like '180407'
+        :param data_type: string like 'ctime', 'cspec', 'poshist'
+        :param detector: string like 'n1', 'n2' or 'all' for poshist
+        :param version: version of the file, default the latest
+        :param check: check on rank 0 that the file still exists, a removed
+        file is dropped from the index
+        :returns: path or None if the file is not in the index
+        """
+        if self._files is None:
+            self._load()
+
+        versions = self._files.get((date, data_type, detector))
+
+        if versions is None:
+            return None
+
+        if version is None:
+            version = max(versions)
+
+        path = versions.get(version)
+
+        if path is None or not check:
+            return path
+
+        exists = None
+        if rank == 0:
+            exists = os.path.exists(path)
+
+        if using_mpi:
+            exists = comm.bcast(exists, root=0)
+
+        if not exists:
+            self.remove(path)
+            return None
+
+        return path
+
+    def add(self, path):
+        """
+        Add a new file, e.g. after a download. Has to be called on all ranks.
+        """
+        if self._files is None:
+            self._load()
+
+        path = str(path)
+
+        match = _file_pattern.match(os.path.basename(path))
+
+        assert match is not None, f"{path} is not a daily GBM file"
+
+        key = (match.group(3), match.group(1), match.group(2))
+
+        self._files.setdefault(key, {})[int(match.group(4))] = path
+
+        if rank == 0 and self._db_file is not None:
+            with sqlite3.connect(self._db_file) as con:
+                con.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                    (*key, int(match.group(4)), path),
+                )
+
+    def remove(self, path):
+        """
+        Remove a file from the index, e.g. if it was deleted or is corrupt.
+        Has to be called on all ranks.
+        """
+        if self._files is None:
+            self._load()
+
+        path = str(path)
+
+        match = _file_pattern.match(os.path.basename(path))
+
+        assert match is not None, f"{path} is not a daily GBM file"
+
+        key = (match.group(3), match.group(1), match.group(2))
+        version = int(match.group(4))
+
+        versions = self._files.get(key, {})
+        versions.pop(version, None)
+
+        if len(versions) == 0:
+            self._files.pop(key, None)
+
+        if rank == 0 and self._db_file is not None:
+            with sqlite3.connect(self._db_file) as con:
+                con.execute(
+                    "DELETE FROM files WHERE date=? AND data_type=? AND detector=? "
+                    "AND version=?",
+                    (*key, version),
+                )
+
+    def __len__(self):
+        if self._files is None:
+            self._load()
+
+        return sum(len(versions) for versions in self._files.values())
+
+    @property
+    def data_dir(self):
+        return self._data_dir
+
+    @property
+    def db_file(self):
+        return self._db_file
+
+
+_index = None
+
+
+def get_file_index():
+    """
+    Index of $GBMDATA of this process. Set $GBMDATA_INDEX to the path of
+    a sqlite file to keep the index between runs.
+    """
+    global _index
+
+    data_dir = get_path_of_external_data_dir()
+
+    if _index is None or str(_index.data_dir) != str(data_dir):
+        _index = GBMDataIndex(data_dir, db_file=os.environ.get("GBMDATA_INDEX"))
+
+    return _index
@@ -3,6 +3,7 @@ from matplotlib.ticker import MaxNLocator
 import numpy as np
 from gbmbkgpy.utils.binner import Rebinner
 from gbmbkgpy.utils.progress_bar import progress_bar
+from gbmbkgpy.utils.mpi import gatherv_array
 
 from gbmbkgpy.io.plotting.step_plots import step_plot
 from gbmbkgpy.exceptions.custom_exceptions import custom_warnings
@@ -315,6 +316,8 @@ class ResidualPlot(object):
         self,
         rebinned_ppc_rates=None,
         rebinned_time_bin_mean=None,
+        ppc_percentile_rates=None,
+        ppc_percentile_levels=None,
         result_dir=None,
         model=None,
         plotter=None,
@@ -330,6 +333,8 @@ class ResidualPlot(object):
     ):
         """
         Add ppc plot
+        :param ppc_percentile_rates: precomputed percentiles of the ppc rates
+        :param ppc_percentile_levels: percentiles of ppc_percentile_rates
         :param result_dir: path to result directory
         :param model: Model object
         :param time_bin: Time bins where to compute ppc steps
@@ -344,7 +349,26 @@ class ResidualPlot(object):
 
         q_levels.sort(reverse=True)
 
-        if rebinned_ppc_rates is None or rebinned_time_bin_mean is None:
+        if ppc_percentile_rates is not None:
+            if rank == 0:
+                levels = np.array(ppc_percentile_levels)
+                for i, level in enumerate(q_levels):
+                    low_idx = np.isclose(levels, 50 - 50 * level)
+                    high_idx = np.isclose(levels, 50 + 50 * level)
+
+                    assert np.any(low_idx) and np.any(
+                        high_idx
+                    ), f"The ppc percentiles for the q_level {level} are missing"
+
+                    self._data_axis.fill_between(
+                        rebinned_time_bin_mean,
+                        ppc_percentile_rates[low_idx][0],
+                        ppc_percentile_rates[high_idx][0],
+                        color=colors[i],
+                        alpha=alpha,
+                    )
+
+        elif rebinned_ppc_rates is None or rebinned_time_bin_mean is None:
             # Get Analyze object from results file of Multinest Fit
             import pymultinest
 
@@ -414,10 +438,7 @@ class ResidualPlot(object):
 
                 rates = np.array(rates)
                 print(rates.shape)
-                rates_g = comm.gather(rates, root=0)
-                if rank == 0:
-                    rates_g = np.concatenate(rates_g)
-                rates = comm.bcast(rates_g, root=0)
+                rates = gatherv_array(rates, root=0)
                 if rank == 0:
                     for i, level in enumerate(q_levels):
                         low = np.percentile(rates, 50 - 50 * level, axis=0)[0]
@@ -0,0 +1,60 @@
+import numpy as np
+
+
+def min_max_indices(x, y, n_columns):
+    """
+    Indices of the points with the minimal and maximal y in each of
+    n_columns equally wide columns in x. Plotting only these points looks
+    the same as plotting all points at a resolution of n_columns pixels,
+    peaks and dips are kept.
+    :param x: sorted x values
+    :param y: y values, non finite values are ignored
+    :param n_columns: number of columns, e.g. the width of the axis in pixels
+    :returns: sorted indices
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+
+    if len(x) <= 2 * n_columns:
+        return np.arange(len(x))
+
+    valid = np.flatnonzero(np.isfinite(y))
+
+    if len(valid) == 0:
+        return valid
+
+    x_valid = x[valid]
+
+    width = (x_valid[-1] - x_valid[0]) / n_columns
+
+    if width <= 0:
+        return valid
+
+    column = np.minimum(((x_valid - x_valid[0]) / width).astype(int), n_columns - 1)
+
+    # sorted by column and y, the first and last entry of each column are
+    # the min and max
+    order = np.lexsort((y[valid], column))
+
+    sorted_column = column[order]
+    first = np.flatnonzero(np.r_[True, sorted_column[1:] != sorted_column[:-1]])
+    last = np.r_[first[1:], len(order)] - 1
+
+    return valid[np.unique(np.concatenate((order[first], order[last])))]
+
+
+def decimate(x, ys, n_columns):
+    """
+    Decimate several curves on the same x values to the points that are
+    the min or max of any of them in a column
+    :param x: sorted x values
+    :param ys: list of y arrays
+    :param n_columns: number of columns
+    :returns: indices of the kept points
+    """
+    if len(x) <= 2 * n_columns:
+        return np.arange(len(x))
+
+    return np.unique(
+        np.concatenate([min_max_indices(x, y, n_columns) for y in ys])
+    )
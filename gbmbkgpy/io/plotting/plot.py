@@ -7,6 +7,7 @@ from astropy.time import Time
 
 from gbmbkgpy.utils.statistics.stats_tools import Significance
 from gbmbkgpy.data.gbm_data import GBMData
+from gbmbkgpy.modeling.ppc import PPCEngine
 
 def plot_lightcurve(model, ax=None, rates=True, eff_echan=None, bin_width=None,
                     show_data=True, data_color="black", data_alpha=0.9,
@@ -109,30 +110,17 @@ def plot_lightcurve(model, ax=None, rates=True, eff_echan=None, bin_width=None,
         num_labels += 1
 
     if plot_ppc:
-        # save current parameter values to reset it after the ppc generation
-        current_par_vals = []
-        for p in model.parameter.values():
-            current_par_vals.append(p.value)
+        engine = PPCEngine(model, time_bins=time_bins)
 
         # samples from fit run
-        samples = model.raw_samples
-        if len(samples) > 300:
-            mask = np.zeros(len(samples), dtype=bool)
-            mask[:300] = True
-            np.random.shuffle(mask)
-            samples = samples[mask]
+        samples = engine.subsample(model.raw_samples, 300)
 
-        # get the model counts for every sample
-        model_counts = np.zeros((len(samples), len(times)))
-        for i, s in enumerate(samples):
-            model.set_parameters(s)
-            model_counts[i] = model.get_model_counts(time_bins=time_bins)[:, eff_echan]
-
-        # poisson noise
-        model_counts = np.random.poisson(model_counts)
-
-        min_p = np.percentile(model_counts, 50-ppc_percentile/2, axis=0)
-        max_p = np.percentile(model_counts, 50+ppc_percentile/2, axis=0)
+        # percentiles of the poisson realizations for every time bin
+        min_p, max_p = engine.ppc_percentiles(
+            [50-ppc_percentile/2, 50+ppc_percentile/2],
+            samples=samples,
+            echans=[eff_echan]
+        )[:, :, 0]
 
         for n, (start, stop) in enumerate(zip(idxs[:-1], idxs[1:])):
             if n == 0:
@@ -148,8 +136,6 @@ def plot_lightcurve(model, ax=None, rates=True, eff_echan=None, bin_width=None,
                             color=ppc_color,
                             alpha=ppc_alpha, label=label, linewidth=0, zorder=-5)
 
-        model.set_parameters(current_par_vals)
-
     for comp, color in zip(model_component_list, model_component_colors):
 
         for n, (start, stop) in enumerate(zip(idxs[:-1], idxs[1:])):
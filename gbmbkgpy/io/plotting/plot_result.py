@@ -1,3 +1,6 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import h5py
 import yaml
@@ -9,6 +12,7 @@ import astropy.time as astro_time
 from gbmbkgpy.utils.progress_bar import progress_bar
 from gbmbkgpy.utils.statistics.stats_tools import Significance
 from gbmbkgpy.io.plotting.data_residual_plot import ResidualPlot
+from gbmbkgpy.io.plotting.decimate import decimate
 from gbmbkgpy.utils.binner import Rebinner
 
 NO_REBIN = 1e-9
@@ -66,6 +70,10 @@ class ResultPlotGenerator(object):
         self.axis_title = config["plot"].get("axis_title", None)
         self.legend_outside = config["plot"].get("legend_outside", True)
         self.file_format = config["plot"].get("file_format", "pdf")
+        # plot at most two points per pixel column (min and max)
+        self.decimate = config["plot"].get("decimate", True)
+        # number of processes that create the plots
+        self.n_processes = config["plot"].get("n_processes", 1)
 
         # Import component settings
         self.show_data = config["component"].get("show_data", True)
@@ -124,8 +132,13 @@ class ResultPlotGenerator(object):
         self._hide_sources = []
 
     @classmethod
-    def from_result_file(cls, config_file, result_data_file):
-
+    def from_result_file(cls, config_file, result_data_file, lazy=True):
+        """
+        Plots of a result file
+        :param lazy: only read the time bins and attributes at the start, the
+        counts are read from the file when the plots are created and the
+        ppc datasets only if they are shown
+        """
         result_dict = {}
 
         print("Load result file for plotting from: {}".format(result_data_file))
@@ -147,27 +160,118 @@ class ResultPlotGenerator(object):
             ).T
             result_dict["saa_mask"] = f["saa_mask"][()]
 
-            result_dict["model_counts"] = f["model_counts"][()]
-            result_dict["observed_counts"] = f["observed_counts"][()]
+            if "ppc_time_bins" in f.keys():
+                result_dict["ppc_time_bins"] = f["ppc_time_bins"][()]
 
-            result_dict["sources"] = {}
+            if "ppc_percentiles" in f.keys():
+                result_dict["ppc_percentile_levels"] = f["ppc_percentiles"].attrs[
+                    "levels"
+                ]
 
-            for source_name in f["sources"].keys():
-                result_dict["sources"][source_name] = f["sources"][source_name][()]
+            if lazy:
+                result_dict["result_file"] = result_data_file
+                result_dict["sources"] = {name: None for name in f["sources"].keys()}
 
-            if "ppc_counts" in f.keys():
+                for name in [
+                    "model_counts",
+                    "observed_counts",
+                    "ppc_counts",
+                    "ppc_percentiles",
+                ]:
+                    result_dict[name] = None
 
-                result_dict["ppc_counts"] = f["ppc_counts"][()]
-                result_dict["ppc_time_bins"] = f["ppc_time_bins"][()]
+                result_dict["datasets"] = list(f.keys())
 
             else:
+                result_dict["model_counts"] = f["model_counts"][()]
+                result_dict["observed_counts"] = f["observed_counts"][()]
+
+                result_dict["sources"] = {}
+
+                for source_name in f["sources"].keys():
+                    result_dict["sources"][source_name] = f["sources"][source_name][()]
 
-                result_dict["ppc_counts"] = None
+                if "ppc_counts" in f.keys():
+                    result_dict["ppc_counts"] = f["ppc_counts"][()]
+                else:
+                    result_dict["ppc_counts"] = None
+
+                if "ppc_percentiles" in f.keys():
+                    result_dict["ppc_percentiles"] = f["ppc_percentiles"][()]
+                else:
+                    result_dict["ppc_percentiles"] = None
 
             result_dict["time_stamp"] = datetime.now().strftime("%y%m%d_%H%M")
 
         return cls(config_file=config_file, result_dict=result_dict)
 
+    def _has_dataset(self, name):
+        if "result_file" in self._result_dict:
+            return name in self._result_dict["datasets"]
+
+        return self._result_dict.get(name, None) is not None
+
+    def _panel_data(self, det_idx, echan_idx):
+        """
+        Counts of one detector and echan. For a lazy result the needed
+        datasets are read from the result file at the first call and kept
+        in memory, as reading single columns decompresses every chunk of
+        a dataset for each panel.
+        :returns: dict with observed_counts, model_counts, sources and
+        ppc_percentiles or ppc_counts if they are shown
+        """
+        read_ppc = None
+
+        if self.show_ppc:
+            if self._has_dataset("ppc_percentiles"):
+                read_ppc = "ppc_percentiles"
+            elif self._has_dataset("ppc_counts"):
+                read_ppc = "ppc_counts"
+
+        if "result_file" in self._result_dict:
+            self._read_result_datasets(read_ppc)
+
+        panel = {
+            "observed_counts": self._result_dict["observed_counts"][
+                :, det_idx, echan_idx
+            ],
+            "model_counts": self._result_dict["model_counts"][:, det_idx, echan_idx],
+            "sources": {
+                key: value[:, det_idx, echan_idx]
+                for key, value in self._result_dict["sources"].items()
+            },
+        }
+
+        if read_ppc is not None:
+            panel[read_ppc] = self._result_dict[read_ppc][:, :, det_idx, echan_idx]
+
+        return panel
+
+    def _read_result_datasets(self, read_ppc):
+        """
+        Read the datasets of a lazy result that are not read yet
+        :param read_ppc: ppc dataset to read or None
+        """
+        names = ["observed_counts", "model_counts"]
+
+        if read_ppc is not None:
+            names.append(read_ppc)
+
+        names = [name for name in names if self._result_dict[name] is None]
+        sources = [
+            key for key, value in self._result_dict["sources"].items() if value is None
+        ]
+
+        if len(names) == 0 and len(sources) == 0:
+            return
+
+        with h5py.File(self._result_dict["result_file"], "r") as f:
+            for name in names:
+                self._result_dict[name] = f[name][()]
+
+            for key in sources:
+                self._result_dict["sources"][key] = f["sources"][key][()]
+
     @classmethod
     def from_result_instance(cls, config_file, data, model, saa_object):
         result_dict = {}
@@ -228,28 +332,36 @@ class ResultPlotGenerator(object):
 
         # TODO: Add PPC calc
         result_dict["ppc_counts"] = None
+        result_dict["ppc_percentiles"] = None
 
         return cls(config_file=config_file, result_dict=result_dict)
 
-    def create_plots(self, output_dir, plot_name="plot_date_", time_stamp=None):
+    def create_plots(
+        self, output_dir, plot_name="plot_date_", time_stamp=None, n_processes=None
+    ):
+        """
+        Create one plot per date, detector and echan
+        :param n_processes: number of processes that create the plots in
+        parallel, default the n_processes of the plot config
+        """
+        if n_processes is None:
+            n_processes = self.n_processes
 
-        for day_idx, day in enumerate(self._result_dict["dates"]):
+        if not self._has_dataset("ppc_counts") and not self._has_dataset(
+            "ppc_percentiles"
+        ):
+            self.show_ppc = False
 
-            for det_idx, det in enumerate(self._result_dict["detectors"]):
+        if time_stamp is None:
+            time_stamp = f'__{datetime.now().strftime("%y%m%d_%H%M")}'
 
-                for echan_idx, echan in enumerate(self._result_dict["echans"]):
+        panels = []
 
-                    if self._result_dict["ppc_counts"] is None:
-                        self.show_ppc = False
+        for day_idx, day in enumerate(self._result_dict["dates"]):
 
-                    total_steps = (
-                        12
-                        if self.show_ppc is False
-                        else 12 + len(self._result_dict["ppc_counts"])
-                    )
+            for det_idx, det in enumerate(self._result_dict["detectors"]):
 
-                    if time_stamp is None:
-                        time_stamp = f'__{datetime.now().strftime("%y%m%d_%H%M")}'
+                for echan_idx, echan in enumerate(self._result_dict["echans"]):
 
                     plot_path = (
                         f"{output_dir}/"
@@ -261,9 +373,8 @@ class ResultPlotGenerator(object):
 
                     self._plot_path_list.append(plot_path)
 
-                    with progress_bar(total_steps, title="Create Result plot") as p:
-                        self._create_model_plots(
-                            p_bar=p,
+                    panels.append(
+                        dict(
                             det=det,
                             det_idx=det_idx,
                             echan=echan,
@@ -271,6 +382,43 @@ class ResultPlotGenerator(object):
                             day_idx=day_idx,
                             savepath=plot_path,
                         )
+                    )
+
+        if n_processes > 1 and "fork" in multiprocessing.get_all_start_methods():
+            self._create_plots_parallel(panels, n_processes)
+            return
+
+        for panel in panels:
+            with progress_bar(12, title="Create Result plot") as p:
+                self._create_model_plots(p_bar=p, **panel)
+
+    def _create_plots_parallel(self, panels, n_processes):
+        """
+        Create the plots in a pool of forked processes, which share this
+        object with the parent process without pickling it. The first plot
+        is created before the fork, so all plots use its axis limits.
+        """
+        global _plot_generator
+
+        with progress_bar(12, title="Create Result plot") as p:
+            self._create_model_plots(p_bar=p, **panels[0])
+
+        panels = panels[1:]
+
+        if len(panels) == 0:
+            return
+
+        _plot_generator = self
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=n_processes, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                with progress_bar(len(panels), title="Create Result plots") as p:
+                    for _ in executor.map(_create_panel, panels):
+                        p.increase()
+        finally:
+            _plot_generator = None
 
     def _create_model_plots(
         self,
@@ -335,6 +483,8 @@ class ResultPlotGenerator(object):
 
         p_bar.increase()
 
+        panel = self._panel_data(det_idx, echan_idx)
+
         residual_plot = ResidualPlot(show_residuals=self.show_residuals, **kwargs)
 
         if self.bin_width > NO_REBIN:
@@ -346,12 +496,10 @@ class ResultPlotGenerator(object):
             )
 
             self._rebinned_observed_counts = this_rebinner.rebin(
-                self._result_dict["observed_counts"][:, det_idx, echan_idx]
+                panel["observed_counts"]
             )[0]
 
-            self._rebinned_model_counts = this_rebinner.rebin(
-                self._result_dict["model_counts"][:, det_idx, echan_idx]
-            )[0]
+            self._rebinned_model_counts = this_rebinner.rebin(panel["model_counts"])[0]
 
             self._rebinned_time_bins = this_rebinner.time_rebinned
 
@@ -359,13 +507,9 @@ class ResultPlotGenerator(object):
 
         else:
 
-            self._rebinned_observed_counts = self._result_dict["observed_counts"][
-                :, det_idx, echan_idx
-            ]
+            self._rebinned_observed_counts = panel["observed_counts"]
 
-            self._rebinned_model_counts = self._result_dict["model_counts"][
-                :, det_idx, echan_idx
-            ]
+            self._rebinned_model_counts = panel["model_counts"]
 
             self._rebinned_time_bins = (
                 self._result_dict["total_time_bins"] - self._time_ref
@@ -388,12 +532,25 @@ class ResultPlotGenerator(object):
         residual_errors = None
         self._residuals = significance_calc.known_background()
 
+        observed_rates = self._rebinned_observed_counts / self._rebinned_time_bin_widths
+
+        # number of pixel columns of the plot
+        if self.decimate:
+            n_columns = int(residual_plot.figure.get_size_inches()[0] * self.dpi)
+            data_idx = decimate(
+                self._rebinned_time_bin_mean,
+                [observed_rates, self._residuals],
+                n_columns,
+            )
+        else:
+            data_idx = slice(None)
+
         p_bar.increase()
 
         residual_plot.add_data(
-            self._rebinned_time_bin_mean,
-            self._rebinned_observed_counts / self._rebinned_time_bin_widths,
-            self._residuals,
+            self._rebinned_time_bin_mean[data_idx],
+            observed_rates[data_idx],
+            self._residuals[data_idx],
             residual_yerr=residual_errors,
             yerr=None,
             xerr=None,
@@ -410,16 +567,6 @@ class ResultPlotGenerator(object):
         )
         p_bar.increase()
 
-        if self.show_model:
-            residual_plot.add_model(
-                self._rebinned_time_bin_mean,
-                self._rebinned_model_counts / self._rebinned_time_bin_widths,
-                label="Best Fit" if self.model_styles.get("show_label", True) else None,
-                color=self.model_styles.get("color", "red"),
-                alpha=self.model_styles.get("alpha", 0.9),
-                linewidth=self.model_styles.get("linewidth", 0.8),
-            )
-
         p_bar.increase()
 
         src_list = []
@@ -495,13 +642,9 @@ class ResultPlotGenerator(object):
             label = label.replace("_", "-")
 
             if rebin:
-                rebinned_source_counts = this_rebinner.rebin(
-                    self._result_dict["sources"][key][:, det_idx, echan_idx]
-                )[0]
+                rebinned_source_counts = this_rebinner.rebin(panel["sources"][key])[0]
             else:
-                rebinned_source_counts = self._result_dict["sources"][key][
-                    :, det_idx, echan_idx
-                ]
+                rebinned_source_counts = panel["sources"][key]
 
             if np.sum(rebinned_source_counts) > 0.0:
                 if key not in self._hide_sources:
@@ -542,14 +685,40 @@ class ResultPlotGenerator(object):
                     else None
                 )
 
+        model_rates = self._rebinned_model_counts / self._rebinned_time_bin_widths
+
+        # the model and the sources share the decimated time bins
+        if self.decimate:
+            line_idx = decimate(
+                self._rebinned_time_bin_mean,
+                [model_rates] + [source["data"] for source in self._source_list],
+                n_columns,
+            )
+        else:
+            line_idx = slice(None)
+
+        if self.show_model:
+            residual_plot.add_model(
+                self._rebinned_time_bin_mean[line_idx],
+                model_rates[line_idx],
+                label="Best Fit" if self.model_styles.get("show_label", True) else None,
+                color=self.model_styles.get("color", "red"),
+                alpha=self.model_styles.get("alpha", 0.9),
+                linewidth=self.model_styles.get("linewidth", 0.8),
+            )
+
         if len(self._source_list) > 0:
             residual_plot.add_list_of_sources(
-                self._rebinned_time_bin_mean, self._source_list
+                self._rebinned_time_bin_mean[line_idx],
+                [
+                    dict(source, data=source["data"][line_idx])
+                    for source in self._source_list
+                ],
             )
 
         p_bar.increase()
 
-        if self.show_ppc and self._result_dict["ppc_counts"] is not None:
+        if self.show_ppc and ("ppc_counts" in panel or "ppc_percentiles" in panel):
             # rebinned_ppc_rates = []
 
             # ppc_counts_det_echan = self._result_dict["ppc_counts"][
@@ -580,18 +749,29 @@ class ResultPlotGenerator(object):
                 np.mean(self._result_dict["ppc_time_bins"], axis=1) - self._time_ref
             )
 
-            ppc_rates = (
-                self._result_dict["ppc_counts"][:, :, det_idx, echan_idx]
-                / ppc_time_bin_widths
-            )
+            if "ppc_percentiles" in panel:
+                # use the percentile bands saved in the result file
+                ppc_percentile_rates = panel["ppc_percentiles"] / ppc_time_bin_widths
+
+                residual_plot.add_ppc(
+                    rebinned_time_bin_mean=ppc_time_bin_means,
+                    ppc_percentile_rates=ppc_percentile_rates,
+                    ppc_percentile_levels=self._result_dict["ppc_percentile_levels"],
+                    q_levels=[0.68, 0.95, 0.99],
+                    colors=self.ppc_styles["color"],
+                    alpha=self.ppc_styles["alpha"],
+                )
 
-            residual_plot.add_ppc(
-                rebinned_ppc_rates=ppc_rates,
-                rebinned_time_bin_mean=ppc_time_bin_means,
-                q_levels=[0.68, 0.95, 0.99],
-                colors=self.ppc_styles["color"],
-                alpha=self.ppc_styles["alpha"],
-            )
+            else:
+                ppc_rates = panel["ppc_counts"] / ppc_time_bin_widths
+
+                residual_plot.add_ppc(
+                    rebinned_ppc_rates=ppc_rates,
+                    rebinned_time_bin_mean=ppc_time_bin_means,
+                    q_levels=[0.68, 0.95, 0.99],
+                    colors=self.ppc_styles["color"],
+                    alpha=self.ppc_styles["alpha"],
+                )
 
         # Add vertical lines for grb triggers
         if self.show_grb_trigger:
@@ -664,6 +844,8 @@ class ResultPlotGenerator(object):
                 savepath, dpi=self.dpi, transparent=True, bbox_inches="tight"
             )
 
+        plt.close(final_plot)
+
         p_bar.increase()
 
     def add_grb_trigger(
@@ -827,6 +1009,17 @@ class ResultPlotGenerator(object):
             return f"Echan {echan}"
 
 
+# the plot generator of the parent process, shared with the forked workers
+_plot_generator = None
+
+
+def _create_panel(panel):
+    with progress_bar(12, title="Create Result plot", hidden=True) as p:
+        _plot_generator._create_model_plots(p_bar=p, **panel)
+
+    return panel["savepath"]
+
+
 def set_saa_zero(vector, saa_mask):
     vector[np.where(~saa_mask)] = 0.0
     return vector
@@ -0,0 +1,250 @@
+import h5py
+import numpy as np
+
+try:
+
+    import hdf5plugin
+
+except ImportError:
+
+    has_hdf5plugin = False
+
+else:
+
+    has_hdf5plugin = True
+
+# Version of the layout of the result files:
+# 1: lzf compression with the default chunks of h5py
+# 2: time-major chunks, selectable compression and a time index
+RESULT_SCHEMA_VERSION = 2
+
+# target size of one chunk in bytes
+RESULT_CHUNK_BYTES = 1 << 18
+
+# every TIME_INDEX_STEP-th start time of the time bins is saved in the time index
+TIME_INDEX_STEP = 1024
+
+# datasets with the time bins on the second axis and their own time grid
+_ppc_datasets = ["ppc_percentiles", "ppc_counts"]
+
+
+def compression_options(compression="lzf"):
+    """
+    Keyword arguments of h5py create_dataset for a compression
+    :param compression: "lzf", "gzip", "blosc", "zstd" or None. blosc and
+    zstd need the hdf5plugin package for writing and reading.
+    """
+    if compression is None:
+        return {}
+
+    if compression in ["lzf", "gzip"]:
+        return {"compression": compression}
+
+    assert compression in ["blosc", "zstd"], f"Unknown compression {compression}"
+
+    if not has_hdf5plugin:
+        raise ImportError(f"The compression {compression} needs the hdf5plugin package")
+
+    if compression == "blosc":
+        return dict(
+            hdf5plugin.Blosc(cname="zstd", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE)
+        )
+
+    return dict(hdf5plugin.Zstd(clevel=5))
+
+
+def time_major_chunks(shape, itemsize, time_axis=0, chunk_bytes=RESULT_CHUNK_BYTES):
+    """
+    Chunk shape that holds a block of consecutive time bins with the full
+    extent of all other axes, so reading a short time window of all
+    detectors touches only a few chunks
+    """
+    if len(shape) == 0 or 0 in shape:
+        return None
+
+    other = int(np.prod(shape)) // shape[time_axis] * itemsize
+
+    chunks = list(shape)
+    chunks[time_axis] = int(min(shape[time_axis], max(1, chunk_bytes // other)))
+
+    return tuple(chunks)
+
+
+def write_result_dataset(group, name, data, compression="lzf", time_axis=0):
+    """
+    Create a dataset of a result file with time-major chunks
+    :param group: h5py File or Group
+    :param data: array with the time bins on time_axis
+    """
+    data = np.asarray(data)
+
+    return group.create_dataset(
+        name,
+        data=data,
+        chunks=time_major_chunks(data.shape, data.dtype.itemsize, time_axis),
+        **compression_options(compression),
+    )
+
+
+def write_time_bins(f, time_bins, compression="lzf"):
+    """
+    Save the time bins, the time index and the schema version in a result file
+    """
+    f.attrs["schema_version"] = RESULT_SCHEMA_VERSION
+
+    write_result_dataset(f, "time_bins_start", time_bins[:, 0], compression)
+    write_result_dataset(f, "time_bins_stop", time_bins[:, 1], compression)
+
+    dset = f.create_dataset("time_index", data=time_bins[::TIME_INDEX_STEP, 0])
+    dset.attrs["step"] = TIME_INDEX_STEP
+
+
+class ResultFile(object):
+    def __init__(self, file_path):
+        """
+        Reader for the result files of DataExporter and StanDataExporter
+        that only reads the requested time window and detectors.
+        Files of all schema versions can be read, the time index is only
+        used if the file has one.
+        :param file_path: path of the result file
+        """
+        self._file = h5py.File(file_path, "r")
+
+        self._schema_version = int(self._file.attrs.get("schema_version", 1))
+
+        self._detectors = list(self._file.attrs["detectors"])
+        self._echans = list(self._file.attrs["echans"])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._file.close()
+
+    def _time_slice(self, start, stop):
+        """
+        Slice of the time bins that overlap with [start, stop]
+        """
+        n_bins = self._file["time_bins_start"].shape[0]
+
+        if "time_index" in self._file:
+            index = self._file["time_index"]
+            step = int(index.attrs["step"])
+            index = index[()]
+
+            # the bins of the window are between these two index entries
+            lo = max(np.searchsorted(index, start, side="right") - 1, 0) * step
+            hi = min(np.searchsorted(index, stop, side="right") * step, n_bins)
+        else:
+            lo, hi = 0, n_bins
+
+        start_times = self._file["time_bins_start"][lo:hi]
+        stop_times = self._file["time_bins_stop"][lo:hi]
+
+        i0 = lo + np.searchsorted(stop_times, start, side="right")
+        i1 = lo + np.searchsorted(start_times, stop, side="left")
+
+        return slice(i0, max(i0, i1))
+
+    def _det_index(self, detectors):
+        if detectors is None:
+            return slice(None), self._detectors
+
+        for det in detectors:
+            assert det in self._detectors, f"{det} is not in the result file"
+
+        # h5py needs increasing indices
+        idx = sorted(self._detectors.index(det) for det in detectors)
+
+        return idx, [self._detectors[i] for i in idx]
+
+    def read_window(
+        self,
+        start,
+        stop,
+        detectors=None,
+        datasets=("observed_counts", "model_counts", "stat_err"),
+        sources=True,
+    ):
+        """
+        Read the time bins that overlap with [start, stop] of some detectors
+        :param start: start of the window in MET
+        :param stop: stop of the window in MET
+        :param detectors: list of detectors, default all of the file
+        :param datasets: names of the datasets with the counts,
+        ppc_percentiles and ppc_counts are read on the ppc time bins
+        :param sources: read the counts of the sources
+        :returns: dict with the time bins, saa mask, detectors, echans,
+        the datasets and a dict with the sources
+        """
+        time_slice = self._time_slice(start, stop)
+        det_idx, dets = self._det_index(detectors)
+
+        window = dict(
+            time_bins=np.column_stack(
+                [
+                    self._file["time_bins_start"][time_slice],
+                    self._file["time_bins_stop"][time_slice],
+                ]
+            ),
+            saa_mask=self._file["saa_mask"][time_slice],
+            detectors=dets,
+            echans=self._echans,
+        )
+
+        for name in datasets:
+            if name in _ppc_datasets:
+                continue
+            window[name] = self._file[name][time_slice, det_idx]
+
+        if any(name in _ppc_datasets for name in datasets):
+            ppc_time_bins = self._file["ppc_time_bins"][()]
+
+            ppc_slice = slice(
+                np.searchsorted(ppc_time_bins[:, 1], start, side="right"),
+                np.searchsorted(ppc_time_bins[:, 0], stop, side="left"),
+            )
+
+            window["ppc_time_bins"] = ppc_time_bins[ppc_slice]
+
+            for name in datasets:
+                if name in _ppc_datasets:
+                    window[name] = self._file[name][:, ppc_slice, det_idx]
+
+        if sources:
+            window["sources"] = {
+                label: dset[time_slice, det_idx]
+                for label, dset in self._file["sources"].items()
+            }
+
+        return window
+
+    @property
+    def schema_version(self):
+        return self._schema_version
+
+    @property
+    def detectors(self):
+        return self._detectors
+
+    @property
+    def echans(self):
+        return self._echans
+
+    @property
+    def data_type(self):
+        return self._file.attrs["data_type"]
+
+    @property
+    def dates(self):
+        return list(self._file.attrs["dates"])
+
+    @property
+    def time_range(self):
+        return (
+            self._file["time_bins_start"][0],
+            self._file["time_bins_stop"][-1],
+        )
@@ -1,25 +1,84 @@
 import numpy as np
-from scipy.optimize import minimize, basinhopping
+from scipy.optimize import minimize, basinhopping, OptimizeResult
 import pandas as pd
-from datetime import datetime
+from datetime import datetime, timedelta
+import glob
 import json
 import os
+import re
+
 from gbmbkgpy.io.package_data import get_path_of_external_data_dir
+from gbmbkgpy.utils.mpi import check_mpi
+from gbmbkgpy.utils.warm_start import WarmStart
+
+using_mpi, rank, size, comm = check_mpi()
+
+
+def atomic_json_dump(data, file_path):
+    """
+    Write json data to a temporary file and move it to file_path, so that
+    file_path always contains a complete file, even if the process is killed
+    while writing.
+    :param data: json serializable dict
+    :param file_path: path of the file
+    """
+    tmp_path = f"{file_path}.tmp{os.getpid()}"
+
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, sort_keys=True, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+
+    os.replace(tmp_path, file_path)
 
 
 class Minimizer(object):
-    def __init__(self, likelihood):
+    def __init__(self, likelihood, checkpoint_dir=None):
+        """
+        :param likelihood: BackgroundLike object
+        :param checkpoint_dir: directory for the checkpoints of the fit stages,
+        default is $GBMDATA/fits/checkpoints
+        """
 
         self._likelihood = likelihood
         self._result_steps = {}
         self._fitted_params_steps = {}
         self._fitted_params = {}
+        self._stage_timing = {}
 
         self._day = self._likelihood._data.dates[0]
         self._det = self._likelihood._data.detectors[0]
 
+        # detector/echan layout of this fit, checkpoints and warm starts
+        # are only used for the same layout
+        self._layout = {
+            "detectors": [str(d) for d in self._likelihood._data.detectors],
+            "echans": [str(e) for e in self._likelihood._data.echans],
+            "param-names": [p.name for p in self._likelihood._parameters.values()],
+        }
+
+        if checkpoint_dir is None:
+            checkpoint_dir = os.path.join(
+                get_path_of_external_data_dir(), "fits", "checkpoints"
+            )
+
+        self._checkpoint_path = os.path.join(
+            checkpoint_dir,
+            "Checkpoint_{}_{}_{}.json".format(
+                self._day,
+                "-".join(self._layout["detectors"]),
+                "-".join(self._layout["echans"]),
+            ),
+        )
+
     def fit(
-        self, n_interations=3, method_1="L-BFGS-B", method_2="Powell", use_saa=True
+        self,
+        n_interations=3,
+        method_1="L-BFGS-B",
+        method_2="Powell",
+        use_saa=True,
+        resume=False,
+        warm_start=None,
     ):
         """
         Fits the model stepwise by calling the scipy.minimize in the following steps:
@@ -28,67 +87,321 @@ class Minimizer(object):
         3. Fit all parameters with bounds
         4. Fit all parameters without bounds multiple times: Powell
         5. Fit all parameters without bounds and high precision: Powell
+        After every stage a checkpoint is written, a killed fit continues
+        after the last completed stage.
         :param n_interations:
+        :param resume: continue from the checkpoint of a previous run with
+        the same parameters and stages
+        :param warm_start: path to a fit result file to start from, "auto"
+        to use the fit of the previous day with the same detector/echan layout
+        or a WarmStart
         :return:
         """
 
         start = datetime.now()
 
-        # method_1 = 'L-BFGS-B'
-        # #method_1 = 'TNC'
-        # method_2 = 'Powell'
+        stages = self._build_stages(n_interations, method_1, method_2, use_saa)
+
+        completed = 0
+        if resume:
+            completed = self._load_checkpoint(stages)
+
+        if completed == 0 and warm_start is not None:
+            self.warm_start(warm_start)
+
+        for stage_nr, stage in enumerate(stages):
+
+            # the fixed parameters of a stage depend on all previous stages
+            self._likelihood.fix_parameters(stage["fix"])
+            self._likelihood.unfix_parameters(stage["unfix"])
+
+            if stage_nr < completed:
+                continue
+
+            step = datetime.now()
+
+            if stage["bounded"]:
+                self._fit_with_bounds(
+                    stage["method"], type=stage["type"], iter_nr=stage["iter_nr"]
+                )
+            else:
+                self._fit_without_bounds(
+                    stage["method"], iter_nr=stage["iter_nr"], options=stage["options"]
+                )
+
+            self._stage_timing[str(stage["iter_nr"])] = (
+                datetime.now() - step
+            ).total_seconds()
+
+            self._save_checkpoint(stages, stage_nr + 1)
+
+        self.result = self._result_steps[str(stages[-1]["iter_nr"])]
+
+        print("The total Optimization took: {}".format(datetime.now() - start))
+
+        print("The Optimization ended with message:  {}".format(self.result.message))
+
+        print("Success = {}".format(self.result.success))
+
+        # save the fit results and errors
+
+        self._save_fits_file()
+
+        # the fit is complete, a new call of fit should start from scratch
+        if rank == 0 and os.path.isfile(self._checkpoint_path):
+            os.remove(self._checkpoint_path)
+
+        # display the results
+
+        print(self.display())
+
+        return self.result
+
+    def _build_stages(self, n_interations, method_1, method_2, use_saa):
+        """
+        Build the list of fit stages. Every stage lists the parameters that
+        are fixed and unfixed before the stage is run.
+        """
+        norm_params = self._likelihood.get_normalization_parameter_list
+        not_norm_params = self._likelihood.get_not_normalization_parameter_list
+
+        stages = []
 
         # First do the linear fit for normalizations and fix the other parameters
-        self._likelihood.fix_parameters(
-            self._likelihood.get_not_normalization_parameter_list
+        stages.append(
+            dict(
+                iter_nr=1,
+                type="linear",
+                fix=not_norm_params,
+                unfix=[],
+                bounded=True,
+                method=method_1,
+                options={},
+            )
         )
-        self._fit_with_bounds(method_1, type="linear", iter_nr=1)
 
         if use_saa:
             # Fix the normalizations and fit for the other parameters
-            self._likelihood.fix_parameters(
-                self._likelihood.get_normalization_parameter_list[0:4]
+            stages.append(
+                dict(
+                    iter_nr=2,
+                    type="SAA",
+                    fix=norm_params[0:4],
+                    unfix=not_norm_params,
+                    bounded=True,
+                    method=method_1,
+                    options={},
+                )
             )
-            self._likelihood.unfix_parameters(
-                self._likelihood.get_not_normalization_parameter_list
-            )
-            self._fit_with_bounds(method_1, type="SAA", iter_nr=2)
 
         # Unfix all parameters and fit all with bounds
-        self._likelihood.unfix_parameters(
-            self._likelihood.get_normalization_parameter_list
+        stages.append(
+            dict(
+                iter_nr=3,
+                type="full constrained",
+                fix=[],
+                unfix=norm_params,
+                bounded=True,
+                method=method_1,
+                options={},
+            )
         )
-        self._fit_with_bounds(method_1, type="full constrained", iter_nr=3)
 
         # Fit all parameters without bounds in three runs to improve speed and accuracy
         if n_interations > 3:
             for i in range(4, n_interations):
-                self._fit_without_bounds(method_2, iter_nr=i, options={})
+                stages.append(
+                    dict(
+                        iter_nr=i,
+                        type="unconstrained",
+                        fix=[],
+                        unfix=[],
+                        bounded=False,
+                        method=method_2,
+                        options={},
+                    )
+                )
 
             # Final run with improved accuracy
-            self._fit_without_bounds(
-                method_2,
-                iter_nr=n_interations,
-                options={"xtol": 0.000001, "ftol": 0.000001},
+            stages.append(
+                dict(
+                    iter_nr=n_interations,
+                    type="unconstrained",
+                    fix=[],
+                    unfix=[],
+                    bounded=False,
+                    method=method_2,
+                    options={"xtol": 0.000001, "ftol": 0.000001},
+                )
             )
 
-        self.result = self._result_steps["%s" % n_interations]
+        return stages
 
-        print("The total Optimization took: {}".format(datetime.now() - start))
+    def _save_checkpoint(self, stages, completed):
+        """
+        Save the state after the completed stages atomically
+        """
+        if rank != 0:
+            return
+
+        data = {
+            "layout": self._layout,
+            "stages": stages,
+            "completed-stages": completed,
+            "param-values": [
+                p.value for p in self._likelihood._parameters.values()
+            ],
+            "fitted-param-steps": self._fitted_params,
+            "stage-results": {
+                key: {
+                    "fun": float(np.asarray(result.fun).squeeze()),
+                    "success": bool(result.success),
+                    "message": str(result.message),
+                }
+                for key, result in self._result_steps.items()
+            },
+            "stage-timing": self._stage_timing,
+            "rng-state": _rng_state_to_json(np.random.get_state()),
+        }
 
-        print("The Optimization ended with message:  {}".format(self.result.message))
+        os.makedirs(os.path.dirname(self._checkpoint_path), exist_ok=True)
 
-        print("Success = {}".format(self.result.success))
+        atomic_json_dump(data, self._checkpoint_path)
 
-        # save the fit results and errors
+    def _load_checkpoint(self, stages):
+        """
+        Restore the state of a previous run with the same stages and layout
+        :returns: number of completed stages
+        """
+        if not os.path.isfile(self._checkpoint_path):
+            return 0
+
+        with open(self._checkpoint_path, "r") as f:
+            data = json.load(f)
+
+        if data["layout"] != self._layout or data["stages"] != json.loads(
+            json.dumps(stages)
+        ):
+            print(
+                "Checkpoint {} belongs to another fit setup and is ignored".format(
+                    self._checkpoint_path
+                )
+            )
+            return 0
 
-        self._save_fits_file()
+        for parameter, value in zip(
+            self._likelihood._parameters.values(), data["param-values"]
+        ):
+            parameter.value = value
 
-        # display the results
+        self._fitted_params = data["fitted-param-steps"]
+        self._param_index = self._layout["param-names"]
+        self._stage_timing = data["stage-timing"]
 
-        print(self.display())
+        for key, result in data["stage-results"].items():
+            self._result_steps[key] = OptimizeResult(**result)
 
-        return self.result
+        np.random.set_state(_rng_state_from_json(data["rng-state"]))
+
+        print(
+            "Resume fit from {} after stage {} of {}".format(
+                self._checkpoint_path, data["completed-stages"], len(stages)
+            )
+        )
+
+        return data["completed-stages"]
+
+    def warm_start(self, fit_file="auto"):
+        """
+        Set the start values of the parameters from a previous fit result
+        with the same detector/echan layout. Parameters are matched by name.
+        :param fit_file: path to a fit result file, "auto" to search the
+        latest fit of the previous day or a WarmStart with the posterior of
+        a previous fit
+        :returns: True if start values were set
+        """
+        if isinstance(fit_file, WarmStart):
+            return fit_file.set_start_values(self._likelihood._parameters) > 0
+
+        if fit_file == "auto":
+            fit_file = self.find_previous_fit()
+
+            if fit_file is None:
+                print("No fit of the previous day found for the warm start")
+                return False
+
+        with open(fit_file, "r") as f:
+            data = json.load(f)
+
+        if not self._same_layout(data):
+            print(
+                "The fit {} has another detector/echan layout and is not used for the warm start".format(
+                    fit_file
+                )
+            )
+            return False
+
+        values = dict(
+            zip(data["fit-result"]["param-names"], data["fit-result"]["param-values"])
+        )
+
+        for parameter in self._likelihood._parameters.values():
+            if parameter.name not in values:
+                continue
+
+            value = values[parameter.name]
+
+            # keep the start value inside the bounds of this fit
+            if parameter.bounds is not None:
+                lower, upper = parameter.bounds
+                if lower is not None:
+                    value = max(value, lower)
+                if upper is not None:
+                    value = min(value, upper)
+
+            parameter.value = value
+
+        print("Warm start from {}".format(fit_file))
+
+        return True
+
+    def _same_layout(self, data):
+        """
+        If the fit result data has the detector/echan layout of this fit
+        """
+        layout = data.get("layout", {})
+
+        return (
+            layout.get("detectors") == self._layout["detectors"]
+            and layout.get("echans") == self._layout["echans"]
+        )
+
+    def find_previous_fit(self):
+        """
+        Latest fit result of the previous day with the same detector/echan
+        layout
+        :returns: path or None
+        """
+        previous_day = (
+            datetime.strptime(self._day, "%y%m%d") - timedelta(days=1)
+        ).strftime("%y%m%d")
+
+        files = glob.glob(
+            os.path.join(
+                get_path_of_external_data_dir(),
+                "fits",
+                "Fit_{}_{}_*.json".format(previous_day, self._det),
+            )
+        )
+
+        for fit_file in sorted(files, key=_fit_file_number, reverse=True):
+            with open(fit_file, "r") as f:
+                data = json.load(f)
+
+            if self._same_layout(data):
+                return fit_file
+
+        return None
 
     def _fit_with_bounds(
         self, method="L-BFGS-B", type="bounded", iter_nr=1, ftol=1e-12
@@ -138,6 +451,9 @@ class Minimizer(object):
 
     def _save_fits_file(self):
 
+        if rank != 0:
+            return
+
         data = {}
 
         data["fitted-param-steps"] = {
@@ -151,23 +467,31 @@ class Minimizer(object):
             data["fit-result"]["param-names"].append(parameter.name)
             data["fit-result"]["param-values"].append(parameter.value)
 
+        data["layout"] = self._layout
+        data["stage-timing"] = self._stage_timing
+
         folder_path = os.path.join(get_path_of_external_data_dir(), "fits")
 
         # create directory if it doesn't exist
-        if not os.access(folder_path, os.F_OK):
-            print("Making New Directory")
-            os.mkdir(folder_path)
+        os.makedirs(folder_path, exist_ok=True)
 
-        file_number = 0
-        file_name = "Fit_{}_{}_{:d}.json".format(self._day, self._det, file_number)
+        # Use the next free file number, the exclusive creation makes sure
+        # that parallel fits never overwrite each other
+        existing = glob.glob(
+            os.path.join(folder_path, "Fit_{}_{}_*.json".format(self._day, self._det))
+        )
+        file_number = max([_fit_file_number(f) for f in existing], default=-1) + 1
 
-        # If file already exists increase file number
-        while os.path.isfile(os.path.join(folder_path, file_name)):
-            file_number += 1
+        while True:
             file_name = "Fit_{}_{}_{:d}.json".format(self._day, self._det, file_number)
+            try:
+                f = open(os.path.join(folder_path, file_name), "x")
+                break
+            except FileExistsError:
+                file_number += 1
 
         # Writing JSON data
-        with open(os.path.join(folder_path, file_name), "w") as f:
+        with f:
             json.dump(data, f, sort_keys=True, indent=4)
 
     def display(self, label="fitted_value"):
@@ -205,3 +529,26 @@ class Minimizer(object):
     @property
     def fitted_param_steps(self):
         return pd.DataFrame(data=self._fitted_params, index=self._param_index)
+
+    @property
+    def stage_timing(self):
+        return self._stage_timing
+
+    @property
+    def checkpoint_path(self):
+        return self._checkpoint_path
+
+
+def _fit_file_number(file_name):
+    match = re.search(r"_(\d+)\.json$", file_name)
+    return int(match.group(1)) if match else -1
+
+
+def _rng_state_to_json(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    return [name, keys.tolist(), int(pos), int(has_gauss), float(cached_gaussian)]
+
+
+def _rng_state_from_json(state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    return (name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian)
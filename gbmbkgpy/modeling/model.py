@@ -1,4 +1,5 @@
 import collections
+import json
 import random
 import numpy as np
 from datetime import datetime
@@ -113,8 +114,21 @@ class ModelDet:
         const_efficiency_mode=False,
         verbose=True,
         resume=False,
+        warm_start=None,
+        prior_width=None,
     ):
-        """Multinest Fit"""
+        """
+        Multinest Fit
+        :param warm_start: WarmStart with the posterior of a previous fit
+        of the same layout, e.g. the previous day
+        :param prior_width: tighten the priors to this many posterior std
+        around the warm start before the fit, None keeps the priors
+        """
+        if warm_start is not None:
+            warm_start.set_start_values(self.parameter)
+
+            if prior_width is not None:
+                warm_start.tighten_priors(self.parameter, width=prior_width)
 
         # assert (
         #    has_pymultinest
@@ -131,6 +145,12 @@ class ModelDet:
 
         # output dir
         output_dir, tmp_output_dir = create_output_dir(identifier)
+
+        # save the parameter names to map the posterior by name later
+        if rank == 0:
+            with open(output_dir / "fit_params.json", "w") as f:
+                json.dump(list(self.parameter.keys()), f)
+
         # Run PyMultiNest
         sampler = pymultinest.run(
             func_wrapper,
@@ -366,12 +386,16 @@ class ModelCombine(ModelDet):
         n_live_points=400,
         const_efficiency_mode=False,
         verbose=True,
+        warm_start=None,
+        prior_width=None,
     ):
         self._output_dir = super().minimize_multinest(
             identifier=identifier,
             n_live_points=n_live_points,
             const_efficiency_mode=const_efficiency_mode,
             verbose=verbose,
+            warm_start=warm_start,
+            prior_width=prior_width,
         )
 
         self.send_samples_to_submodels()
@@ -0,0 +1,310 @@
+import numpy as np
+
+from gbmbkgpy.modeling.model import ModelCombine, ModelDet
+from gbmbkgpy.modeling.source import NormOnlySource
+
+
+class _EvaluationPlan:
+    def __init__(self, model, time_bins, parameter_index):
+        """
+        Everything needed to evaluate the model counts of many parameter
+        samples at a fixed set of time bins.
+        :param model: ModelDet object
+        :param time_bins: time bins at which the model is evaluated
+        :param parameter_index: dict with id(parameter) -> column in the samples
+        """
+        self._num_bins = len(time_bins)
+        self._num_echan = model.data.num_echan
+
+        # counts that do not depend on any sample
+        self._offset = np.zeros((self._num_bins, self._num_echan))
+
+        # per echan: sample columns and the matching rows of the design matrix
+        linear_idx = [[] for _ in range(self._num_echan)]
+        linear_rows = [[] for _ in range(self._num_echan)]
+
+        self._nonlinear = []
+
+        for source in model.sources:
+            source_copy = source.copy_at_time_bins(time_bins)
+
+            components = None
+            if isinstance(source_copy, NormOnlySource):
+                components = source_copy.linear_components()
+
+            if components is not None:
+                base_array = np.broadcast_to(
+                    source_copy._base_array, (self._num_bins, self._num_echan)
+                )
+                for param, column in components:
+                    columns = range(self._num_echan) if column is None else [column]
+
+                    if id(param) in parameter_index and param.free:
+                        for x in columns:
+                            linear_idx[x].append(parameter_index[id(param)])
+                            linear_rows[x].append(base_array[:, x])
+                    else:
+                        for x in columns:
+                            self._offset[:, x] += param.value * base_array[:, x]
+                continue
+
+            params = list(source_copy.parameters.values())
+            idx = [parameter_index[id(p)] for p in params]
+
+            if len(idx) == 0:
+                self._offset += self._evaluate_source(source_copy)
+            else:
+                self._nonlinear.append((source_copy, np.array(idx), params))
+
+        self._linear = []
+        for x in range(self._num_echan):
+            if len(linear_idx[x]) > 0:
+                self._linear.append(
+                    (np.array(linear_idx[x]), np.array(linear_rows[x]))
+                )
+            else:
+                self._linear.append((None, None))
+
+    def _evaluate_source(self, source):
+        counts = source._evaluate()
+        return np.broadcast_to(counts, (self._num_bins, self._num_echan))
+
+    def expected_counts(self, samples, echans):
+        """
+        Model counts for all samples
+        :param samples: array with shape (n_samples, n_parameters)
+        :param echans: list of echan columns to evaluate
+        :return: array with shape (n_samples, n_bins, len(echans))
+        """
+        counts = np.empty((len(samples), self._num_bins, len(echans)))
+        counts[:] = self._offset[:, echans]
+
+        # all linear sources of all samples as one matrix product per echan
+        for j, x in enumerate(echans):
+            idx, design = self._linear[x]
+            if idx is not None:
+                counts[:, :, j] += samples[:, idx] @ design
+
+        # everything else has to be evaluated sample by sample
+        for source, idx, params in self._nonlinear:
+            for i, sample in enumerate(samples):
+                for param, value in zip(params, sample[idx]):
+                    param.value = value
+                counts[i] += self._evaluate_source(source)[:, echans]
+
+        return counts
+
+
+class PPCEngine:
+    def __init__(self, model, time_bins=None, chunk_size=50, seed=None):
+        """
+        Posterior predictive checks of a fitted model. The sources are
+        precalculated once at the given time bins, all samples of the linear
+        sources are evaluated as one matrix product and the poisson noise is
+        drawn in chunks of samples. For a ModelCombine the counts have a
+        detector axis before the echan axis, parameters of the detectors
+        with the same name share one column of the samples.
+        :param model: ModelDet or ModelCombine object
+        :param time_bins: time bins for the ppc, default are the data time
+        bins of the (first) detector
+        :param chunk_size: number of samples evaluated at once
+        :param seed: seed for the random number generator
+        """
+        assert isinstance(
+            model, (ModelDet, ModelCombine)
+        ), "PPCEngine needs a ModelDet or ModelCombine"
+
+        self._model = model
+        self._combined = isinstance(model, ModelCombine)
+
+        if self._combined:
+            self._model_dets = list(model.model_dets)
+        else:
+            self._model_dets = [model]
+
+        if time_bins is None:
+            time_bins = self._model_dets[0].data.time_bins
+
+        self._time_bins = time_bins
+        self._num_echan = self._model_dets[0].data.num_echan
+
+        assert chunk_size > 0, "chunk_size must be positive"
+        self._chunk_size = int(chunk_size)
+
+        self._rng = np.random.default_rng(seed)
+
+        columns = {name: i for i, name in enumerate(model.parameter.keys())}
+        self._num_parameters = len(columns)
+
+        self._parameter_index = [
+            {id(p): columns[name] for name, p in m.parameter.items()}
+            for m in self._model_dets
+        ]
+
+        self._plan = None
+
+    def subsample(self, samples, max_samples):
+        """
+        Random subset of at most max_samples samples
+        :param samples: array with shape (n_samples, n_parameters)
+        :param max_samples: maximal number of returned samples
+        :return: samples
+        """
+        if max_samples is None or len(samples) <= max_samples:
+            return samples
+
+        idx = np.sort(self._rng.choice(len(samples), max_samples, replace=False))
+        return samples[idx]
+
+    def expected_counts(self, samples=None, echans=None):
+        """
+        Model counts for all samples without poisson noise
+        :param samples: array with shape (n_samples, n_parameters), default
+        are the raw samples of the model
+        :param echans: list of echan columns, default all
+        :return: array with shape (n_samples, n_bins, n_echans)
+        """
+        samples, echans = self._check_input(samples, echans)
+
+        return self._evaluate(self._get_plan(), samples, echans)
+
+    def iter_ppc_counts(self, samples=None, echans=None):
+        """
+        Iterate over poisson realizations of the model in chunks of samples
+        :param samples: array with shape (n_samples, n_parameters), default
+        are the raw samples of the model
+        :param echans: list of echan columns, default all
+        :return: generator of (slice of the samples, counts of the chunk)
+        """
+        samples, echans = self._check_input(samples, echans)
+
+        plan = self._get_plan()
+
+        for start in range(0, len(samples), self._chunk_size):
+            chunk = slice(start, min(start + self._chunk_size, len(samples)))
+
+            expected = self._evaluate(plan, samples[chunk], echans)
+
+            yield chunk, self._rng.poisson(expected)
+
+    def ppc_counts(self, samples=None, echans=None, dtype=np.int64):
+        """
+        Poisson realizations of the model for all samples
+        :param samples: array with shape (n_samples, n_parameters), default
+        are the raw samples of the model
+        :param echans: list of echan columns, default all
+        :param dtype: dtype of the returned counts
+        :return: array with shape (n_samples, n_bins, n_echans)
+        """
+        samples, echans = self._check_input(samples, echans)
+
+        counts = np.empty(
+            self._counts_shape(len(samples), len(self._time_bins), len(echans)),
+            dtype=dtype,
+        )
+
+        for chunk, chunk_counts in self.iter_ppc_counts(samples, echans):
+            counts[chunk] = chunk_counts
+
+        return counts
+
+    def ppc_percentiles(self, percentiles, samples=None, echans=None, block_size=None):
+        """
+        Percentiles of the poisson realizations of the model. With a block_size
+        the time bins are processed in blocks, so only the realizations of one
+        block have to be kept in memory.
+        :param percentiles: list of percentiles in [0, 100]
+        :param samples: array with shape (n_samples, n_parameters), default
+        are the raw samples of the model
+        :param echans: list of echan columns, default all
+        :param block_size: number of time bins per block, default all at once
+        :return: array with shape (len(percentiles), n_bins, n_echans)
+        """
+        samples, echans = self._check_input(samples, echans)
+
+        num_bins = len(self._time_bins)
+
+        if block_size is None or block_size >= num_bins:
+            return np.percentile(self.ppc_counts(samples, echans), percentiles, axis=0)
+
+        result = np.empty(
+            (len(percentiles),) + self._counts_shape(None, num_bins, len(echans))[1:]
+        )
+
+        for start in range(0, num_bins, block_size):
+            stop = min(start + block_size, num_bins)
+
+            plan = self._create_plan(self._time_bins[start:stop])
+
+            counts = np.empty(
+                self._counts_shape(len(samples), stop - start, len(echans))
+            )
+
+            for s in range(0, len(samples), self._chunk_size):
+                chunk = slice(s, min(s + self._chunk_size, len(samples)))
+                counts[chunk] = self._rng.poisson(
+                    self._evaluate(plan, samples[chunk], echans)
+                )
+
+            result[:, start:stop] = np.percentile(counts, percentiles, axis=0)
+
+        return result
+
+    def _counts_shape(self, num_samples, num_bins, num_echans):
+        if self._combined:
+            return (num_samples, num_bins, len(self._model_dets), num_echans)
+
+        return (num_samples, num_bins, num_echans)
+
+    def _check_input(self, samples, echans):
+        if samples is None:
+            samples = self._model.raw_samples
+
+        samples = np.atleast_2d(np.asarray(samples, dtype=float))
+
+        assert (
+            samples.shape[1] == self._num_parameters
+        ), "Samples must have one column per free model parameter"
+
+        if echans is None:
+            echans = np.arange(self._num_echan)
+
+        return samples, np.atleast_1d(echans)
+
+    def _create_plan(self, time_bins):
+        return [
+            _EvaluationPlan(m, time_bins, parameter_index)
+            for m, parameter_index in zip(self._model_dets, self._parameter_index)
+        ]
+
+    def _get_plan(self):
+        if self._plan is None:
+            self._plan = self._create_plan(self._time_bins)
+        return self._plan
+
+    def _evaluate(self, plan, samples, echans):
+        # the non-linear sources set the parameter values of the models,
+        # restore them afterwards
+        current_values = [
+            [p.value for p in m.parameter.values()] for m in self._model_dets
+        ]
+
+        try:
+            counts = [det_plan.expected_counts(samples, echans) for det_plan in plan]
+
+        finally:
+            for m, values in zip(self._model_dets, current_values):
+                m.set_parameters(values)
+
+        if self._combined:
+            return np.stack(counts, axis=2)
+
+        return counts[0]
+
+    @property
+    def time_bins(self):
+        return self._time_bins
+
+    @property
+    def chunk_size(self):
+        return self._chunk_size
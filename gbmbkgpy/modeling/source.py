@@ -1,3 +1,5 @@
+import copy
+
 from scipy import integrate
 import numpy as np
 
@@ -24,6 +26,19 @@ class Source:
     def _precalculation(self, time_bins):
         self._time_bins = time_bins
 
+    def copy_at_time_bins(self, time_bins):
+        """
+        Shallow copy of this source that is precalculated at other time bins.
+        The copy shares the fit model (and therefore the parameters) with
+        this source, so it can be evaluated for many parameter values without
+        integrating the source again.
+        :param time_bins: time bins of the copy
+        :return: precalculated copy of the source
+        """
+        source_copy = copy.copy(self)
+        source_copy._precalculation(time_bins)
+        return source_copy
+
     def get_counts(self, bin_mask=None, time_bins=None):
         """
         Calls the evaluation of the source to get the counts per bin. Uses a bin_mask to exclude some bins if needed.
@@ -233,6 +248,24 @@ class NormOnlySource(Source):
         # eval model at dummy value (is a constant model)
         return self._fit_model(1) * self._base_array
 
+    def linear_components(self):
+        """
+        Split the counts of this source into the parts scaled by the
+        individual normalization parameters. The counts are linear in all
+        of them, which allows to evaluate many samples with one matrix product.
+        :return: list of (parameter, echan column or None for all columns);
+        None if the fit model is not a (vector of) Constant(s)
+        """
+        if self.fit_model.name == "AstromodelFunctionVector":
+            if self.fit_model.vector[0].name != "Constant":
+                return None
+            return [(f.k, x) for x, f in enumerate(self.fit_model.vector)]
+
+        if self.fit_model.name != "Constant":
+            return None
+
+        return [(self.fit_model.k, None)]
+
     def _evaluate_at_time_bins(self, time_bins):
         rates = self._interp1d_rate_base_array(time_bins)
         if len(rates.shape) == 3:
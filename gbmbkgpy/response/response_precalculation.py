@@ -1,7 +1,12 @@
 import numpy as np
 
 from gbmbkgpy.utils.progress_bar import progress_bar
-from gbmbkgpy.utils.mpi import check_mpi
+from gbmbkgpy.utils.mpi import (
+    check_mpi,
+    split_range,
+    allgatherv_array,
+    allgatherv_shared,
+)
 
 using_mpi, rank, size, comm = check_mpi()
 
@@ -33,9 +38,16 @@ def fibonacci_sphere(samples=1):
 
 class ResponsePrecalculation:
 
-    def __init__(self, response_generator, Ngrid=40000):
+    def __init__(self, response_generator, Ngrid=40000, shared=True):
+        """
+        :param response_generator: DRMGen object
+        :param Ngrid: number of points on the unit sphere
+        :param shared: store the response grid only once per node in MPI shared memory
+        """
         self._response_generator = response_generator
         self._Ngrid = Ngrid
+        self._shared = shared
+        self._shared_array = None
 
         self._points = fibonacci_sphere(samples=Ngrid)
         self._calculate_responses()
@@ -44,67 +56,56 @@ class ResponsePrecalculation:
         """
         Function to calculate the responses from all the points on the unit sphere.
         """
-        # Initialize response list
-
-        if self._Ngrid > 5000:
-            # we have to split the calc in several parts in case we are using mpi
-            endpoint_per_run = np.arange(4000, self._Ngrid, 4000, dtype=int)
-            endpoint_per_run = np.append(endpoint_per_run, self._Ngrid)
-            split = True
-        else:
-            endpoint_per_run = np.array([self._Ngrid])
-
-        responses_all_split = []
-        num_calcs = len(endpoint_per_run)
-        for i, endpoint in enumerate(endpoint_per_run):
-            responses = []
-            if i == 0:
-                startpoint = 0
-            else:
-                startpoint = endpoint_per_run[i-1]
-
-            points_per_rank = float(endpoint-startpoint) / float(size)
-            points_lower_index = (int(np.floor(points_per_rank * rank)) +
-                                  startpoint)
-            points_upper_index = (int(np.floor(points_per_rank * (rank + 1))) +
-                                  startpoint)
-
-            # Only rank==0 gives some output how much of the geometry is
-            # already calculated (progress_bar)
-            hidden = False if rank == 0 else True
-
-            with progress_bar(
-                    points_upper_index-points_lower_index,
-                    title=f"Calculating response calc {i+1} out of {num_calcs}."
-                    f"This shows the progress of rank {rank}. "
-                    "All other should be about the same.",
-                    hidden=hidden,
-            ) as p:
-                for point in self._points[
-                        points_lower_index:points_upper_index
-                ]:
-                    # get the response of every point
-                    matrix = self._response_generator.calc_response_xyz(
-                        point[0], point[1], point[2]
+        points_lower_index, points_upper_index = split_range(self._Ngrid, rank, size)
+
+        # Only rank==0 gives some output how much of the geometry is
+        # already calculated (progress_bar)
+        hidden = False if rank == 0 else True
+
+        responses = None
+
+        with progress_bar(
+                points_upper_index-points_lower_index,
+                title="Calculating response grid. "
+                f"This shows the progress of rank {rank}. "
+                "All other should be about the same.",
+                hidden=hidden,
+        ) as p:
+            for i, point in enumerate(
+                    self._points[points_lower_index:points_upper_index]
+            ):
+                # get the response of every point
+                matrix = self._response_generator.calc_response_xyz(
+                    point[0], point[1], point[2]
+                )
+
+                if responses is None:
+                    responses = np.empty(
+                        (points_upper_index-points_lower_index, *matrix.shape)
                     )
 
-                    responses.append(matrix)
-
-                    p.increase()
+                responses[i] = matrix
 
-            responses = np.array(responses)
-            if using_mpi:
-                responses_g = comm.gather(responses, root=0)
-                if rank == 0:
-                    responses_g = np.concatenate(responses_g)
+                p.increase()
 
-                # broadcast the resulting list to all ranks
-                responses = comm.bcast(responses_g, root=0)
-
-            responses_all_split.append(responses)
+        if using_mpi and responses is None:
+            # this rank has no points, but needs the response shape
+            matrix = self._response_generator.calc_response_xyz(*self._points[0])
+            responses = np.empty((0, *matrix.shape))
 
         # mult with area per point
-        self._response_array = np.concatenate(responses_all_split)*(4*np.pi/self._Ngrid)
+        responses *= 4*np.pi/self._Ngrid
+
+        if using_mpi:
+            # gather the buffers of all ranks without pickling
+            if self._shared:
+                # the grid is read-only, so one copy per node is enough
+                self._shared_array = allgatherv_shared(responses, comm=comm)
+                responses = self._shared_array.array
+            else:
+                responses = allgatherv_array(responses, comm=comm)
+
+        self._response_array = responses
 
     @property
     def response_grid(self):
@@ -2,6 +2,7 @@ import numpy as np
 from scipy.interpolate import interp1d
 
 from gbmbkgpy.utils.progress_bar import progress_bar
+from gbmbkgpy.utils.mpi import SharedArray, split_range
 
 
 def cart2ang(vec):
@@ -74,7 +75,14 @@ class PointSourceResponse:
 
 class ExtendedSourceResponse:
 
-    def __init__(self, times, resp_prec, weights):
+    def __init__(self, times, resp_prec, weights, shared=True):
+        """
+        :param times: interpolation times
+        :param resp_prec: ResponsePrecalculation object
+        :param weights: weights of the grid points for every time
+        :param shared: store the effective responses only once per node in
+        MPI shared memory
+        """
 
         response_grid = resp_prec.response_grid
 
@@ -95,20 +103,45 @@ class ExtendedSourceResponse:
         self._num_times = len(times)
         self._area_per_point = 4*np.pi/(len(response_grid))
 
+        self._shared = shared
+
         self._calc_effective_responses()
 
-        # build interpolation
+        assert np.all(np.diff(self._times) > 0),\
+            "The interpolation times must be sorted"
+
+        # build interpolation, without copying the effective responses
         self._effective_response_interp = interp1d(self._times,
                                                    self._effective_responses,
                                                    axis=0,
+                                                   copy=False,
+                                                   assume_sorted=True,
                                                    fill_value='extrapolate')
 
     def _calc_effective_responses(self):
-        eff_responses = np.zeros((self._num_times,
-                                  *self._response_grid.shape[1:]))
-        for i in range(self._num_times):
-            eff_responses[i] = np.dot(self._response_grid.T,
-                                      self._weights[i]).T
+        shape = (self._num_times, *self._response_grid.shape[1:])
+
+        if self._shared:
+            # every rank of a node calculates a part of the times
+            # and writes it directly into the shared memory
+            self._shared_array = SharedArray(shape)
+            eff_responses = self._shared_array.array
+            start, stop = split_range(self._num_times,
+                                      self._shared_array.node_rank,
+                                      self._shared_array.node_size)
+        else:
+            self._shared_array = None
+            eff_responses = np.empty(shape)
+            start, stop = 0, self._num_times
+
+        # all times at once as one matrix product with the flattened grid
+        grid = self._response_grid.reshape(len(self._response_grid), -1)
+        eff_responses[start:stop] = np.dot(
+            self._weights[start:stop], grid
+        ).reshape(stop-start, *shape[1:])
+
+        if self._shared_array is not None:
+            self._shared_array.barrier()
 
         self._effective_responses = eff_responses
 
@@ -156,18 +189,12 @@ class EarthCGBResponse(ExtendedSourceResponse):
                                     np.linalg.norm(resp_prec._points,
                                                    axis=1)[:, np.newaxis])
 
-        # get az, el of grid points
-        azs, els = cart2ang(grid_points_pos_norm_vec)
+        occulted = geom.earth_occultation(interp_times, grid_points_pos_norm_vec)
 
-        for k, time in enumerate(interp_times):
-
-            ras, decs = geom.satellite_to_icrs(time, azs, els)
-            occulted = geom.is_occulted(time, ras, decs)
-
-            if kind == "earth albedo":
-                weights[k, occulted] = 1
-            else:
-                weights[k, ~occulted] = 1
+        if kind == "earth albedo":
+            weights[occulted] = 1
+        else:
+            weights[~occulted] = 1
 
         return weights
 
@@ -209,19 +236,11 @@ class GalacticCenterResponse(ExtendedSourceResponse):
                                     np.linalg.norm(resp_prec._points,
                                                    axis=1)[:, np.newaxis])
 
-        # get az, el of grid points
-        azs, els = cart2ang(grid_points_pos_norm_vec)
-
-        for k, time in enumerate(interp_times):
-
-            ras, decs = geom.satellite_to_icrs(time, azs, els)
-            occulted = geom.is_occulted(time, ras, decs)
+        occulted = geom.earth_occultation(interp_times, grid_points_pos_norm_vec)
 
-            l, b = geom.satellite_to_galactic(time,
-                                              azs[~occulted],
-                                              els[~occulted])
+        l, b = geom.satellite_to_galactic_cart(interp_times, grid_points_pos_norm_vec)
 
-            weights[k, ~occulted] = self._lorentzian(l, b)
+        weights[~occulted] = self._lorentzian(l[~occulted], b[~occulted])
 
         return weights
 
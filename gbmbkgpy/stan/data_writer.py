@@ -0,0 +1,286 @@
+import io
+import json
+import os
+
+import h5py
+import numpy as np
+
+
+class HDF5DataWriter(object):
+    def __init__(self, file_path, compression=None):
+        """
+        Write the stan data to a hdf5 file. Large arrays are created as
+        datasets and filled chunk wise by StanDataConstructor.write_data.
+        :param file_path: path of the hdf5 file
+        :param compression: compression of the datasets, e.g. "gzip"
+        """
+        self._file_path = file_path
+        self._compression = compression
+
+        self._f = h5py.File(file_path, "w")
+
+    def write(self, name, value):
+        """
+        Write one entry of the stan data
+        :param name: name in the stan data
+        :param value: scalar or array
+        """
+        value = np.asarray(value)
+
+        if value.ndim == 0:
+            self._f.attrs[name] = value
+        else:
+            self._f.create_dataset(name, data=value, compression=self._compression)
+
+    def create_array(self, name, shape, dtype):
+        """
+        Create an empty array, that is filled by slice assignment
+        :param name: name in the stan data
+        :param shape: shape of the array
+        :param dtype: dtype of the array
+        :returns: hdf5 dataset
+        """
+        return self._f.create_dataset(
+            name, shape=shape, dtype=dtype, compression=self._compression
+        )
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @property
+    def file_path(self):
+        return self._file_path
+
+
+def read_hdf5_data(file_path):
+    """
+    Read stan data written by HDF5DataWriter
+    :param file_path: path of the hdf5 file
+    :returns: data dictionary for stan
+    """
+    data_dict = {}
+
+    with h5py.File(file_path, "r") as f:
+        for name, value in f.attrs.items():
+            data_dict[name] = value.item() if np.ndim(value) == 0 else value
+
+        for name in f.keys():
+            data_dict[name] = f[name][()]
+
+    return data_dict
+
+
+def _float_format(dtype):
+    # enough digits to restore the values exactly
+    if np.dtype(dtype) == np.float32:
+        return "%.9g"
+    return "%.17g"
+
+
+def _format_rows(array):
+    """
+    Rows of a 2D array as CmdStan JSON text "[a,b],[c,d]"
+    """
+    array = np.asarray(array)
+
+    if array.dtype.kind in "iub":
+        fmt = "%d"
+    else:
+        assert np.all(np.isfinite(array)), "Stan data must be finite"
+        fmt = _float_format(array.dtype)
+
+    if array.shape[-1] == 0:
+        return ",".join(["[]"] * len(array))
+
+    buffer = io.StringIO()
+    np.savetxt(buffer, array, fmt=fmt, delimiter=",", newline="],[")
+
+    # remove the separator after the last row
+    return "[" + buffer.getvalue()[:-2]
+
+
+class _JSONArray(object):
+    def __init__(self, writer, shape):
+        """
+        Array in a CmdStan JSON file that is filled with consecutive blocks
+        of rows, (rows) for 2D and (index, rows) for 3D arrays
+        """
+        assert len(shape) in (2, 3), "Only 2D and 3D arrays can be written chunk wise"
+
+        self._writer = writer
+        self._shape = tuple(shape)
+
+        self._num_outer = 1 if len(shape) == 2 else shape[0]
+        self._num_rows = shape[-2]
+
+        assert self._num_rows > 0, "Arrays without rows can not be written chunk wise"
+
+        self._outer = 0
+        self._row = 0
+
+        self._writer._write("[" if len(shape) == 2 else "[[")
+
+    def __setitem__(self, key, value):
+        if len(self._shape) == 2:
+            index, rows = 0, key
+        else:
+            index, rows = key
+
+        start, stop, _ = rows.indices(self._num_rows)
+
+        assert (index, start) == (
+            self._outer,
+            self._row,
+        ), "The rows have to be written in order"
+
+        value = np.asarray(value).reshape(-1, self._shape[-1])
+
+        assert stop - start == len(value), "Wrong number of rows"
+
+        if len(value) == 0:
+            return
+
+        text = _format_rows(value)
+
+        if self._row > 0:
+            text = "," + text
+
+        self._row = stop
+
+        if self._row == self._num_rows:
+            self._outer += 1
+            self._row = 0
+
+            if self._outer == self._num_outer:
+                text += "]" if len(self._shape) == 2 else "]]"
+            else:
+                text += "],["
+
+        self._writer._write(text)
+
+    @property
+    def complete(self):
+        return self._outer == self._num_outer
+
+
+class CmdStanJSONWriter(object):
+    def __init__(self, file_path, block_size=100000):
+        """
+        Write the stan data as CmdStan JSON file without building one large
+        dict or string. Arrays are formatted in blocks of rows and the free
+        spectrum responses are written chunk wise by
+        StanDataConstructor.write_data. The file is written to a temporary
+        file and renamed when it is closed, so a file with this name is
+        always complete.
+        :param file_path: path of the json file
+        :param block_size: number of rows that are formatted at once
+        """
+        self._file_path = file_path
+        self._tmp_path = f"{file_path}.tmp"
+        self._block_size = block_size
+
+        self._f = open(self._tmp_path, "w")
+        self._f.write("{")
+
+        self._num_entries = 0
+        self._open_array = None
+
+    def _write(self, text):
+        self._f.write(text)
+
+    def _start_entry(self, name):
+        assert (
+            self._open_array is None or self._open_array.complete
+        ), "The previous array is not complete"
+
+        if self._num_entries > 0:
+            self._f.write(",\n")
+
+        self._f.write(f"{json.dumps(name)}:")
+        self._num_entries += 1
+
+    def write(self, name, value):
+        """
+        Write one entry of the stan data
+        :param name: name in the stan data
+        :param value: scalar or array
+        """
+        self._start_entry(name)
+
+        value = np.asarray(value)
+
+        if value.ndim == 0:
+            value = value.item()
+            if isinstance(value, float):
+                assert np.isfinite(value), "Stan data must be finite"
+            self._f.write(json.dumps(value))
+            return
+
+        self._write_array(value)
+
+    def _write_array(self, value):
+        if value.ndim == 1:
+            self._f.write(_format_rows(value[np.newaxis]))
+
+        elif value.ndim == 2:
+            self._f.write("[")
+            for start in range(0, len(value), self._block_size):
+                if start > 0:
+                    self._f.write(",")
+                self._f.write(_format_rows(value[start : start + self._block_size]))
+            self._f.write("]")
+
+        else:
+            # higher dimensions as nested lists
+            self._f.write("[")
+            for i, sub in enumerate(value):
+                if i > 0:
+                    self._f.write(",")
+                self._write_array(sub)
+            self._f.write("]")
+
+    def create_array(self, name, shape, dtype):
+        """
+        Create an array, that is filled with consecutive blocks of rows
+        :param name: name in the stan data
+        :param shape: shape of the array
+        :param dtype: dtype of the array (not used, the values are written
+        with the precision of the assigned blocks)
+        :returns: array like that supports the assignment of row blocks
+        """
+        self._start_entry(name)
+
+        self._open_array = _JSONArray(self, shape)
+
+        return self._open_array
+
+    def close(self):
+        assert (
+            self._open_array is None or self._open_array.complete
+        ), "The last array is not complete"
+
+        self._f.write("}\n")
+        self._f.close()
+
+        os.replace(self._tmp_path, self._file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self._f.close()
+            os.remove(self._tmp_path)
+
+    @property
+    def file_path(self):
+        return self._file_path
+
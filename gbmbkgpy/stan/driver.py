@@ -0,0 +1,312 @@
+import json
+import os
+import re
+import subprocess
+import time
+from pathlib import Path
+
+_progress_pattern = re.compile(r"Iteration:\s*(\d+)\s*/\s*(\d+)")
+
+
+def available_cpus():
+    """
+    CPUs this process is allowed to run on
+    :returns: sorted list of cpu ids
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count()))
+
+
+def chain_cpu_sets(chains, threads_per_chain, cpus=None):
+    """
+    Split the cpus in one contiguous block per chain, so the threads of a
+    chain share the caches of neighbouring cores
+    :param chains: number of chains
+    :param threads_per_chain: number of threads per chain
+    :param cpus: cpu ids to use, default all available cpus
+    :returns: list with the cpu ids of every chain
+    """
+    if cpus is None:
+        cpus = available_cpus()
+
+    assert chains * threads_per_chain <= len(cpus), (
+        f"{chains} chains with {threads_per_chain} threads need "
+        f"{chains * threads_per_chain} cpus, but only {len(cpus)} are available"
+    )
+
+    return [
+        list(cpus[i * threads_per_chain : (i + 1) * threads_per_chain])
+        for i in range(chains)
+    ]
+
+
+def _read_progress(stdout_file):
+    """
+    Last iteration in the CmdStan output of one chain
+    """
+    if not os.path.exists(stdout_file):
+        return 0, 0
+
+    with open(stdout_file, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        f.seek(max(0, f.tell() - 2000))
+        tail = f.read().decode(errors="ignore")
+
+    matches = _progress_pattern.findall(tail)
+
+    if len(matches) == 0:
+        return 0, 0
+
+    return int(matches[-1][0]), int(matches[-1][1])
+
+
+class ParallelChains(object):
+    def __init__(
+        self,
+        model,
+        data_file,
+        chains=4,
+        threads_per_chain=1,
+        output_dir="stan_chains",
+        cpus=None,
+        pin_threads=True,
+    ):
+        """
+        Run the chains of a Stan fit as separate CmdStan processes on the same
+        data file. Every chain gets its own output dir, a fixed number of
+        threads and (on Linux) a block of cpus, so several multithreaded
+        chains run next to each other on one node without competing for
+        cores.
+        :param model: compiled CmdStanModel, e.g. StanModelConstructor.compiled_model()
+        :param data_file: json data file, e.g. StanDataConstructor.save_data_json
+        :param chains: number of chains
+        :param threads_per_chain: threads of reduce_sum per chain
+        :param output_dir: base dir of the chain output dirs
+        :param cpus: cpu ids to use, default all available cpus
+        :param pin_threads: pin every chain to its block of cpus
+        """
+        self._exe_file = str(model.exe_file)
+        self._data_file = str(Path(data_file).absolute())
+        self._chains = chains
+        self._threads_per_chain = threads_per_chain
+        self._output_dir = Path(output_dir).absolute()
+
+        self._cpu_sets = chain_cpu_sets(chains, threads_per_chain, cpus)
+
+        self._pin_threads = pin_threads and hasattr(os, "sched_setaffinity")
+
+        self._csv_files = None
+
+    def chain_dir(self, chain):
+        return self._output_dir / f"chain_{chain + 1}"
+
+    def _chain_args(
+        self,
+        chain,
+        seed,
+        init_file,
+        iter_warmup,
+        iter_sampling,
+        thin,
+        save_warmup,
+        adapt_delta,
+        max_treedepth,
+        refresh,
+    ):
+        """
+        Command line of CmdStan for one chain
+        """
+        args = [
+            self._exe_file,
+            f"id={chain + 1}",
+            "method=sample",
+            f"num_samples={iter_sampling}",
+            f"num_warmup={iter_warmup}",
+            f"save_warmup={int(save_warmup)}",
+            f"thin={thin}",
+        ]
+
+        if adapt_delta is not None:
+            args += ["adapt", f"delta={adapt_delta}"]
+
+        if max_treedepth is not None:
+            args += ["algorithm=hmc", "engine=nuts", f"max_depth={max_treedepth}"]
+
+        args += ["data", f"file={self._data_file}"]
+
+        if init_file is not None:
+            args.append(f"init={init_file}")
+
+        args += [
+            "random",
+            f"seed={seed}",
+            "output",
+            f"file={self.chain_dir(chain) / 'output.csv'}",
+            f"refresh={refresh}",
+        ]
+
+        return args
+
+    def _write_init_file(self, chain, inits):
+        if inits is None or isinstance(inits, (str, Path)):
+            return inits
+
+        if isinstance(inits, (list, tuple)):
+            inits = inits[chain]
+
+        init_file = self.chain_dir(chain) / "inits.json"
+
+        with open(init_file, "w") as f:
+            json.dump(inits, f)
+
+        return str(init_file)
+
+    def run(
+        self,
+        seed=None,
+        inits=None,
+        iter_warmup=1000,
+        iter_sampling=1000,
+        thin=1,
+        save_warmup=False,
+        adapt_delta=None,
+        max_treedepth=None,
+        refresh=10,
+        poll_interval=30,
+    ):
+        """
+        Run all chains and wait until they are finished
+        :param seed: seed of the fit, the chains use different streams of it
+        :param inits: path of an init file, a dict for all chains or a list
+        with one dict per chain, e.g. WarmStart.stan_inits
+        :param refresh: iterations between two progress outputs of CmdStan
+        :param poll_interval: seconds between two progress reports
+        :returns: list of the csv files of the chains
+        """
+        if seed is None:
+            seed = int.from_bytes(os.urandom(3), "little")
+
+        processes = []
+        stdout_files = []
+
+        try:
+            for chain in range(self._chains):
+                self.chain_dir(chain).mkdir(parents=True, exist_ok=True)
+
+                args = self._chain_args(
+                    chain,
+                    seed,
+                    self._write_init_file(chain, inits),
+                    iter_warmup,
+                    iter_sampling,
+                    thin,
+                    save_warmup,
+                    adapt_delta,
+                    max_treedepth,
+                    refresh,
+                )
+
+                env = dict(os.environ)
+                env["STAN_NUM_THREADS"] = str(self._threads_per_chain)
+
+                preexec_fn = None
+                if self._pin_threads:
+                    cpu_set = self._cpu_sets[chain]
+                    preexec_fn = lambda cpu_set=cpu_set: os.sched_setaffinity(0, cpu_set)
+
+                stdout_file = self.chain_dir(chain) / "stdout.txt"
+                stdout_files.append(stdout_file)
+
+                with open(stdout_file, "w") as f:
+                    processes.append(
+                        subprocess.Popen(
+                            args,
+                            stdout=f,
+                            stderr=subprocess.STDOUT,
+                            env=env,
+                            cwd=self.chain_dir(chain),
+                            preexec_fn=preexec_fn,
+                        )
+                    )
+
+            print(
+                f"Started {self._chains} chains with {self._threads_per_chain} threads each"
+            )
+
+            start = time.time()
+
+            while any(p.poll() is None for p in processes):
+                time.sleep(poll_interval)
+
+                # stop the other chains if one chain failed
+                if any(p.poll() not in (None, 0) for p in processes):
+                    break
+
+                progress = [_read_progress(f) for f in stdout_files]
+                print(
+                    f"{time.time() - start:8.0f} s: "
+                    + " ".join(f"{it}/{total}" for it, total in progress)
+                )
+
+        except BaseException:
+            for p in processes:
+                if p.poll() is None:
+                    p.terminate()
+            raise
+
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+                p.wait()
+
+        for chain, p in enumerate(processes):
+            if p.returncode not in (0, -15):
+                with open(stdout_files[chain], "r") as f:
+                    tail = f.read()[-2000:]
+
+                raise RuntimeError(
+                    f"Chain {chain + 1} failed with return code {p.returncode}:\n{tail}"
+                )
+
+        print(f"All chains finished after {time.time() - start:.0f} s")
+
+        self._csv_files = [
+            str(self.chain_dir(chain) / "output.csv") for chain in range(self._chains)
+        ]
+
+        return self._csv_files
+
+    def to_cmdstanpy(self):
+        """
+        Merged fit of all chains as CmdStanMCMC
+        """
+        import cmdstanpy
+
+        assert self._csv_files is not None, "Run the chains first"
+
+        return cmdstanpy.from_csv(self._csv_files)
+
+    def to_arviz(self, **kwargs):
+        """
+        Merged fit of all chains as arviz InferenceData
+        :param kwargs: passed to arviz.from_cmdstan, e.g. posterior_predictive
+        """
+        import arviz
+
+        assert self._csv_files is not None, "Run the chains first"
+
+        return arviz.from_cmdstan(posterior=self._csv_files, **kwargs)
+
+    @property
+    def csv_files(self):
+        return self._csv_files
+
+    @property
+    def cpu_sets(self):
+        return self._cpu_sets
+
+    @property
+    def output_dir(self):
+        return self._output_dir
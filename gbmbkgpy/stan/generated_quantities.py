@@ -0,0 +1,163 @@
+import inspect
+import math
+import os
+import re
+import tempfile
+
+_config_pattern = re.compile(r"^#\s*(\w+)\s*=\s*(\S+)")
+
+
+def _is_true(value):
+    return value.lower() in ("1", "true")
+
+
+def read_csv_config(csv_file):
+    """
+    Config of a Stan CSV file of the sampler (the "# key = value" comment
+    lines before the header)
+    :param csv_file: path of the csv file
+    :returns: dict key -> value as string
+    """
+    config = {}
+
+    with open(csv_file, "r") as f:
+        for line in f:
+            if not line.startswith("#"):
+                break
+
+            match = _config_pattern.match(line)
+            if match is not None:
+                config.setdefault(match.group(1), match.group(2))
+
+    return config
+
+
+def num_sampling_draws(csv_file):
+    """
+    Number of saved sampling draws in a Stan CSV file of the sampler
+    """
+    config = read_csv_config(csv_file)
+
+    return int(math.ceil(int(config["num_samples"]) / int(config.get("thin", 1))))
+
+
+def thin_stan_csv(csv_file, out_file, step):
+    """
+    Write a Stan CSV file with every step-th sampling draw. The thin in the
+    config is changed accordingly and saved warmup draws are dropped, so
+    cmdstanpy and CmdStan read the file like the output of a sampler run with
+    the larger thin.
+    :param csv_file: path of the csv file of the sampler
+    :param out_file: path of the thinned csv file
+    :param step: keep every step-th draw
+    """
+    assert step >= 1, "step must be at least 1"
+
+    config = read_csv_config(csv_file)
+
+    thin = int(config.get("thin", 1))
+
+    num_warmup_rows = 0
+    if _is_true(config.get("save_warmup", "0")):
+        num_warmup_rows = int(math.ceil(int(config["num_warmup"]) / thin))
+
+    header = False
+    row = 0
+
+    with open(csv_file, "r") as f_in, open(out_file, "w") as f_out:
+        for line in f_in:
+            if line.startswith("#"):
+                match = _config_pattern.match(line)
+
+                if match is not None and match.group(1) == "thin":
+                    line = f"{line[: match.start(2)]}{thin * step}\n"
+
+                elif match is not None and match.group(1) == "save_warmup":
+                    line = f"{line[: match.start(2)]}0\n"
+
+                f_out.write(line)
+                continue
+
+            if not header:
+                header = True
+                f_out.write(line)
+                continue
+
+            row += 1
+
+            if row <= num_warmup_rows:
+                continue
+
+            if (row - num_warmup_rows - 1) % step == 0:
+                f_out.write(line)
+
+
+def fit_seed(csv_file):
+    """
+    Seed of the sampler run of a Stan CSV file
+    :returns: seed as int or None if the file has no seed
+    """
+    seed = read_csv_config(csv_file).get("seed")
+
+    return None if seed is None else int(seed)
+
+
+def run_generated_quantities(
+    model, data, fit, thin=None, num_draws=None, seed=None, output_dir=None
+):
+    """
+    Standalone generated quantities pass of a model on (a thinned subset of)
+    the draws of a previous fit
+    :param model: compiled CmdStanModel with the generated quantities
+    :param data: data of the fit, dict or path of a json file
+    :param fit: CmdStanMCMC or list of Stan CSV files of the fit
+    :param thin: use every thin-th draw
+    :param num_draws: use about num_draws draws in total, overrides thin
+    :param seed: seed of the pass, default is the seed of the fit, so random
+    numbers of the transformed data are the same as in the fit
+    :param output_dir: directory of the thinned csv files and the output
+    :returns: CmdStanGQ
+    """
+    if hasattr(fit, "runset"):
+        csv_files = list(fit.runset.csv_files)
+    else:
+        csv_files = list(fit)
+
+    if seed is None:
+        seed = fit_seed(csv_files[0])
+
+    step = 1 if thin is None else int(thin)
+
+    if num_draws is not None:
+        total = sum(num_sampling_draws(f) for f in csv_files)
+        step = max(1, int(math.ceil(total / num_draws)))
+
+    if output_dir is None:
+        output_dir = tempfile.mkdtemp(prefix="stan_gq_")
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    if step > 1:
+        thinned_files = []
+        for csv_file in csv_files:
+            name = os.path.splitext(os.path.basename(csv_file))[0]
+            out_file = os.path.join(output_dir, f"{name}_thin{step}.csv")
+            thin_stan_csv(csv_file, out_file, step)
+            thinned_files.append(out_file)
+
+        csv_files = thinned_files
+
+    print(f"Generate quantities for every {step}. draw of {len(csv_files)} chains")
+
+    # older cmdstanpy versions call the previous fit mcmc_sample
+    if "previous_fit" in inspect.signature(model.generate_quantities).parameters:
+        fit_kwarg = "previous_fit"
+    else:
+        fit_kwarg = "mcmc_sample"
+
+    return model.generate_quantities(
+        data=data,
+        seed=seed,
+        gq_output_dir=output_dir,
+        **{fit_kwarg: csv_files},
+    )
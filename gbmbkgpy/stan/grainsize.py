@@ -0,0 +1,187 @@
+import csv
+import json
+import os
+from pathlib import Path
+
+from gbmbkgpy.stan.model_cache import file_lock, get_stan_model_cache_dir
+
+
+def heuristic_grainsize(num_data_points, threads):
+    """
+    Grainsize for reduce_sum that gives every thread one slice of the data
+    :param num_data_points: number of data points in the likelihood
+    :param threads: number of threads per chain
+    :returns: grainsize
+    """
+    if threads <= 1:
+        return 1
+
+    return max(1, int(num_data_points / threads))
+
+
+def grainsize_candidates(num_data_points, threads, splits=(1, 2, 4, 8, 16, 32)):
+    """
+    Grainsizes that are tested by the autotuning, every thread gets
+    between one and max(splits) slices of the data
+    :param num_data_points: number of data points in the likelihood
+    :param threads: number of threads per chain
+    :param splits: number of slices per thread
+    :returns: sorted list of grainsizes
+    """
+    return sorted(
+        {max(1, int(num_data_points / (threads * k))) for k in splits}, reverse=True
+    )
+
+
+def grainsize_key(num_time_bins, num_dets, num_echans, num_Ein, threads):
+    """
+    Key of the cached grainsize for one data shape and thread count
+    """
+    return f"{num_time_bins}_{num_dets}_{num_echans}_{num_Ein}_{threads}"
+
+
+class GrainsizeCache(object):
+    def __init__(self, cache_file=None):
+        """
+        Grainsizes found by the autotuning per data shape and thread count
+        :param cache_file: json file, default $GBMDATA/stan_models/grainsize.json
+        """
+        if cache_file is None:
+            cache_file = get_stan_model_cache_dir() / "grainsize.json"
+
+        self._cache_file = Path(cache_file)
+
+    def _read(self):
+        if not self._cache_file.exists():
+            return {}
+
+        with open(self._cache_file, "r") as f:
+            return json.load(f)
+
+    def get(self, key):
+        """
+        Cached grainsize for this key
+        :returns: grainsize or None if the key is not in the cache
+        """
+        entry = self._read().get(key)
+
+        return None if entry is None else entry["grainsize"]
+
+    def set(self, key, grainsize, timings=None):
+        """
+        Save the grainsize for this key
+        :param timings: dict grainsize -> time per gradient of the autotuning
+        """
+        self._cache_file.parent.mkdir(parents=True, exist_ok=True)
+
+        with file_lock(f"{self._cache_file}.lock"):
+            cache = self._read()
+
+            cache[key] = dict(
+                grainsize=int(grainsize),
+                timings={} if timings is None else {str(k): v for k, v in timings.items()},
+            )
+
+            tmp_path = f"{self._cache_file}.tmp{os.getpid()}"
+            with open(tmp_path, "w") as f:
+                json.dump(cache, f, indent=4, sort_keys=True)
+            os.replace(tmp_path, self._cache_file)
+
+    @property
+    def cache_file(self):
+        return self._cache_file
+
+
+def set_json_grainsize(data_file, grainsize):
+    """
+    Change the grainsize in a CmdStan json data file in place. The grainsize
+    has to be the last entry, like in the files of
+    StanDataConstructor.save_data_json, so only the end of the file is
+    rewritten.
+    :param data_file: path of the json data file
+    :param grainsize: new grainsize
+    """
+    with open(data_file, "r+b") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+
+        f.seek(max(0, size - 200))
+        tail = f.read()
+
+        pos = tail.rfind(b'"grainsize":')
+        assert pos >= 0, "The grainsize must be the last entry of the data file"
+
+        f.seek(max(0, size - 200) + pos)
+        f.write(f'"grainsize":{int(grainsize)}}}\n'.encode())
+        f.truncate()
+
+
+def read_profile_time(profile_file, name="reduce_sum"):
+    """
+    Time per gradient evaluation of one profile block
+    :param profile_file: profile csv file of CmdStan
+    :param name: name of the profile block
+    :returns: total time / number of autodiff calls
+    """
+    total_time = 0.0
+    calls = 0
+
+    with open(profile_file, "r") as f:
+        for row in csv.DictReader(f):
+            if row["name"] == name:
+                total_time += float(row["total_time"])
+                calls += int(row["autodiff_calls"])
+
+    assert calls > 0, f"No profile of {name} found, compile the model with profile=True"
+
+    return total_time / calls
+
+
+def autotune_grainsize(
+    model,
+    data_file,
+    threads,
+    candidates,
+    iter_warmup=20,
+    seed=1,
+    output_dir=None,
+):
+    """
+    Run a few iterations of the sampler with every grainsize and measure the
+    time per gradient of the reduce_sum profile block. The model must be
+    generated with StanModelConstructor(profile=True).
+    :param model: compiled CmdStanModel
+    :param data_file: CmdStan json data file with the grainsize as last entry
+    :param threads: number of threads per chain
+    :param candidates: list of grainsizes to test
+    :param iter_warmup: number of warmup iterations per grainsize
+    :param seed: seed of the sampler, the same for all grainsizes
+    :param output_dir: directory of the CmdStan output
+    :returns: best grainsize, dict grainsize -> time per gradient
+    """
+    timings = {}
+
+    for grainsize in candidates:
+        set_json_grainsize(data_file, grainsize)
+
+        fit = model.sample(
+            data=str(data_file),
+            chains=1,
+            seed=seed,
+            threads_per_chain=threads,
+            iter_warmup=iter_warmup,
+            iter_sampling=1,
+            save_profile=True,
+            output_dir=output_dir,
+            show_progress=False,
+        )
+
+        timings[int(grainsize)] = read_profile_time(fit.runset.profile_files[0])
+
+        print(f"Grainsize {grainsize}: {timings[int(grainsize)]:.3e} s per gradient")
+
+    best = min(timings, key=timings.get)
+
+    set_json_grainsize(data_file, best)
+
+    return best, timings
@@ -0,0 +1,238 @@
+import fcntl
+import hashlib
+import json
+import os
+import re
+from contextlib import contextmanager
+from pathlib import Path
+
+from gbmbkgpy.io.package_data import get_path_of_external_data_dir
+
+_include_pattern = re.compile(r"^\s*#include\s+[<\"]?([^\s>\"]+)", re.MULTILINE)
+
+STAN_FILE_NAME = "model.stan"
+INFO_FILE_NAME = "model_info.json"
+LOCK_FILE_NAME = ".lock"
+
+
+def get_stan_model_cache_dir():
+    """
+    Default directory of the compiled stan models
+    :returns: $GBMDATA/stan_models
+    """
+    return get_path_of_external_data_dir() / "stan_models"
+
+
+def resolve_include_paths(include_paths=None):
+    """
+    Absolute include paths, default is the current working directory
+    :param include_paths: list of directories with the included .stan files
+    :returns: list of absolute paths as str
+    """
+    if include_paths is None:
+        include_paths = [os.getcwd()]
+
+    return [str(Path(p).absolute()) for p in include_paths]
+
+
+def _find_include(name, include_paths):
+    for path in include_paths:
+        file_path = Path(path) / name
+        if file_path.exists():
+            return file_path
+    return None
+
+
+def _included_files(stan_code, include_paths, found=None):
+    """
+    All files that are included (also recursively) in the stan code
+    """
+    if found is None:
+        found = {}
+
+    for name in _include_pattern.findall(stan_code):
+        if name in found:
+            continue
+
+        file_path = _find_include(name, include_paths)
+        found[name] = file_path
+
+        if file_path is not None:
+            _included_files(file_path.read_text(), include_paths, found)
+
+    return found
+
+
+def _cmdstan_version():
+    try:
+        from cmdstanpy.utils import cmdstan_version
+
+        version = cmdstan_version()
+    except (ImportError, ValueError):
+        version = None
+
+    return None if version is None else ".".join(str(v) for v in version)
+
+
+def stan_model_hash(stan_code, cpp_options=None, stanc_options=None, include_paths=None):
+    """
+    Hash of everything that changes the compiled model: the stan code, the
+    content of all included files, the compiler options and the CmdStan version
+    :param stan_code: text of the .stan file
+    :param cpp_options: dict with the C++ compiler options
+    :param stanc_options: dict with the stanc options
+    :param include_paths: list of directories with the included .stan files,
+    default is the current working directory
+    :returns: hex digest of the hash
+    """
+    include_paths = resolve_include_paths(include_paths)
+
+    sha = hashlib.sha256()
+    sha.update(stan_code.encode())
+
+    for name, file_path in sorted(
+        _included_files(stan_code, include_paths).items()
+    ):
+        sha.update(name.encode())
+        if file_path is not None:
+            sha.update(file_path.read_bytes())
+
+    options = dict(
+        cpp_options={} if cpp_options is None else cpp_options,
+        stanc_options={} if stanc_options is None else stanc_options,
+        cmdstan=_cmdstan_version(),
+    )
+    sha.update(json.dumps(options, sort_keys=True, default=str).encode())
+
+    return sha.hexdigest()
+
+
+@contextmanager
+def file_lock(lock_path):
+    """
+    Exclusive lock on a file, that blocks until all other processes
+    released the lock
+    :param lock_path: path of the lock file
+    """
+    with open(lock_path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class StanModelCache(object):
+    def __init__(self, cache_dir=None):
+        """
+        Store of compiled stan models. Every model gets its own directory named
+        after the hash of the stan code and compiler options, so a model that
+        was compiled once is reused by all later runs with the same code.
+        Concurrent jobs that need the same model are serialized with a file
+        lock, only the first one compiles it.
+        :param cache_dir: directory of the store, default $GBMDATA/stan_models
+        """
+        if cache_dir is None:
+            cache_dir = get_stan_model_cache_dir()
+
+        self._cache_dir = Path(cache_dir)
+
+    def model_dir(self, model_hash):
+        """
+        Directory of the model with this hash
+        """
+        return self._cache_dir / model_hash
+
+    def is_compiled(self, model_hash):
+        """
+        Check if the model with this hash was compiled completely
+        """
+        info_path = self.model_dir(model_hash) / INFO_FILE_NAME
+
+        if not info_path.exists():
+            return False
+
+        with open(info_path, "r") as f:
+            info = json.load(f)
+
+        return Path(info["exe_file"]).exists()
+
+    def get_model(
+        self, stan_code, cpp_options=None, stanc_options=None, include_paths=None
+    ):
+        """
+        Get the compiled CmdStanModel of this stan code. It is compiled
+        only if it is not in the store yet.
+        :param stan_code: text of the .stan file
+        :param cpp_options: dict with the C++ compiler options
+        :param stanc_options: dict with the stanc options
+        :param include_paths: list of directories with the included .stan files,
+        default is the current working directory
+        :returns: CmdStanModel
+        """
+        from cmdstanpy import CmdStanModel
+
+        include_paths = resolve_include_paths(include_paths)
+
+        model_hash = stan_model_hash(
+            stan_code,
+            cpp_options=cpp_options,
+            stanc_options=stanc_options,
+            include_paths=include_paths,
+        )
+
+        model_dir = self.model_dir(model_hash)
+        model_dir.mkdir(parents=True, exist_ok=True)
+
+        stan_file = model_dir / STAN_FILE_NAME
+        info_path = model_dir / INFO_FILE_NAME
+
+        stanc_options = dict({} if stanc_options is None else stanc_options)
+        stanc_options["include-paths"] = include_paths
+
+        with file_lock(model_dir / LOCK_FILE_NAME):
+
+            if self.is_compiled(model_hash):
+
+                with open(info_path, "r") as f:
+                    info = json.load(f)
+
+                return CmdStanModel(
+                    stan_file=str(stan_file), exe_file=info["exe_file"], compile=False
+                )
+
+            # an interrupted compilation can leave an incomplete executable
+            if info_path.exists():
+                info_path.unlink()
+
+            with open(stan_file, "w") as f:
+                f.write(stan_code)
+
+            print(f"Compile stan model {model_hash}")
+
+            model = CmdStanModel(
+                stan_file=str(stan_file),
+                cpp_options=cpp_options,
+                stanc_options=stanc_options,
+                compile="force",
+            )
+
+            info = dict(
+                hash=model_hash,
+                exe_file=str(model.exe_file),
+                cpp_options=cpp_options,
+                stanc_options=stanc_options,
+                cmdstan=_cmdstan_version(),
+            )
+
+            # the info file marks a complete compilation
+            tmp_path = model_dir / f"{INFO_FILE_NAME}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(info, f, indent=4, default=str)
+            os.replace(tmp_path, info_path)
+
+        return model
+
+    @property
+    def cache_dir(self):
+        return self._cache_dir
@@ -1,7 +1,59 @@
+import hashlib
+import os
+
 import numpy as np
 from scipy.interpolate import interp1d
+from scipy.stats import norm
 import arviz as av
 import matplotlib.pyplot as plt
+import xarray as xr
+
+from gbmbkgpy.stan.data_writer import CmdStanJSONWriter
+from gbmbkgpy.stan.generated_quantities import run_generated_quantities
+from gbmbkgpy.stan.grainsize import (
+    GrainsizeCache,
+    autotune_grainsize,
+    grainsize_candidates,
+    grainsize_key,
+    heuristic_grainsize,
+)
+from gbmbkgpy.stan.model_cache import StanModelCache, stan_model_hash
+from gbmbkgpy.utils.statistics.streaming_quantiles import StreamingPercentiles
+
+
+def _cpp_options(cpp_options=None):
+    """
+    C++ compiler options of the models, default is a threaded model
+    """
+    if cpp_options is None:
+        return {"STAN_THREADS": "TRUE"}
+
+    return cpp_options
+
+
+def _gp_num_basis(gp_basis, gp_num_basis=None):
+    """
+    Number of frequencies ("precomputed", default 10) or basis functions
+    ("hsgp", default 40) of the CR GP
+    """
+    if gp_num_basis is None:
+        return 40 if gp_basis == "hsgp" else 10
+
+    return gp_num_basis
+
+
+def gp_basis_frequencies(num_basis):
+    """
+    Frequencies of the precomputed CR GP basis, the quantiles of a
+    half-normal at the centers of num_basis equal intervals. They are
+    positive and distinct, so the cos and sin columns of the basis are
+    independent, and the model does not depend on the seed of a run.
+    :param num_basis: number of frequencies
+    :returns: array with the frequencies
+    """
+    quantiles = 0.5 + 0.5 * (np.arange(num_basis) + 0.5) / num_basis
+
+    return norm.ppf(quantiles)
 
 
 class StanModelConstructor(object):
@@ -9,7 +61,27 @@ class StanModelConstructor(object):
     Object to construct the .stan model
     """
 
-    def __init__(self, model_generator, profile=False, cgb_beuermann3=False, cr_per_det=False, use_cr_eff_area_corr=True, free_n1=True, uncert_on_cr=False, use_cr_gp=False, use_only_cr_gp=False,gp_ordered=False,move_all_to_parallel=True, not_sample_freq=True, share_omega=True):
+    def __init__(self, model_generator, profile=False, cgb_beuermann3=False, cr_per_det=False, use_cr_eff_area_corr=True, free_n1=True, uncert_on_cr=False, use_cr_gp=False, use_only_cr_gp=False,gp_ordered=False,move_all_to_parallel=True, not_sample_freq=True, share_omega=True, block_layout=False, gp_basis=None, gp_num_basis=None, gp_boundary_factor=3.0):
+        """
+        :param block_layout: generate the likelihood per (detector, echan) block,
+        with one matrix-vector product per block for the fixed, continuum and
+        free spectrum sources instead of the flattened counts with index
+        arithmetic. The data must be constructed with
+        StanDataConstructor(block_layout=True).
+        :param gp_basis: basis of the CR GP of use_only_cr_gp (with
+        move_all_to_parallel). None recomputes the random Fourier features in
+        the likelihood, "precomputed" keeps the cos/sin basis of the fixed
+        frequencies in the transformed data (needs not_sample_freq) and "hsgp"
+        uses a Hilbert space approximation of a squared exponential GP. In both
+        cases the GP is contracted once per gradient and the likelihood has no
+        trigonometric calls.
+        :param gp_num_basis: number of frequencies ("precomputed", default 10)
+        or basis functions ("hsgp", default 40). The frequencies of the
+        precomputed basis are data, see StanDataConstructor(gp_basis=...)
+        :param gp_boundary_factor: boundary of the hsgp basis in units of the
+        half range of the (normalized) time. The number of basis functions and
+        the boundary factor bound the lengthscales the hsgp can describe.
+        """
 
         self._profile = profile
         self._cgb_beuermann3 = cgb_beuermann3
@@ -24,6 +96,22 @@ class StanModelConstructor(object):
         self._move_all_to_parallel=move_all_to_parallel
         self._not_sample_freq=not_sample_freq
         self._share_omega=share_omega
+        self._block_layout = block_layout
+        gp_num_basis = _gp_num_basis(gp_basis, gp_num_basis)
+
+        self._gp_basis = gp_basis
+        self._gp_num_basis = gp_num_basis
+        self._gp_boundary_factor = gp_boundary_factor
+
+        assert gp_basis in (None, "precomputed", "hsgp"), "gp_basis must be None, 'precomputed' or 'hsgp'"
+        if gp_basis is not None:
+            assert use_only_cr_gp and move_all_to_parallel, "gp_basis needs use_only_cr_gp and move_all_to_parallel"
+            assert not cr_per_det, "gp_basis is not supported with cr_per_det"
+            assert gp_num_basis > 0, "gp_num_basis must be positive"
+        if gp_basis == "precomputed":
+            assert not_sample_freq, "The precomputed basis needs fixed frequencies (not_sample_freq)"
+        if gp_basis == "hsgp":
+            assert gp_boundary_factor > 1, "gp_boundary_factor must be larger than 1"
         assert not (self._uncert_on_cr and self._use_cr_gp), "No"
         assert not (self._uncert_on_cr and self._use_only_cr_gp), "No"
         assert not (self._use_only_cr_gp and self._use_cr_gp), "No"
@@ -97,6 +185,23 @@ class StanModelConstructor(object):
         else:
             self._use_free_ps = False
 
+        # number of free spectrum sources, they share one response matrix
+        # per block in the block layout
+        self._num_free_comp = (
+            int(self._use_free_earth)
+            + int(self._use_free_cgb)
+            + int(self._use_sun)
+            + self._num_free_ps
+        )
+
+        if self._block_layout:
+            assert not (
+                self._use_cr_gp or self._use_only_cr_gp or self._uncert_on_cr
+            ), "The block layout does not support the CR GP or CR uncertainty terms"
+            assert (
+                not self._use_cont_sources or self._cr_per_det
+            ), "The block layout needs cr_per_det=True for the continuum sources"
+
     def source_count(self):
 
         return dict(
@@ -109,32 +214,112 @@ class StanModelConstructor(object):
             num_fixed_global_sources=self._num_fixed_global_sources,
         )
 
-    def create_stan_file(self, save_path, total_only=False):
-
-        if not total_only:
-            text = (
-                self.function_block()
-                + self.data_block()
-                + self.trans_data_block()
-                + self.parameter_block()
-                + self.trans_parameter_block()
-                + self.model_block()
-                + self.generated_block()
-            )
+    def stan_code(self, total_only=False, sampling_only=False):
+        """
+        Text of the generated .stan model
+        :param total_only: only generate the total counts in the generated quantities
+        :param sampling_only: no generated quantities, they are generated
+        afterwards with generate_quantities
+        :returns: stan code
+        """
+        if sampling_only:
+            generated = ""
+        elif not total_only:
+            generated = self.generated_block()
         else:
-            text = (
-                self.function_block()
-                + self.data_block()
-                + self.trans_data_block()
-                + self.parameter_block()
-                + self.trans_parameter_block()
-                + self.model_block()
-                + self.generated_block_total_only()
-            )
+            generated = self.generated_block_total_only()
+
+        return (
+            self.function_block()
+            + self.data_block()
+            + self.trans_data_block()
+            + self.parameter_block()
+            + self.trans_parameter_block()
+            + self.model_block()
+            + generated
+        )
+
+    def model_hash(self, cpp_options=None, stanc_options=None, include_paths=None, total_only=False, sampling_only=False):
+        """
+        Hash of the generated stan code and the compiler options. Two configs
+        with the same hash result in the same compiled model.
+        :param cpp_options: dict with the C++ compiler options, default
+        STAN_THREADS
+        :param stanc_options: dict with the stanc options
+        :param include_paths: list of directories with the included .stan files,
+        default is the current working directory
+        :param total_only: only generate the total counts in the generated quantities
+        :param sampling_only: no generated quantities
+        :returns: hex digest of the hash
+        """
+        return stan_model_hash(
+            self.stan_code(total_only=total_only, sampling_only=sampling_only),
+            cpp_options=_cpp_options(cpp_options),
+            stanc_options=stanc_options,
+            include_paths=include_paths,
+        )
+
+    def create_stan_file(self, save_path, total_only=False, sampling_only=False):
 
         with open(save_path, "w") as f:
-            f.write(text)
-            
+            f.write(self.stan_code(total_only=total_only, sampling_only=sampling_only))
+
+    def compiled_model(self, cpp_options=None, stanc_options=None, include_paths=None, total_only=False, cache_dir=None, sampling_only=False):
+        """
+        Get the compiled CmdStanModel of the generated stan code. The model
+        is taken from the compiled model store ($GBMDATA/stan_models) and only
+        compiled if the store has no model with the same hash yet.
+        :param cpp_options: dict with the C++ compiler options, default
+        STAN_THREADS
+        :param stanc_options: dict with the stanc options
+        :param include_paths: list of directories with the included .stan files,
+        default is the current working directory
+        :param total_only: only generate the total counts in the generated quantities
+        :param cache_dir: directory of the store, default $GBMDATA/stan_models
+        :param sampling_only: no generated quantities
+        :returns: CmdStanModel
+        """
+        return StanModelCache(cache_dir=cache_dir).get_model(
+            self.stan_code(total_only=total_only, sampling_only=sampling_only),
+            cpp_options=_cpp_options(cpp_options),
+            stanc_options=stanc_options,
+            include_paths=include_paths,
+        )
+
+    def generate_quantities(self, fit, data, thin=None, num_draws=None, seed=None, output_dir=None, cpp_options=None, stanc_options=None, include_paths=None, cache_dir=None):
+        """
+        Generate the predictions of all sources and the ppc for the draws of a
+        fit of the model with sampling_only=True (or total_only=True) in a
+        standalone pass of the full model. Only the thinned draws are written,
+        the result can be passed to StanDataExporter.from_generated_quantities.
+        :param fit: CmdStanMCMC or list of Stan CSV files of the fit
+        :param data: data of the fit, dict or path of a json file
+        :param thin: use every thin-th draw
+        :param num_draws: use about num_draws draws in total, overrides thin
+        :param seed: seed of the ppc, default is the seed of the fit, so
+        random numbers in the transformed data are the same as in the fit
+        :param output_dir: directory of the thinned draws and the output
+        :param cpp_options: dict with the C++ compiler options, default
+        STAN_THREADS
+        :returns: CmdStanGQ
+        """
+        model = self.compiled_model(
+            cpp_options=cpp_options,
+            stanc_options=stanc_options,
+            include_paths=include_paths,
+            cache_dir=cache_dir,
+        )
+
+        return run_generated_quantities(
+            model,
+            data,
+            fit,
+            thin=thin,
+            num_draws=num_draws,
+            seed=seed,
+            output_dir=output_dir,
+        )
+
     def function_block(self):
         text = "functions { \n"
         text += "\t#include powerlaw.stan\n"
@@ -169,7 +354,11 @@ class StanModelConstructor(object):
         if self._use_cont_sources:
             if self._use_cr_eff_area_corr:
                 main += "\t, vector cr_eff_area_array\n"
-            if self._use_only_cr_gp:
+            if self._use_only_cr_gp and self._gp_basis is not None:
+                main += "\t, vector[] cr_gp_counts\n"
+                main += "\t, int[] time_ids\n"
+                main += "\t, int[] echans\n"
+            elif self._use_only_cr_gp:
                 if self._move_all_to_parallel:
                     main += "\t, vector[] beta1\n"
                     main += "\t, vector[] beta2\n"
@@ -206,7 +395,13 @@ class StanModelConstructor(object):
         #if self._profile:                                                                                
         #    main += "\t\tprofile(\"loglike\"){\n"
 
-        if self._move_all_to_parallel:
+        if self._move_all_to_parallel and self._gp_basis is not None:
+            # the GP counts per echan and time bin are calculated in the model block
+            main += "\t\tvector[stop-start+1] cr_comp;\n"
+            main += "\t\tfor (i in start:stop){\n"
+            main += "\t\t\tcr_comp[i-start+1] = cr_gp_counts[echans[i], time_ids[i]];\n"
+            main += "\t\t}\n"
+        elif self._move_all_to_parallel:
             main += "\t\tint j;\n"
             main += "\t\tint t;\n"
             if not self._not_sample_freq:
@@ -302,7 +497,10 @@ class StanModelConstructor(object):
         main += "\t}\n"
 
 
-        text = text + main
+        if self._block_layout:
+            text = text + self._block_partial_sum()
+        else:
+            text = text + main
 
         text += "\treal beuermann3(real E, real Enorm, real norm_ref, real norm, real index1, real index2, real index3, real Eb1, real Eb2, real n1, real n2){\n"
         text += "\t\treal C=norm*norm_ref*pow(pow(pow(Eb1, -index1)*pow(pow(Enorm/Eb1, n1*index1)+pow(Enorm/Eb1, n1*index2), -1/n1), -n2)+pow(pow(Eb1, -index1)*pow(pow(Eb2/Eb1, n1*index1)+pow(Eb2/Eb1, n1*index2), -1/n1)*pow(Enorm/Eb2, -index3), -n2),1/n2);\n"
@@ -319,6 +517,9 @@ class StanModelConstructor(object):
         return text
 
     def data_block(self):
+        if self._block_layout:
+            return self._block_data_block()
+
         # Start
         text = "data { \n"
         # This we need always:
@@ -371,11 +572,17 @@ class StanModelConstructor(object):
         if self._use_free_earth:
             text += "\tmatrix[num_echans*num_dets*num_time_bins, rsp_num_Ein] base_response_array_earth;\n"
 
+        if self._gp_basis == "precomputed":
+            text += f"\trow_vector[{self._gp_num_basis}] gp_omega;\n"
+
         # Close
         text = text + "}\n\n"
         return text
 
     def trans_data_block(self):
+        if self._block_layout:
+            return self._block_trans_data_block()
+
         text = "transformed data { \n"
 
         text += "\tint num_data_points = num_time_bins*num_dets*num_echans;\n"
@@ -395,7 +602,9 @@ class StanModelConstructor(object):
                 "\t\t\t}\n\t\t}\n\t}\n"
             )
 
-        if self._use_cr_gp or self._use_only_cr_gp:
+        if self._gp_basis is not None:
+            text += self._gp_basis_trans_data()
+        elif self._use_cr_gp or self._use_only_cr_gp:
             text += "\tint kn=10;\n"
             text += "\tvector[num_time_bins] norm_mean_time = ((time_bins[:,2]+time_bins[:,1])/2.0-time_bins[1,1])/(time_bins[num_time_bins,2]-time_bins[1,1]);\n"
             text += "\tvector[num_time_bins] time_bin_width = (time_bins[:,2]-time_bins[:,1]);\n"
@@ -454,6 +663,9 @@ class StanModelConstructor(object):
                     text += "\tvector<lower=0>[num_echans] raw_scale;\n"
                     text += "\tvector<lower=0, upper=1>[num_echans] range1_raw;\n"
 
+                elif self._use_only_cr_gp and self._gp_basis is not None:
+                    text += self._gp_basis_parameters()
+
                 elif self._use_only_cr_gp:
                     text += "\tvector[kn] beta1[num_echans]; // the amplitude along the cos basis\n"
                     text += "\tvector[kn] beta2[num_echans]; // the amplitude along the sin basis\n"
@@ -586,12 +798,16 @@ class StanModelConstructor(object):
         if self._use_saa:
             text += "\treal norm_saa[num_saa_exits,num_dets_saa, num_echans]=exp(log_norm_saa);\n"
 
-            text += "\tvector[num_data_points] saa_decay_vec[num_saa_exits];\n"
-            text += "\tvector[num_data_points] saa_norm_vec[num_saa_exits];\n"
+            if not self._block_layout:
+                text += "\tvector[num_data_points] saa_decay_vec[num_saa_exits];\n"
+                text += "\tvector[num_data_points] saa_norm_vec[num_saa_exits];\n"
 
         if self._use_cont_sources:
             if self._use_cr_eff_area_corr:
-                text += "\tvector[num_data_points] cr_eff_area_array;\n"
+                if self._block_layout:
+                    text += "\tvector[num_dets] cr_eff_area_det;\n"
+                else:
+                    text += "\tvector[num_data_points] cr_eff_area_array;\n"
             if self._cr_per_det:
                 text += "\treal norm_cont[num_cont_comp, num_dets, num_echans] = pow(10,log_norm_cont);\n"
             else:
@@ -603,7 +819,7 @@ class StanModelConstructor(object):
             if self._use_only_cr_gp:
                 if not self._move_all_to_parallel:
                     text += "\tvector[num_data_points] norm_cont_vec;\n"
-            else:
+            elif not self._block_layout:
                 text += "\tvector[num_data_points] norm_cont_vec[num_cont_comp];\n"
 
         if self._use_free_earth:
@@ -664,9 +880,21 @@ class StanModelConstructor(object):
             text += "\tvector[rsp_num_Ein] sun_spec;\n"
 
         if self._use_eff_area_correction:
-            text += "\tvector[num_data_points] eff_area_array;\n"
-
-        if self._use_cr_gp or self._use_only_cr_gp:
+            if self._block_layout:
+                text += "\tvector[num_dets] eff_area_det;\n"
+            else:
+                text += "\tvector[num_data_points] eff_area_array;\n"
+
+        if self._block_layout:
+            if self._use_fixed_global_sources or self._use_cont_sources:
+                text += "\tvector[num_base_comp] base_norm[num_blocks];\n"
+            if self._num_free_comp > 0:
+                text += "\tvector[num_free_comp*rsp_num_Ein] free_spec;\n"
+
+        if self._gp_basis is not None:
+            if self._gp_basis == "precomputed":
+                text += "\tvector[num_echans] scale1 = raw_scale*inv_sqrt(kn);\n"
+        elif self._use_cr_gp or self._use_only_cr_gp:
             text += "\tvector[num_echans] scale1 = raw_scale*inv_sqrt(kn);\n"
 
             if not self._not_sample_freq:
@@ -696,7 +924,7 @@ class StanModelConstructor(object):
         #    "\t\t\t}\n\t\t}\n\t}\n"
         #)
         
-        if self._use_cont_sources:
+        if self._use_cont_sources and not self._block_layout:
             if self._cr_per_det:
                 text += (
                     "\tfor (l in 1:num_cont_comp){\n"
@@ -772,7 +1000,7 @@ class StanModelConstructor(object):
                             "\t\t\t\t\tnorm_cont_vec[(k-1)*(num_dets*num_echans)+(i-1)*num_echans+j] = exp(expected_counts_log[j,k]);\n"
                             "\t\t\t}\n\t\t}\n\t}\n"
                         )
-                    elif not self._not_sample_freq:
+                    elif not self._not_sample_freq and self._gp_basis is None:
                         if self._share_omega:
                             text += "\t\tomega_var_row=to_row_vector(omega_var);\n"
                         else:
@@ -792,7 +1020,7 @@ class StanModelConstructor(object):
                     )
                 
 
-        if self._use_saa:
+        if self._use_saa and not self._block_layout:
                 
             text += (
                 "\tfor (l in 1:num_saa_exits){\n"
@@ -1118,7 +1346,7 @@ class StanModelConstructor(object):
                 #"\t}\n"
                         #)
 
-        if self._use_eff_area_correction:
+        if self._use_eff_area_correction and not self._block_layout:
             text += (
                 "\tfor (i in 1:num_dets){\n"
                 "\t\tfor (k in 1:num_time_bins){\n"
@@ -1132,6 +1360,8 @@ class StanModelConstructor(object):
                 "\t}\n"
             )
 
+        if self._block_layout:
+            text += self._block_trans_parameters()
             
         if self._profile:
             text += "\t}\n"
@@ -1300,6 +1530,9 @@ class StanModelConstructor(object):
                         "\t}\n"
                         )
 
+                elif self._use_only_cr_gp and self._gp_basis is not None:
+                    text += self._gp_basis_priors()
+
                 elif self._use_only_cr_gp:
                     if self._not_sample_freq:
                         text += (
@@ -1368,6 +1601,14 @@ class StanModelConstructor(object):
         if self._profile:
             text += "\t}\n"
             text += "\tprofile(\"reduce_sum\"){\n"
+
+        if self._gp_basis is not None:
+            text += (
+                "\tvector[num_time_bins] cr_gp_counts[num_echans];\n"
+                "\tfor (j in 1:num_echans){\n"
+                f"\t\tcr_gp_counts[j] = (exp({self._gp_basis_log_rate()})+pow(10,cr_log_const[j])).*time_bin_width;\n"
+                "\t}\n"
+            )
         
         # Reduce sum call
         main = "\ttarget += reduce_sum(partial_sum_lpmf, counts, grainsize\n"
@@ -1390,7 +1631,9 @@ class StanModelConstructor(object):
         if self._use_cont_sources:
             if self._use_cr_eff_area_corr:
                 main += "\t\t, cr_eff_area_array\n"
-            if self._use_only_cr_gp:
+            if self._use_only_cr_gp and self._gp_basis is not None:
+                main += "\t\t, cr_gp_counts, time_ids, echans\n"
+            elif self._use_only_cr_gp:
                 if self._move_all_to_parallel:
                     main += "\t\t, beta1\n"
                     main += "\t\t, beta2\n"
@@ -1421,12 +1664,17 @@ class StanModelConstructor(object):
         #main += "\t\t, phi\n"
         #main += "\t\t, 4000\n"
         main += "\t);\n"
+        if self._block_layout:
+            main = self._block_reduce_sum()
         if self._profile:
             main += "\t}\n" 
         text = text + main + "}\n\n"
         return text
 
     def generated_block(self):
+        if self._block_layout:
+            return self._block_generated_block()
+
         text = "generated quantities { \n"
 
         text += "\tint ppc[num_data_points];\n"
@@ -1441,14 +1689,17 @@ class StanModelConstructor(object):
                 if self._move_all_to_parallel:
                     text += "\tvector[num_data_points] norm_cont_vec;\n"
                     text += "\tvector[num_time_bins] expected_counts_log[num_echans];\n"
-                    text += "\tmatrix[num_time_bins,kn] tw1[num_echans];\n"
-                    if not self._not_sample_freq:
-                        if self._share_omega:
-                            text += "\trow_vector[kn] omega1;\n"
-                        else:
-                            text += "\trow_vector[kn] omega1[num_echans];\n"
-                    else:
+                    if self._gp_basis == "precomputed":
                         text += "\trow_vector[kn] omegas = omega1;\n"
+                    elif self._gp_basis is None:
+                        text += "\tmatrix[num_time_bins,kn] tw1[num_echans];\n"
+                        if not self._not_sample_freq:
+                            if self._share_omega:
+                                text += "\trow_vector[kn] omega1;\n"
+                            else:
+                                text += "\trow_vector[kn] omega1[num_echans];\n"
+                        else:
+                            text += "\trow_vector[kn] omegas = omega1;\n"
 
                 text += "\tvector[num_data_points] f_cont;\n"
             else:
@@ -1483,7 +1734,9 @@ class StanModelConstructor(object):
                         text += (
                             "\tfor (j in 1:num_echans){\n"
                         )
-                        if not self._not_sample_freq:
+                        if self._gp_basis is not None:
+                            text += f"\t\texpected_counts_log[j] = {self._gp_basis_log_rate()};\n"
+                        elif not self._not_sample_freq:
                             if self._gp_ordered:
                                 if self._share_omega:
                                     text += "\t\tomega1=to_row_vector(omega_var) * bw[j];\n"
@@ -1500,9 +1753,9 @@ class StanModelConstructor(object):
                                 text += "\t\ttw1[j]=norm_mean_time * omega1[j];\n"
                         else:
                             text += "\t\ttw1[j]=norm_mean_time * omega1;\n"
+                        if self._gp_basis is None:
+                            text += "\t\texpected_counts_log[j] = (scale1[j] * cos(tw1[j])* beta1[j]) + (scale1[j] * sin(tw1[j]) * beta2[j]);\n"
                         text += (
-
-                            "\t\texpected_counts_log[j] = (scale1[j] * cos(tw1[j])* beta1[j]) + (scale1[j] * sin(tw1[j]) * beta2[j]);\n"
                             "\t\tfor (k in 1:num_time_bins){\n"
                             "\t\t\tfor (i in 1:num_dets){\n"
                             "\t\t\t\t\tnorm_cont_vec[(k-1)*(num_dets*num_echans)+(i-1)*num_echans+j] = (exp(expected_counts_log[j,k])+pow(10,cr_log_const[j]))*time_bin_width[k];\n"
@@ -1606,6 +1859,394 @@ class StanModelConstructor(object):
         text = text + "}\n\n"
         return text
 
+    def _block_partial_sum(self):
+        """
+        Partial sum over (det, echan) blocks. Block b belongs to detector
+        (b-1)/num_echans+1 and echan (b-1)%num_echans+1, the counts of one block
+        are the counts of all time bins.
+        """
+        text = "\treal partial_block_lpmf(int[,] counts, int start, int stop, int num_time_bins, int num_echans\n"
+
+        if self._use_fixed_global_sources or self._use_cont_sources:
+            text += "\t, matrix[] base_counts_block, vector[] base_norm\n"
+
+        if self._num_free_comp > 0:
+            text += "\t, matrix[] base_response_block, vector free_spec\n"
+
+        if self._use_eff_area_correction:
+            text += "\t, vector eff_area_det\n"
+
+        if self._use_saa:
+            text += "\t, matrix[] t_t0, real[,,] norm_saa, real[,,] decay_saa, int[] dets_saa, int[] dets_saa_all_dets, int num_saa_exits\n"
+
+        text += "\t){\n"
+        text += "\t\treal lp = 0;\n"
+        text += "\t\tfor (b in start:stop){\n"
+        text += "\t\t\tint i = (b-1) %/% num_echans + 1;\n"
+        text += "\t\t\tint j = (b-1) % num_echans + 1;\n"
+        text += "\t\t\tvector[num_time_bins] mu = rep_vector(0.0, num_time_bins);\n"
+
+        # one matrix-vector product for all fixed and continuum sources
+        if self._use_fixed_global_sources or self._use_cont_sources:
+            text += "\t\t\tmu += base_counts_block[b]*base_norm[b];\n"
+
+        # and one for all free spectrum sources
+        if self._num_free_comp > 0:
+            if self._use_eff_area_correction:
+                text += "\t\t\tmu += eff_area_det[i]*(base_response_block[b]*free_spec);\n"
+            else:
+                text += "\t\t\tmu += base_response_block[b]*free_spec;\n"
+
+        if self._use_saa:
+            text += (
+                "\t\t\tif (dets_saa[i]){\n"
+                "\t\t\t\tfor (e in 1:num_saa_exits){\n"
+                "\t\t\t\t\treal decay = 0.0001*decay_saa[e, dets_saa_all_dets[i], j];\n"
+                "\t\t\t\t\tmu += norm_saa[e, dets_saa_all_dets[i], j]/decay*(exp(-t_t0[e,:,1]*decay)-exp(-t_t0[e,:,2]*decay));\n"
+                "\t\t\t\t}\n"
+                "\t\t\t}\n"
+            )
+
+        text += "\t\t\tlp += poisson_lupmf(counts[b-start+1] | mu);\n"
+        text += "\t\t}\n"
+        text += "\t\treturn lp;\n"
+        text += "\t}\n"
+
+        return text
+
+    def _block_data_block(self):
+        text = "data { \n"
+        text += "\tint<lower=1> num_time_bins;\n"
+        text += "\tint<lower=1> num_dets;\n"
+        text += "\tint<lower=1> num_echans;\n"
+
+        text += "\tint<lower=1> rsp_num_Ein;\n"
+        text += "\tvector[rsp_num_Ein] Ebins_in[2];\n"
+
+        text += "\tint<lower=1> grainsize;\n"
+        text += "\tmatrix[num_time_bins, 2] time_bins;\n"
+
+        text += "\tint counts[num_dets*num_echans, num_time_bins];\n"
+        text += "\treal Rmin[num_echans];\n"
+
+        if self._use_fixed_global_sources:
+            text += "\tint<lower=0> num_fixed_comp;\n"
+            text += "\tvector[num_fixed_comp] mu_norm_fixed;\n"
+            text += "\tvector[num_fixed_comp] sigma_norm_fixed;\n"
+
+        if self._use_cont_sources:
+            text += "\tint num_cont_comp;\n"
+            text += "\treal mu_norm_cont[num_cont_comp, num_dets, num_echans];\n"
+            text += "\treal sigma_norm_cont[num_cont_comp, num_dets, num_echans];\n"
+
+        if self._use_fixed_global_sources or self._use_cont_sources:
+            # fixed sources first, then the continuum sources
+            text += "\tint<lower=1> num_base_comp;\n"
+            text += "\tmatrix[num_time_bins, num_base_comp] base_counts_block[num_dets*num_echans];\n"
+
+        if self._use_saa:
+            text += "\tint num_saa_exits;\n"
+            text += "\tvector[num_saa_exits] saa_start_times;\n"
+            text += "\treal mu_norm_saa[num_saa_exits, num_dets, num_echans];\n"
+            text += "\treal sigma_norm_saa[num_saa_exits, num_dets, num_echans];\n"
+            text += "\treal mu_decay_saa[num_saa_exits, num_dets, num_echans];\n"
+            text += "\treal sigma_decay_saa[num_saa_exits, num_dets, num_echans];\n"
+
+            text += "\tint dets_saa[num_dets];\n"
+            text += "\tint num_dets_saa;\n"
+            text += "\tint dets_saa_all_dets[num_dets];\n"
+
+        if self._use_free_ps:
+            text += "\tint num_free_ps_comp;\n"
+
+        if self._num_free_comp > 0:
+            # responses of earth, cgb, sun and the free point sources side by side
+            text += "\tint<lower=1> num_free_comp;\n"
+            text += "\tmatrix[num_time_bins, num_free_comp*rsp_num_Ein] base_response_block[num_dets*num_echans];\n"
+
+        text = text + "}\n\n"
+        return text
+
+    def _block_trans_data_block(self):
+        text = "transformed data { \n"
+
+        text += "\tint num_blocks = num_dets*num_echans;\n"
+        text += "\tint num_data_points = num_time_bins*num_blocks;\n"
+
+        if self._use_saa:
+            # only depends on the time, the same for all blocks
+            text += "\tmatrix[num_time_bins,2] t_t0[num_saa_exits];\n"
+            text += (
+                "\tfor (j in 1:num_saa_exits){\n"
+                "\t\tfor (i in 1:num_time_bins){\n"
+                "\t\t\tif (time_bins[i,1]>saa_start_times[j]){\n"
+                "\t\t\t\tt_t0[j,i] = time_bins[i]-saa_start_times[j];\n"
+                "\t\t\t}\n"
+                "\t\t\telse {\n"
+                "\t\t\t\tt_t0[j,i] = rep_row_vector(0.0, 2);\n"
+                "\t\t\t}\n\t\t}\n\t}\n"
+            )
+
+        text = text + "}\n\n"
+        return text
+
+    def _block_trans_parameters(self):
+        """
+        Norms of the base sources per block and the spectrum of all free
+        spectrum sources
+        """
+        text = ""
+
+        if self._use_eff_area_correction:
+            text += "\teff_area_det[1] = 1;\n"
+            text += "\teff_area_det[2:num_dets] = to_vector(eff_area_corr);\n"
+
+        if self._use_cont_sources and self._use_cr_eff_area_corr:
+            text += "\tcr_eff_area_det[1] = 1;\n"
+            text += "\tcr_eff_area_det[2:num_dets] = to_vector(cr_eff_area_corr);\n"
+
+        if self._use_fixed_global_sources or self._use_cont_sources:
+            text += "\tfor (i in 1:num_dets){\n"
+            text += "\t\tfor (j in 1:num_echans){\n"
+            text += "\t\t\tint b = (i-1)*num_echans+j;\n"
+
+            if self._use_fixed_global_sources:
+                if self._use_eff_area_correction:
+                    text += "\t\t\tbase_norm[b,1:num_fixed_comp] = eff_area_det[i]*to_vector(norm_fixed);\n"
+                else:
+                    text += "\t\t\tbase_norm[b,1:num_fixed_comp] = to_vector(norm_fixed);\n"
+                offset = "num_fixed_comp+"
+            else:
+                offset = ""
+
+            if self._use_cont_sources:
+                text += "\t\t\tfor (l in 1:num_cont_comp){\n"
+                if self._use_cr_eff_area_corr:
+                    text += f"\t\t\t\tbase_norm[b,{offset}l] = cr_eff_area_det[i]*norm_cont[l,i,j];\n"
+                else:
+                    text += f"\t\t\t\tbase_norm[b,{offset}l] = norm_cont[l,i,j];\n"
+                text += "\t\t\t}\n"
+
+            text += "\t\t}\n\t}\n"
+
+        if self._num_free_comp > 0:
+            for k, spec in enumerate(self._block_free_spectra()):
+                text += f"\tfree_spec[{k}*rsp_num_Ein+1:{k+1}*rsp_num_Ein] = {spec};\n"
+
+        return text
+
+    def _block_free_spectra(self):
+        """
+        Spectra of the free spectrum sources in the order of the columns
+        of base_response_block
+        """
+        spectra = []
+        if self._use_free_earth:
+            spectra.append("earth_spec")
+        if self._use_free_cgb:
+            spectra.append("cgb_spec")
+        if self._use_sun:
+            spectra.append("sun_spec")
+        for i in range(self._num_free_ps):
+            spectra.append(f"ps_spec[{i+1}]")
+        return spectra
+
+    def _block_reduce_sum(self):
+        main = "\ttarget += reduce_sum(partial_block_lpmf, counts, grainsize, num_time_bins, num_echans\n"
+
+        if self._use_fixed_global_sources or self._use_cont_sources:
+            main += "\t\t, base_counts_block, base_norm\n"
+
+        if self._num_free_comp > 0:
+            main += "\t\t, base_response_block, free_spec\n"
+
+        if self._use_eff_area_correction:
+            main += "\t\t, eff_area_det\n"
+
+        if self._use_saa:
+            main += "\t\t, t_t0, norm_saa, decay_saa, dets_saa, dets_saa_all_dets, num_saa_exits\n"
+
+        main += "\t);\n"
+        return main
+
+    def _block_generated_block(self, total_only=False):
+        """
+        Generated quantities in the block layout, all arrays have the
+        shape (num_blocks, num_time_bins)
+        """
+        text = "generated quantities { \n"
+
+        text += "\tint ppc[num_blocks, num_time_bins];\n"
+        text += "\tvector[num_time_bins] tot[num_blocks];\n"
+
+        if not total_only:
+            if self._use_saa:
+                text += "\tvector[num_time_bins] f_saa[num_blocks];\n"
+            if self._use_cont_sources:
+                text += "\tvector[num_time_bins] f_cont[num_cont_comp, num_blocks];\n"
+            if self._use_fixed_global_sources:
+                text += "\tvector[num_time_bins] f_fixed_global[num_fixed_comp, num_blocks];\n"
+            if self._use_free_earth:
+                text += "\tvector[num_time_bins] f_earth[num_blocks];\n"
+            if self._use_free_cgb:
+                text += "\tvector[num_time_bins] f_cgb[num_blocks];\n"
+            if self._use_sun:
+                text += "\tvector[num_time_bins] f_sun[num_blocks];\n"
+            if self._use_free_ps:
+                text += "\tvector[num_time_bins] f_free_ps[num_free_ps_comp, num_blocks];\n"
+
+        text += "\tfor (b in 1:num_blocks){\n"
+        text += "\t\tint i = (b-1) %/% num_echans + 1;\n"
+        text += "\t\tint j = (b-1) % num_echans + 1;\n"
+        text += "\t\ttot[b] = rep_vector(0.0, num_time_bins);\n"
+
+        if self._use_fixed_global_sources or self._use_cont_sources:
+            if total_only:
+                text += "\t\ttot[b] += base_counts_block[b]*base_norm[b];\n"
+            else:
+                if self._use_fixed_global_sources:
+                    text += (
+                        "\t\tfor (k in 1:num_fixed_comp){\n"
+                        "\t\t\tf_fixed_global[k,b] = base_counts_block[b,:,k]*base_norm[b,k];\n"
+                        "\t\t\ttot[b] += f_fixed_global[k,b];\n"
+                        "\t\t}\n"
+                    )
+                if self._use_cont_sources:
+                    offset = "num_fixed_comp+" if self._use_fixed_global_sources else ""
+                    text += (
+                        "\t\tfor (l in 1:num_cont_comp){\n"
+                        f"\t\t\tf_cont[l,b] = base_counts_block[b,:,{offset}l]*base_norm[b,{offset}l];\n"
+                        "\t\t\ttot[b] += f_cont[l,b];\n"
+                        "\t\t}\n"
+                    )
+
+        if self._num_free_comp > 0:
+            eff = "eff_area_det[i]*" if self._use_eff_area_correction else ""
+
+            if total_only:
+                text += f"\t\ttot[b] += {eff}(base_response_block[b]*free_spec);\n"
+            else:
+                names = []
+                if self._use_free_earth:
+                    names.append("f_earth[b]")
+                if self._use_free_cgb:
+                    names.append("f_cgb[b]")
+                if self._use_sun:
+                    names.append("f_sun[b]")
+                for i in range(self._num_free_ps):
+                    names.append(f"f_free_ps[{i+1},b]")
+
+                for k, (name, spec) in enumerate(zip(names, self._block_free_spectra())):
+                    text += (
+                        f"\t\t{name} = {eff}(base_response_block[b,:,{k}*rsp_num_Ein+1:{k+1}*rsp_num_Ein]*{spec});\n"
+                        f"\t\ttot[b] += {name};\n"
+                    )
+
+        if self._use_saa:
+            if not total_only:
+                text += "\t\tf_saa[b] = rep_vector(0.0, num_time_bins);\n"
+            target = "tot[b]" if total_only else "f_saa[b]"
+            text += (
+                "\t\tif (dets_saa[i]){\n"
+                "\t\t\tfor (e in 1:num_saa_exits){\n"
+                "\t\t\t\treal decay = 0.0001*decay_saa[e, dets_saa_all_dets[i], j];\n"
+                f"\t\t\t\t{target} += norm_saa[e, dets_saa_all_dets[i], j]/decay*(exp(-t_t0[e,:,1]*decay)-exp(-t_t0[e,:,2]*decay));\n"
+                "\t\t\t}\n"
+                "\t\t}\n"
+            )
+            if not total_only:
+                text += "\t\ttot[b] += f_saa[b];\n"
+
+        text += "\t\tppc[b] = poisson_rng(tot[b]);\n"
+        text += "\t}\n"
+
+        text = text + "}\n\n"
+        return text
+
+    def _gp_basis_trans_data(self):
+        """
+        Time grid of the CR GP and the basis that does not depend on the
+        parameters, computed once
+        """
+        text = f"\tint kn={self._gp_num_basis};\n"
+        text += "\tvector[num_time_bins] norm_mean_time = ((time_bins[:,2]+time_bins[:,1])/2.0-time_bins[1,1])/(time_bins[num_time_bins,2]-time_bins[1,1]);\n"
+        text += "\tvector[num_time_bins] time_bin_width = (time_bins[:,2]-time_bins[:,1]);\n"
+
+        if self._gp_basis == "precomputed":
+            text += "\trow_vector[kn] omega1 = gp_omega;\n"
+            text += "\tmatrix[num_time_bins,kn] gp_cos = cos(norm_mean_time * omega1);\n"
+            text += "\tmatrix[num_time_bins,kn] gp_sin = sin(norm_mean_time * omega1);\n"
+        else:
+            # eigenfunctions of the laplacian on [-L, L] around the center of the time range
+            text += f"\treal gp_L = {self._gp_boundary_factor}*0.5;\n"
+            text += "\tvector[kn] gp_sqrt_lambda;\n"
+            text += "\tmatrix[num_time_bins,kn] gp_phi;\n"
+            text += "\tfor (m in 1:kn){\n"
+            text += "\t\tgp_sqrt_lambda[m] = m*pi()/(2*gp_L);\n"
+            text += "\t\tgp_phi[:,m] = inv_sqrt(gp_L)*sin(gp_sqrt_lambda[m]*(norm_mean_time-0.5+gp_L));\n"
+            text += "\t}\n"
+
+        return text
+
+    def _gp_lengthscale_bounds(self):
+        """
+        Range of lengthscales (in units of the normalized time) that the hsgp
+        basis describes well. For a squared exponential kernel and the half
+        range S=0.5 of the time this needs m >= 1.75 c S / lengthscale and
+        c >= 3.2 lengthscale / S (Riutort-Mayol et al. 2020).
+        """
+        c = self._gp_boundary_factor
+
+        lower = 1.75 * c * 0.5 / self._gp_num_basis
+        upper = c * 0.5 / 3.2
+
+        assert lower < upper, "Too few basis functions for this boundary factor"
+
+        return round(lower, 4), round(upper, 4)
+
+    def _gp_basis_parameters(self):
+        text = "\tvector[kn] beta1[num_echans]; // the amplitude along the basis\n"
+
+        if self._gp_basis == "precomputed":
+            text += "\tvector[kn] beta2[num_echans]; // the amplitude along the sin basis\n"
+        else:
+            lower, upper = self._gp_lengthscale_bounds()
+            text += f"\tvector<lower={lower}, upper={upper}>[num_echans] gp_lengthscale;\n"
+
+        text += "\tvector<lower=0>[num_echans] raw_scale;\n"
+        text += "\tvector[num_echans] cr_log_const;\n"
+
+        return text
+
+    def _gp_basis_priors(self):
+        text = "\tfor (g in 1:num_echans){\n"
+        text += "\t\tbeta1[g] ~ std_normal();\n"
+        if self._gp_basis == "precomputed":
+            text += "\t\tbeta2[g] ~ std_normal();\n"
+        text += "\t}\n"
+
+        if self._gp_basis == "hsgp":
+            text += "\tgp_lengthscale ~ normal(0,0.2);\n"
+
+        text += "\traw_scale ~ normal(1,1);\n"
+        text += "\tcr_log_const ~ std_normal();\n"
+
+        return text
+
+    def _gp_basis_log_rate(self):
+        """
+        Log of the CR GP of echan j over all time bins, one matrix-vector
+        product with the basis
+        """
+        if self._gp_basis == "precomputed":
+            return "scale1[j]*(gp_cos*beta1[j]+gp_sin*beta2[j])"
+
+        # square root of the spectral density of the squared exponential kernel
+        return (
+            "gp_phi*(raw_scale[j]*sqrt(sqrt(2*pi())*gp_lengthscale[j])"
+            "*exp(-0.25*square(gp_lengthscale[j]*gp_sqrt_lambda)).*beta1[j])"
+        )
+
     def generated_quantities(self):
         keys = []
 
@@ -1633,11 +2274,14 @@ class StanModelConstructor(object):
         if self._use_saa:
             keys.append("f_saa")
 
-        if self._not_sample_freq:
+        if self._not_sample_freq and self._gp_basis != "hsgp":
             keys.append("omegas")
         return keys
 
     def generated_block_total_only(self):
+        if self._block_layout:
+            return self._block_generated_block(total_only=True)
+
         text = "generated quantities { \n"
 
         text += "\tint ppc[num_data_points];\n"
@@ -1690,6 +2334,30 @@ class StanModelConstructor(object):
         return text
 
 
+def _linear_interp_weights(x, xp):
+    """
+    Indices and weights for a linear interpolation at x between the
+    sorted points xp
+    :returns: lower indices, weights of the upper points
+    """
+    assert np.all(x >= xp[0]) and np.all(
+        x <= xp[-1]
+    ), "Time bins outside of the geometry times"
+
+    idx = np.clip(np.searchsorted(xp, x, side="right") - 1, 0, len(xp) - 2)
+    weights = (x - xp[idx]) / (xp[idx + 1] - xp[idx])
+
+    return idx, weights
+
+
+def _linear_interp(values, idx, weights):
+    """
+    Linear interpolation along the first axis of values
+    """
+    w = weights.reshape(-1, *([1] * (values.ndim - 1)))
+    return (1 - w) * values[idx] + w * values[idx + 1]
+
+
 class StanDataConstructor(object):
     """
     Object to construct the data dictionary for stan!
@@ -1703,9 +2371,30 @@ class StanDataConstructor(object):
         geometry=None,
         model_generator=None,
         threads_per_chain=1,
+        dtype=np.float64,
+        chunk_size=1000,
+        grainsize="heuristic",
+        block_layout=False,
+        gp_basis=None,
+        gp_num_basis=None,
     ):
         """
         Init with data, model, response and geometry object or model_generator object
+        :param threads_per_chain: number of threads per chain
+        :param grainsize: grainsize of reduce_sum, either an int, "heuristic" for
+        one slice of the data per thread or "auto" for the value found by
+        autotune_grainsize for this data shape and thread count (falls back to
+        the heuristic if there is none yet)
+        :param dtype: dtype of the response arrays of the free spectrum sources,
+        float32 halves the memory
+        :param chunk_size: number of time bins for which the responses are
+        calculated at once, this bounds the memory of the intermediate arrays
+        :param block_layout: construct the data for a model generated with
+        StanModelConstructor(block_layout=True), the counts and base arrays have
+        one block of all time bins per (detector, echan)
+        :param gp_basis: gp_basis of the StanModelConstructor, the frequencies
+        of the "precomputed" basis are added to the data
+        :param gp_num_basis: gp_num_basis of the StanModelConstructor
         """
 
         if model_generator is None:
@@ -1723,6 +2412,11 @@ class StanDataConstructor(object):
             
         self._threads = threads_per_chain
 
+        assert grainsize in ("heuristic", "auto") or (
+            isinstance(grainsize, int) and grainsize > 0
+        ), "grainsize must be a positive int, 'heuristic' or 'auto'"
+        self._grainsize = grainsize
+
         self._dets = self._data.detectors
         self._echans = self._data.echans
         self._total_time_bins = self._data.time_bins
@@ -1739,7 +2433,20 @@ class StanDataConstructor(object):
         self._nechans = len(self._echans)
         self._ntimebins = len(self._time_bins)
 
+        self._dtype = np.dtype(dtype)
+
+        assert chunk_size > 0, "chunk_size must be positive"
+        self._chunk_size = int(chunk_size)
+
+        self._used_time_bins = None
+
+        self._block_layout = block_layout
+
+        self._gp_basis = gp_basis
+        self._gp_num_basis = _gp_num_basis(gp_basis, gp_num_basis)
+
         self._param_lookup = []
+        self._sources_built = False
 
         self._global_param_names = None
         self._cont_param_names = None
@@ -1882,10 +2589,30 @@ class StanDataConstructor(object):
         self._mu_norm_cont = mu_norm_cont
         self._sigma_norm_cont = sigma_norm_cont
 
+    def _select_time_bins(self):
+        """
+        Select the time bins that are used in the stan model. The first and
+        last two bins and all bins without counts in all detectors and echans
+        are dropped.
+        """
+        if self._used_time_bins is not None:
+            return
+
+        counts = np.array(self._data.counts[self._source_mask][2:-2], dtype=int)
+
+        mask_zeros = np.sum(counts, axis=(1, 2)) != 0
+
+        self._mask_zeros = mask_zeros
+        self._counts = counts[mask_zeros]
+        self._used_time_bins = self._time_bins[2:-2][mask_zeros]
+
     def free_spectrum_sources(self):
         """
-        Free spectrum sources
+        Free spectrum sources. Only the effective responses are collected here,
+        the time integrated responses are built chunk wise when the data is
+        constructed or written.
         """
+        self._select_time_bins()
 
         s = self._model.fit_spectrum_sources
 
@@ -1898,163 +2625,191 @@ class StanDataConstructor(object):
 
         self._num_Ebins_in = len(self._Ebins_in[0])
 
-        self._base_response_array_earth = None
-        self._base_response_array_cgb = None
-        self._base_response_array_sun = None
-        self._base_response_array_ps = None
-
-        if len(s) == 0:
-            return None
-
-        base_response_array_earth = None
-        base_response_array_cgb = None
-        base_response_array_sun = None
-        base_rsp_ps_free = None
+        # stan data name -> effective responses of all sources with this name
+        self._free_spectrum_responses = {}
 
         for k in s.keys():
             rsp_detectors = s[k]._shape._effective_responses
-            ar = np.zeros(
-                (
-                    self._ndets,
-                    len(self._geometry.geometry_times),
-                    self._num_Ebins_in,
-                    self._nechans,
-                )
-            )
-            for i, det in enumerate(self._dets):
-                ar[i] = rsp_detectors[det]
+
             if k == "Earth occultation":
-                base_response_array_earth = ar
+                name = "base_response_array_earth"
             elif k == "cgb":
-                base_response_array_cgb = ar
+                name = "base_response_array_cgb"
             elif k == "sun":
-                base_response_array_sun = ar
+                name = "base_response_array_sun"
             else:
-                if base_rsp_ps_free is not None:
-                    base_rsp_ps_free = np.append(
-                        base_rsp_ps_free, np.array([ar]), axis=0
-                    )
-                else:
-                    base_rsp_ps_free = np.array([ar])
+                name = "base_response_array_free_ps"
 
-        if base_response_array_earth is not None:
+            self._free_spectrum_responses.setdefault(name, []).append(rsp_detectors)
 
-            eff_rsp_new_earth = interp1d(
-                self._geometry.geometry_times, base_response_array_earth, axis=1
-            )
+    def _response_shape(self, name):
+        """
+        Shape of the stan data array of the free spectrum responses
+        """
+        shape = (len(self._used_time_bins) * self._ndets * self._nechans, self._num_Ebins_in)
+
+        if name == "base_response_array_free_ps":
+            return (len(self._free_spectrum_responses[name]), *shape)
+
+        return shape
 
-            rsp_all_earth = np.swapaxes(
-                np.array(
-                    np.swapaxes(eff_rsp_new_earth(self._time_bin_edges), -1, -2),
-                    dtype=float,
+    def iter_response_chunks(self, rsp_detectors):
+        """
+        Time integrated responses of one free spectrum source, calculated in
+        chunks of time bins
+        :param rsp_detectors: dict with the effective responses of all detectors
+        at the geometry times with shape (n_geom_times, n_Ein, n_echans)
+        :returns: generator of (slice of the time bins, responses of the chunk
+        with shape (n_chunk_bins, n_dets, n_echans, n_Ein))
+        """
+        for chunk_slice, weights in self._iter_time_chunks():
+            chunk = np.empty(
+                (
+                    chunk_slice.stop - chunk_slice.start,
+                    self._ndets,
+                    self._nechans,
+                    self._num_Ebins_in,
                 ),
-                0,
-                1,
+                dtype=self._dtype,
             )
 
-            # Trapz integrate over time bins
-            base_response_array_earth = (
-                0.5
-                * (
-                    self._time_bins[:, 1, np.newaxis, np.newaxis, np.newaxis]
-                    - self._time_bins[:, 0, np.newaxis, np.newaxis, np.newaxis]
-                )
-                * (rsp_all_earth[:-1] + rsp_all_earth[1:])
-            )
+            for i, det in enumerate(self._dets):
+                chunk[:, i] = self._integrate_response(rsp_detectors[det], weights)
 
-            self._base_response_array_earth = base_response_array_earth[2:-2]
-            #.reshape(
-            #    -1, self._num_Ebins_in
-            #)
+            yield chunk_slice, chunk
 
-        if base_response_array_cgb is not None:
+    def _iter_time_chunks(self):
+        """
+        Interpolation weights of the bin starts and stops for chunks of
+        the used time bins
+        """
+        geometry_times = self._geometry.geometry_times
+        time_bins = self._used_time_bins
 
-            eff_rsp_new_cgb = interp1d(
-                self._geometry.geometry_times, base_response_array_cgb, axis=1
-            )
+        for start in range(0, len(time_bins), self._chunk_size):
+            stop = min(start + self._chunk_size, len(time_bins))
+            bins = time_bins[start:stop]
 
-            rsp_all_cgb = np.swapaxes(
-                np.array(
-                    np.swapaxes(eff_rsp_new_cgb(self._time_bin_edges), -1, -2),
-                    dtype=float,
-                ),
-                0,
-                1,
+            weights = (
+                _linear_interp_weights(bins[:, 0], geometry_times),
+                _linear_interp_weights(bins[:, 1], geometry_times),
+                0.5 * (bins[:, 1] - bins[:, 0])[:, np.newaxis, np.newaxis],
             )
 
-            # Trapz integrate over time bins
-            base_response_array_cgb = (
-                0.5
-                * (
-                    self._time_bins[:, 1, np.newaxis, np.newaxis, np.newaxis]
-                    - self._time_bins[:, 0, np.newaxis, np.newaxis, np.newaxis]
-                )
-                * (rsp_all_cgb[:-1] + rsp_all_cgb[1:])
-            )
+            yield slice(start, stop), weights
 
-            self._base_response_array_cgb = base_response_array_cgb[2:-2]
-            #.reshape(
-            #    -1, self._num_Ebins_in
-            #)
-            
-        if base_response_array_sun is not None:
+    def _integrate_response(self, rsp, weights):
+        """
+        Trapz integrate the effective response of one detector over a chunk
+        of time bins
+        :returns: array with shape (n_chunk_bins, n_echans, n_Ein)
+        """
+        (idx_start, w_start), (idx_stop, w_stop), half_width = weights
 
-            eff_rsp_new_sun = interp1d(
-                self._geometry.geometry_times, base_response_array_sun, axis=1
-            )
+        integrated = half_width * (
+            _linear_interp(rsp, idx_start, w_start)
+            + _linear_interp(rsp, idx_stop, w_stop)
+        )
 
-            rsp_all_sun = np.swapaxes(
-                np.array(
-                    np.swapaxes(eff_rsp_new_sun(self._time_bin_edges), -1, -2),
-                    dtype=float,
-                ),
-                0,
-                1,
-            )
+        return np.swapaxes(integrated, -1, -2)
 
-            # Trapz integrate over time bins
-            base_response_array_sun = (
-                0.5
-                * (
-                    self._time_bins[:, 1, np.newaxis, np.newaxis, np.newaxis]
-                    - self._time_bins[:, 0, np.newaxis, np.newaxis, np.newaxis]
-                )
-                * (rsp_all_sun[:-1] + rsp_all_sun[1:])
+    def _write_response(self, rsp_detectors, out, index=None):
+        """
+        Write the time integrated responses of one source chunk wise to out
+        :param rsp_detectors: dict with the effective responses of all detectors
+        :param out: array like with shape (n_bins * n_dets * n_echans, n_Ein),
+        e.g. a numpy array or a hdf5 dataset
+        :param index: index of the source if out has a leading source axis
+        """
+        rows_per_bin = self._ndets * self._nechans
+
+        for chunk_slice, chunk in self.iter_response_chunks(rsp_detectors):
+            rows = slice(
+                chunk_slice.start * rows_per_bin, chunk_slice.stop * rows_per_bin
             )
+            chunk = chunk.reshape(-1, self._num_Ebins_in)
 
-            self._base_response_array_sun = base_response_array_sun[2:-2]
-            #.reshape(
-            #    -1, self._num_Ebins_in
-            #)
+            if index is None:
+                out[rows] = chunk
+            else:
+                out[index, rows] = chunk
 
-        if base_rsp_ps_free is not None:
-            eff_rsp_new_free_ps = interp1d(
-                self._geometry.geometry_times, base_rsp_ps_free, axis=2
-            )
+    def build_response_array(self, name, out=None):
+        """
+        Stan data array of the free spectrum responses with this name
+        :param name: name in the stan data, e.g. base_response_array_earth
+        :param out: array like to write the result to, default a new numpy array
+        :returns: out
+        """
+        if out is None:
+            out = np.empty(self._response_shape(name), dtype=self._dtype)
 
-            rsp_all_ps = np.swapaxes(
-                np.array(
-                    np.swapaxes(eff_rsp_new_free_ps(self._time_bin_edges), -1, -2),
-                    dtype=float,
-                ),
-                1,
-                2,
-            )
+        rsp_list = self._free_spectrum_responses[name]
 
-            # Trapz integrate over time bins
-            base_rsp_ps_free = (
-                0.5
-                * (
-                    self._time_bins[:, 1, np.newaxis, np.newaxis, np.newaxis]
-                    - self._time_bins[:, 0, np.newaxis, np.newaxis, np.newaxis]
-                )
-                * (rsp_all_ps[:, :-1] + rsp_all_ps[:, 1:])
+        if name == "base_response_array_free_ps":
+            for i, rsp_detectors in enumerate(rsp_list):
+                self._write_response(rsp_detectors, out, index=i)
+        else:
+            assert len(rsp_list) == 1, f"Only one source for {name} allowed"
+            self._write_response(rsp_list[0], out)
+
+        return out
+
+    def _block_free_spectrum_responses(self):
+        """
+        Effective responses of all free spectrum sources in the order of the
+        columns of base_response_block (earth, cgb, sun, free point sources)
+        """
+        rsp_list = []
+        for name in [
+            "base_response_array_earth",
+            "base_response_array_cgb",
+            "base_response_array_sun",
+            "base_response_array_free_ps",
+        ]:
+            rsp_list.extend(self._free_spectrum_responses.get(name, []))
+        return rsp_list
+
+    def _block_response_shape(self):
+        return (
+            self._ndets * self._nechans,
+            len(self._used_time_bins),
+            len(self._block_free_spectrum_responses()) * self._num_Ebins_in,
+        )
+
+    def build_block_response_array(self, out=None):
+        """
+        Responses of all free spectrum sources in the block layout with shape
+        (n_dets * n_echans, n_bins, n_sources * n_Ein). The responses are
+        calculated detector by detector and the blocks are written in order,
+        so out can also be an array of the CmdStanJSONWriter.
+        :param out: array like to write the result to, default a new numpy array
+        :returns: out
+        """
+        if out is None:
+            out = np.empty(self._block_response_shape(), dtype=self._dtype)
+
+        rsp_list = self._block_free_spectrum_responses()
+        num_Ein = self._num_Ebins_in
+
+        for i, det in enumerate(self._dets):
+            det_blocks = np.empty(
+                (self._nechans, len(self._used_time_bins), len(rsp_list) * num_Ein),
+                dtype=self._dtype,
             )
 
-            self._base_response_array_ps = base_rsp_ps_free[:, 2:-2]
-            #.reshape(
-            #    base_rsp_ps_free.shape[0], -1, self._num_Ebins_in
-            #)
+            for chunk_slice, weights in self._iter_time_chunks():
+                for k, rsp_detectors in enumerate(rsp_list):
+                    integrated = self._integrate_response(rsp_detectors[det], weights)
+
+                    det_blocks[
+                        :, chunk_slice, k * num_Ein : (k + 1) * num_Ein
+                    ] = np.swapaxes(integrated, 0, 1)
+
+            for j in range(self._nechans):
+                out[i * self._nechans + j, 0 : len(self._used_time_bins)] = det_blocks[j]
+
+        return out
 
     def saa_sources(self):
         """
@@ -2151,26 +2906,97 @@ class StanDataConstructor(object):
         self._sigma_decay_saa = sigma_decay_saa
 
     def construct_data_dict(self):
+        """
+        Data dictionary for stan
+        """
+        data_dict = self._base_data_dict()
+
+        if self._block_layout:
+            if len(self._free_spectrum_responses) > 0:
+                data_dict["base_response_block"] = self.build_block_response_array()
+            return data_dict
+
+        for name in self._free_spectrum_responses.keys():
+            data_dict[name] = self.build_response_array(name)
+
+        return data_dict
+
+    def write_data(self, writer):
+        """
+        Write the stan data with a data writer. The responses of the free
+        spectrum sources are calculated chunk wise and written directly, so
+        they never have to be in memory completely.
+        :param writer: data writer, e.g. HDF5DataWriter
+        """
+        data_dict = self._base_data_dict()
+
+        # the grainsize is written last, so it can be changed in the file
+        grainsize = data_dict.pop("grainsize")
+
+        for name, value in data_dict.items():
+            writer.write(name, value)
+
+        if self._block_layout:
+            if len(self._free_spectrum_responses) > 0:
+                out = writer.create_array(
+                    "base_response_block", self._block_response_shape(), self._dtype
+                )
+                self.build_block_response_array(out=out)
+
+        else:
+            for name in self._free_spectrum_responses.keys():
+                out = writer.create_array(name, self._response_shape(name), self._dtype)
+                self.build_response_array(name, out=out)
+
+        writer.write("grainsize", grainsize)
+
+    def save_data_json(self, file_path):
+        """
+        Write the stan data as CmdStan JSON file. The file can be passed
+        directly as data to CmdStanModel.sample, so cmdstanpy does not have to
+        serialize a large data dictionary.
+        :param file_path: path of the json file
+        :returns: file_path
+        """
+        with CmdStanJSONWriter(file_path) as writer:
+            self.write_data(writer)
+
+        return file_path
+
+    def _build_sources(self):
+        """
+        Build the data of all sources once. The builders append to the
+        param_lookup, so they must not run again for the next data dict or
+        data file.
+        """
+        if self._sources_built:
+            return
+
+        self._param_lookup = []
+
         self.global_sources()
         self.continuum_sources()
         self.saa_sources()
         self.free_spectrum_sources()
 
+        self._sources_built = True
+
+    def _base_data_dict(self):
+        """
+        All stan data except the responses of the free spectrum sources
+        """
+        self._build_sources()
+
         data_dict = {}
 
         data_dict["num_dets"] = self._ndets
         data_dict["num_echans"] = self._nechans
 
-        counts = np.array(
-            self._data.counts[self._source_mask][2:-2], dtype=int
-        )#.flatten()
-
+        mask_zeros = self._mask_zeros
 
-        mask_zeros = (np.sum(counts, axis=(1,2)) != 0)
+        counts = self._counts
 
-        counts = counts[mask_zeros]
-
-        time_bins = self._time_bins[2:-2][mask_zeros]
+        time_bins = self._used_time_bins
         # flatten
         data_dict["counts"] = counts.flatten()
         data_dict["Rmin"] = np.min(counts[:,0,:].T/(time_bins[:,1]-time_bins[:,0]), axis=1)
@@ -2197,38 +3023,12 @@ class StanDataConstructor(object):
         #else:
         #    raise NotImplementedError
 
-        if self._base_response_array_ps is not None:
-            data_dict["num_free_ps_comp"] = len(self._base_response_array_ps)
-
-
-            base_response_array_ps_masked = self._base_response_array_ps[:, mask_zeros]
-            data_dict["base_response_array_free_ps"] = base_response_array_ps_masked.reshape(
-                len(base_response_array_ps_masked), -1, self._num_Ebins_in
+        if "base_response_array_free_ps" in self._free_spectrum_responses:
+            data_dict["num_free_ps_comp"] = len(
+                self._free_spectrum_responses["base_response_array_free_ps"]
             )
 
-            #self._base_response_array_ps[
-            #    :, mask_zeros
-            #]
-        if self._base_response_array_earth is not None:
-            data_dict["base_response_array_earth"] = self._base_response_array_earth[
-                mask_zeros
-            ].reshape(
-                -1, self._num_Ebins_in
-            )
-        if self._base_response_array_cgb is not None:
-            data_dict["base_response_array_cgb"] = self._base_response_array_cgb[
-                mask_zeros
-            ].reshape(
-                -1, self._num_Ebins_in
-            )
-        if self._base_response_array_sun is not None:
-            data_dict["base_response_array_sun"] = self._base_response_array_sun[
-                mask_zeros
-            ].reshape(
-                -1, self._num_Ebins_in
-            )
-
-        if self._base_response_array_cgb is not None:
+        if "base_response_array_cgb" in self._free_spectrum_responses:
             data_dict["earth_cgb_free"] = 1
         else:
             data_dict["earth_gb_free"] = 0
@@ -2268,20 +3068,134 @@ class StanDataConstructor(object):
             data_dict["mu_norm_cont"] = self._mu_norm_cont
             data_dict["sigma_norm_cont"] = self._sigma_norm_cont
             
+        if self._gp_basis == "precomputed":
+            data_dict["gp_omega"] = gp_basis_frequencies(self._gp_num_basis)
+
+        if self._block_layout:
+            self._to_block_layout(data_dict)
+
         # Stan grainsize for reduced_sum
-        if self._threads == 1:
-            data_dict["grainsize"] = 1
-        else:
-            data_dict["grainsize"] = 1
-            #int(
-            #    (self._ntimebins - 4) * self._ndets * self._nechans / self._threads
-            #)
+        data_dict["grainsize"] = self._get_grainsize(len(data_dict["counts"]))
+
         return data_dict
 
+    def _to_block_layout(self, data_dict):
+        """
+        Reorder the counts and the base counts of the fixed and continuum
+        sources to one block of all time bins per (detector, echan)
+        """
+        num_blocks = self._ndets * self._nechans
+
+        # (time, det, echan) -> (det, echan, time)
+        data_dict["counts"] = self._counts.transpose(1, 2, 0).reshape(num_blocks, -1)
+
+        base_counts = []
+        if "base_counts_array" in data_dict:
+            data_dict.pop("base_counts_array")
+            base_counts.append(self._global_counts[:, self._mask_zeros])
+
+        if "base_counts_array_cont" in data_dict:
+            data_dict.pop("base_counts_array_cont")
+            base_counts.append(self._cont_counts[:, self._mask_zeros])
+
+        if len(base_counts) > 0:
+            base_counts = np.concatenate(base_counts, axis=0)
+
+            data_dict["num_base_comp"] = len(base_counts)
+            # (comp, time, det, echan) -> (det, echan, time, comp)
+            data_dict["base_counts_block"] = base_counts.transpose(2, 3, 1, 0).reshape(
+                num_blocks, len(self._used_time_bins), -1
+            )
+
+        num_free_comp = len(self._block_free_spectrum_responses())
+        if num_free_comp > 0:
+            data_dict["num_free_comp"] = num_free_comp
+
+    def _grainsize_key(self):
+        key = grainsize_key(
+            len(self._used_time_bins),
+            self._ndets,
+            self._nechans,
+            self._num_Ebins_in,
+            self._threads,
+        )
+
+        # reduce_sum slices blocks instead of single data points
+        if self._block_layout:
+            key += "_block"
+
+        return key
+
+    def _get_grainsize(self, num_data_points):
+        if isinstance(self._grainsize, int):
+            return self._grainsize
+
+        if self._grainsize == "auto":
+            grainsize = GrainsizeCache().get(self._grainsize_key())
+            if grainsize is not None:
+                return grainsize
+
+        return heuristic_grainsize(num_data_points, self._threads)
+
+    def autotune_grainsize(self, model, data_file, candidates=None, iter_warmup=20, output_dir=None):
+        """
+        Find the fastest grainsize for reduce_sum with a few sampler iterations
+        per grainsize. The result is saved in data_file and cached for this
+        data shape and thread count, later runs with grainsize="auto" use it.
+        :param model: compiled CmdStanModel generated with
+        StanModelConstructor(profile=True)
+        :param data_file: json data file written by save_data_json
+        :param candidates: list of grainsizes to test, default between one and
+        32 slices of the data per thread
+        :param iter_warmup: number of warmup iterations per grainsize
+        :param output_dir: directory of the CmdStan output
+        :returns: best grainsize
+        """
+        assert self._threads > 1, "The grainsize has no effect with one thread"
+
+        if self._block_layout:
+            num_data_points = self._ndets * self._nechans
+        else:
+            num_data_points = len(self._counts.flatten())
+
+        if candidates is None:
+            candidates = grainsize_candidates(num_data_points, self._threads)
+
+        best, timings = autotune_grainsize(
+            model,
+            data_file,
+            self._threads,
+            candidates,
+            iter_warmup=iter_warmup,
+            output_dir=output_dir,
+        )
+
+        GrainsizeCache().set(self._grainsize_key(), best, timings)
+
+        self._grainsize = best
+
+        return best
+
     @property
     def param_lookup(self):
         return self._param_lookup
 
+    @property
+    def counts(self):
+        """
+        Counts of the time bins used in the stan model (time, det, echan)
+        """
+        self._select_time_bins()
+        return self._counts
+
+    @property
+    def used_time_bins(self):
+        """
+        Time bins used in the stan model
+        """
+        self._select_time_bins()
+        return self._used_time_bins
+
     @property
     def global_param_names(self):
         return self._global_param_names
@@ -2296,37 +3210,165 @@ class StanDataConstructor(object):
 
 
 class ReadStanArvizResult(object):
-    def __init__(self, nc_files):
-        for i, nc_file in enumerate(nc_files):
-            if i == 0:
-                self._arviz_result = av.from_netcdf(nc_file)
-            else:
-                self._arviz_result = av.concat(
-                    self._arviz_result, av.from_netcdf(nc_file), dim="chain"
-                )
+    def __init__(
+        self,
+        nc_files,
+        percentiles=(5, 95),
+        cache_file=None,
+        buffer_size=1000,
+        max_elements=50000000,
+    ):
+        """
+        Percentiles of the predictions and the ppc of (several) arviz result
+        files. The files are opened lazily and every variable is read once in
+        blocks of data points, the draws of all files and chains of a block are
+        added to one StreamingPercentiles, so all percentiles are computed in
+        one pass and the whole posterior is never in memory. The percentiles
+        are cached and reused as long as the result files do not change.
+        :param nc_files: list of netcdf files written by arviz, the chains of
+        all files are combined
+        :param percentiles: percentiles that are computed
+        :param cache_file: npz file with the cached percentiles, default next
+        to the first nc file
+        :param buffer_size: number of draws for which the percentiles are exact,
+        more draws are estimated with the P² algorithm
+        :param max_elements: maximal number of values of one variable in memory
+        """
+        self._nc_files = [os.path.abspath(f) for f in nc_files]
+        self._percentile_levels = np.array(percentiles, dtype=float)
+        self._buffer_size = buffer_size
+        self._max_elements = max_elements
+
+        if cache_file is None:
+            cache_file = f"{os.path.splitext(self._nc_files[0])[0]}_percentiles.npz"
+        self._cache_file = cache_file
 
-        self._model_parts = self._arviz_result.predictions.keys()
+        with xr.open_dataset(self._nc_files[0], group="constant_data") as constant_data:
+            self._dets = constant_data["dets"].values
+            self._echans = constant_data["echans"].values
+            self._time_bins = constant_data["time_bins"].values
 
-        self._dets = self._arviz_result.constant_data["dets"].values
-        self._echans = self._arviz_result.constant_data["echans"].values
+        with xr.open_dataset(self._nc_files[0], group="observed_data") as observed_data:
+            self._counts = observed_data["counts"].values
 
         self._ndets = len(self._dets)
         self._nechans = len(self._echans)
 
-        self._time_bins = self._arviz_result.constant_data["time_bins"].values
         self._time_bins -= self._time_bins[0, 0]
         self._bin_width = self._time_bins[:, 1] - self._time_bins[:, 0]
 
-        self._counts = self._arviz_result.observed_data["counts"].values
+        self._percentiles = self._load_cache()
+
+        if self._percentiles is None:
+            self._percentiles = self._compute_percentiles()
+            self._save_cache()
+
+        self._model_parts = [k for k in self._percentiles.keys() if k != "ppc"]
+
+    def _cache_key(self):
+        """
+        Hash of the result files and the percentile levels
+        """
+        sha = hashlib.sha256()
+        for nc_file in self._nc_files:
+            stat = os.stat(nc_file)
+            sha.update(f"{nc_file}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        sha.update(self._percentile_levels.tobytes())
+        sha.update(str(self._buffer_size).encode())
+        return sha.hexdigest()
+
+    def _load_cache(self):
+        if not os.path.exists(self._cache_file):
+            return None
+
+        with np.load(self._cache_file) as cache:
+            if str(cache["cache_key"]) != self._cache_key():
+                return None
 
-        predictions = self._arviz_result.predictions.stack(sample=("chain", "draw"))
-        self._parts = {}
-        for key in self._model_parts:
-            self._parts[key] = predictions[key].values
+            return {k: cache[k] for k in cache.files if k != "cache_key"}
+
+    def _save_cache(self):
+        tmp_file = f"{self._cache_file}.tmp{os.getpid()}.npz"
+        np.savez(tmp_file, cache_key=self._cache_key(), **self._percentiles)
+        os.replace(tmp_file, self._cache_file)
+
+    def _compute_percentiles(self):
+        """
+        Percentiles of all prediction variables and the ppc
+        """
+        with xr.open_dataset(self._nc_files[0], group="predictions") as predictions:
+            variables = [("predictions", k) for k in predictions.data_vars.keys()]
 
-        self._ppc = self._arviz_result.posterior_predictive.stack(
-            sample=("chain", "draw")
-        )["ppc"].values
+        variables.append(("posterior_predictive", "ppc"))
+
+        # cache=False, so a slice only reads the values of this slice
+        datasets = {
+            group: [xr.open_dataset(f, group=group, cache=False) for f in self._nc_files]
+            for group in ("predictions", "posterior_predictive")
+        }
+
+        try:
+            return {
+                key: self._variable_percentiles([ds[key] for ds in datasets[group]])
+                for group, key in variables
+            }
+        finally:
+            for ds_list in datasets.values():
+                for ds in ds_list:
+                    ds.close()
+
+    def _variable_percentiles(self, arrays):
+        """
+        Percentiles over all chains and draws of one variable
+        :param arrays: lazy arrays of this variable with the dims
+        (chain, draw, ..., data point) of all files
+        :returns: array with shape (len(percentiles), ..., data point)
+        """
+        shape = arrays[0].shape[2:]
+        num_draws = sum(a.shape[0] * a.shape[1] for a in arrays)
+
+        num_points = shape[-1]
+        point_size = int(np.prod(shape[:-1], dtype=np.int64))
+
+        # data points per block, so that the buffer and a block of draws fit in max_elements
+        block = max(
+            1,
+            self._max_elements // (point_size * min(num_draws, self._buffer_size) * 2),
+        )
+        draws_per_read = max(1, self._max_elements // (2 * point_size * block))
+
+        result = np.empty((len(self._percentile_levels), *shape))
+
+        for start in range(0, num_points, block):
+            stop = min(start + block, num_points)
+
+            sp = StreamingPercentiles(
+                self._percentile_levels,
+                (*shape[:-1], stop - start),
+                buffer_size=max(5, min(num_draws, self._buffer_size)),
+            )
+
+            for array in arrays:
+                for chain in range(array.shape[0]):
+                    for d in range(0, array.shape[1], draws_per_read):
+                        sp.update(
+                            array[chain, d : d + draws_per_read, ..., start:stop].values
+                        )
+
+            result[..., start:stop] = sp.percentiles
+
+        return result
+
+    @property
+    def percentiles(self):
+        """
+        Dict variable name -> array with shape (len(percentiles), ..., data point)
+        """
+        return self._percentiles
+
+    @property
+    def percentile_levels(self):
+        return self._percentile_levels
 
     def ppc_plots(self, save_dir):
 
@@ -2341,6 +3383,12 @@ class ReadStanArvizResult(object):
             "tot": "green",
         }
 
+        # percentile index of the lower and upper limit of the bands
+        low = int(np.argmin(self._percentile_levels))
+        high = int(np.argmax(self._percentile_levels))
+
+        time = np.mean(self._time_bins, axis=1)
+
         for d_index, d in enumerate(self._dets):
             for e_index, e in enumerate(self._echans):
 
@@ -2349,121 +3397,32 @@ class ReadStanArvizResult(object):
                 ]
                 fig, ax = plt.subplots()
 
-                ppc_min = np.percentile(self._ppc[mask], 5, axis=1)/ self._bin_width
-                ppc_max = np.percentile(self._ppc[mask], 95, axis=1)/ self._bin_width
+                ppc = self._percentiles["ppc"][..., mask] / self._bin_width
 
-                ax.fill_between(np.mean(self._time_bins, axis=1),
-                                y1=ppc_min,
-                                y2=ppc_max,
+                ax.fill_between(time,
+                                y1=ppc[low],
+                                y2=ppc[high],
                                 color="darkgreen",
                                 label="PPC",
                                 alpha=0.3)
 
-                for key in self._parts.keys():
-                    if len(self._parts[key].shape) == 3:
-                        for k in range(len(self._parts[key])):
-                            part_min = np.percentile(self._parts[key][k][mask], 5, axis=1)/ self._bin_width
-                            part_max = np.percentile(self._parts[key][k][mask], 95, axis=1)/ self._bin_width
-                            if k==0:
-                                ax.fill_between(np.mean(self._time_bins, axis=1),
-                                                y1=part_min,
-                                                y2=part_max,
-                                                color=colors.get(key, "gray"),
-                                                label=key,
-                                                alpha=0.3)
-                            else:
-                                ax.fill_between(np.mean(self._time_bins, axis=1),
-                                                y1=part_min,
-                                                y2=part_max,
-                                                color=colors.get(key, "gray"),
-                                                alpha=0.3)
-                    else:
-                        part_min = np.percentile(self._parts[key][mask], 5, axis=1)/ self._bin_width
-                        part_max = np.percentile(self._parts[key][mask], 95, axis=1)/ self._bin_width
-
-                        ax.fill_between(np.mean(self._time_bins, axis=1),
-                                            y1=part_min,
-                                            y2=part_max,
+                for key in self._model_parts:
+                    part = self._percentiles[key][..., mask] / self._bin_width
+                    if part.ndim == 3:
+                        for k in range(part.shape[1]):
+                            ax.fill_between(time,
+                                            y1=part[low, k],
+                                            y2=part[high, k],
                                             color=colors.get(key, "gray"),
-                                            label=key,
+                                            label=key if k == 0 else None,
                                             alpha=0.3)
-                """
-                for i in np.linspace(0, self._ppc.shape[1] - 1, 30, dtype=int):
-                    
-                    if i == 0:
-                        ax.scatter(
-                            np.mean(self._time_bins, axis=1),
-                            self._ppc[mask][:, i] / self._bin_width,
-                            color="darkgreen",
-                            alpha=0.025,
-                            edgecolor="darkgreen",
-                            facecolor="none",
-                            lw=0.9,
-                            s=2,
-                            label="PPC",
-                        )
                     else:
-                        ax.scatter(
-                            np.mean(self._time_bins, axis=1),
-                            self._ppc[mask][:, i] / self._bin_width,
-                            color="darkgreen",
-                            alpha=0.025,
-                            edgecolor="darkgreen",
-                            facecolor="none",
-                            lw=0.9,
-                            s=2,
-                        )
-                    
-                    for key in self._parts.keys():
-                        # Check if there are several sources in this class
-                        if len(self._parts[key].shape) == 3:
-                            for k in range(len(self._parts[key])):
-                                if k == 0 and i == 0:
-                                    ax.scatter(
-                                        np.mean(self._time_bins, axis=1),
-                                        self._parts[key][k][mask][:, i]
-                                        / self._bin_width,
-                                        alpha=0.025,
-                                        edgecolor=colors.get(key, "gray"),
-                                        facecolor="none",
-                                        lw=0.9,
-                                        s=2,
+                        ax.fill_between(time,
+                                        y1=part[low],
+                                        y2=part[high],
+                                        color=colors.get(key, "gray"),
                                         label=key,
-                                    )
-                                else:
-                                    ax.scatter(
-                                        np.mean(self._time_bins, axis=1),
-                                        self._parts[key][k][mask][:, i]
-                                        / self._bin_width,
-                                        alpha=0.025,
-                                        edgecolor=colors.get(key, "gray"),
-                                        facecolor="none",
-                                        lw=0.9,
-                                        s=2,
-                                    )
-                        else:
-                            if i == 0:
-                                ax.scatter(
-                                    np.mean(self._time_bins, axis=1),
-                                    self._parts[key][mask][:, i] / self._bin_width,
-                                    alpha=0.025,
-                                    edgecolor=colors.get(key, "gray"),
-                                    facecolor="none",
-                                    lw=0.9,
-                                    s=2,
-                                    label=key,
-                                )
-                            else:
-                                ax.scatter(
-                                    np.mean(self._time_bins, axis=1),
-                                    self._parts[key][mask][:, i] / self._bin_width,
-                                    alpha=0.025,
-                                    edgecolor=colors.get(key, "gray"),
-                                    facecolor="none",
-                                    lw=0.9,
-                                    s=2,
-                                )
-                """
+                                        alpha=0.3)
                 ax.scatter(
                     np.mean(self._time_bins, axis=1),
                     self._counts[mask] / self._bin_width,
@@ -2485,3 +3444,4 @@ class ReadStanArvizResult(object):
                     f"ppc_result_det_{d}_echan_{e}.png",
                     bbox_extra_artists=(lgd,t)
                 )  # , bbox_extra_artists=(lgd,t), dpi=450, bbox_inches='tight')
+                plt.close(fig)
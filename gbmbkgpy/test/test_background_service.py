@@ -0,0 +1,149 @@
+import json
+import threading
+from urllib.request import urlopen
+
+import h5py
+import numpy as np
+import pytest
+
+from gbmbkgpy.io.background_service import (
+    ModelBackground,
+    ResultFileBackground,
+    make_server,
+)
+from gbmbkgpy.io.result_file import write_result_dataset, write_time_bins
+from gbmbkgpy.modeling.functions import AstromodelFunctionVector
+from gbmbkgpy.modeling.model import ModelDet
+from gbmbkgpy.modeling.source import NormOnlySource
+
+
+class _TestData:
+    def __init__(self, det, num_bins=100, num_echan=2):
+        edges = np.linspace(0, 1000, num_bins + 1)
+        self.det = det
+        self.time_bins = np.stack((edges[:-1], edges[1:]), axis=-1)
+        self.fit_time_bins = self.time_bins
+        self.num_echan = num_echan
+        self.fit_counts = np.zeros((num_bins, num_echan))
+        self.counts = np.arange(num_bins * num_echan).reshape(num_bins, num_echan)
+
+
+def _build_model(det):
+    data = _TestData(det)
+    model = ModelDet(data)
+
+    def rates(time_bins):
+        return 1 + 0.5 * np.sin(time_bins / 100.0)
+
+    cr = NormOnlySource("cr", rates, AstromodelFunctionVector(data.num_echan))
+    for i, f in enumerate(cr.fit_model.vector):
+        f.k.value = 2.0 + i
+    model.add_source(cr)
+
+    return model
+
+
+def _write_result_file(path, time_bins, detectors, echans):
+    n_bins = len(time_bins)
+    counts = np.zeros((n_bins, len(detectors), len(echans)))
+
+    # the model counts encode the time, detector and echan
+    for i, det in enumerate(detectors):
+        for j, echan in enumerate(echans):
+            counts[:, i, j] = time_bins[:, 0] + 0.01 * int(det[1:], 16) + 0.001 * echan
+
+    with h5py.File(path, "w") as f:
+        f.attrs["detectors"] = detectors
+        f.attrs["echans"] = [str(e) for e in echans]
+        f.attrs["data_type"] = "ctime"
+        f.attrs["dates"] = ["dummy"]
+        write_time_bins(f, time_bins)
+        write_result_dataset(f, "saa_mask", np.ones(n_bins, dtype=bool))
+        write_result_dataset(f, "observed_counts", counts)
+        write_result_dataset(f, "model_counts", counts)
+        write_result_dataset(f, "stat_err", np.ones_like(counts))
+        f.create_group("sources")
+
+
+@pytest.mark.run(order=1)
+def test_result_file_background(tmp_path):
+    day_1 = np.column_stack([np.arange(0, 1000.0), np.arange(1, 1001.0)])
+    day_2 = day_1 + 1000
+
+    # day 1 with one file per detector, day 2 with one file for both
+    _write_result_file(tmp_path / "day_1_n0.hdf5", day_1, ["n0"], [0, 1, 2])
+    _write_result_file(tmp_path / "day_1_n1.hdf5", day_1, ["n1"], [0, 1])
+    _write_result_file(tmp_path / "day_2.hdf5", day_2, ["n0", "n1"], [0, 1, 2])
+
+    background = ResultFileBackground([tmp_path], cache_size=2)
+
+    result = background.query(990, 1010, detectors=["n1", "n0"], echans=[2, 0])
+
+    assert result["detectors"] == ["n1", "n0"]
+    assert result["echans"] == ["2", "0"]
+    assert np.array_equal(result["time_bins"][:, 0], np.arange(990, 1010.0))
+    assert np.allclose(result["model_counts"][:, 1, 0], np.arange(990, 1010) + 0.002)
+    assert np.allclose(result["model_counts"][-10:, 0, 0], np.arange(1000, 1010) + 0.012)
+
+    # n1 echan 2 is not in the result file of day 1
+    assert np.all(np.isnan(result["model_counts"][:10, 0, 0]))
+
+    with pytest.raises(AssertionError):
+        background.query(0, 10, detectors=["n5"])
+
+    server = make_server(background, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        url = f"http://127.0.0.1:{server.server_port}/background?start=5&stop=7&echans=1"
+        with urlopen(url) as response:
+            result = json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+        background.close()
+
+    assert result["detectors"] == ["n0", "n1"]
+    assert np.allclose(result["model_counts"], [[[5.001], [5.011]], [[6.001], [6.011]]])
+
+
+@pytest.mark.run(order=2)
+def test_model_background():
+    model = _build_model("n3")
+
+    background = ModelBackground(model, max_samples=10, seed=1)
+
+    result = background.query(200, 300, echans=[1])
+
+    assert result["detectors"] == ["n3"]
+    assert result["echans"] == ["1"]
+    assert np.array_equal(result["time_bins"][:, 0], np.arange(200, 300.0, 10))
+    assert np.array_equal(
+        result["observed_counts"][:, 0, 0], model.data.counts[20:30, 1]
+    )
+    assert np.allclose(
+        result["model_counts"][:, 0, 0],
+        model.get_model_counts(time_bins=result["time_bins"])[:, 1],
+    )
+
+    # without posterior samples there is no statistical error
+    assert np.all(result["stat_err"] == 0)
+
+    start_values = np.array([p.value for p in model.parameter.values()])
+    rng = np.random.default_rng(2)
+    model.set_raw_samples(
+        start_values * rng.uniform(0.5, 1.5, (50, len(start_values)))
+    )
+
+    result = background.query(200, 300)
+
+    assert result["echans"] == ["0", "1"]
+    assert np.all(result["stat_err"] > 0)
+
+    # the parameters of the model are untouched
+    assert np.allclose([p.value for p in model.parameter.values()], start_values)
+
+    result = background.query_json(2000, 3000)
+    assert result["time_bins"] == []
+    assert result["model_counts"] == []
@@ -0,0 +1,160 @@
+import io
+import threading
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from astropy.io import fits
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """
+    Local stand-in of the archive, supports range requests like HEASARC
+    """
+
+    def send_head(self):
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+
+        if range_header is None or not path.endswith((".pha", ".fit")):
+            return super().send_head()
+
+        f = open(path, "rb")
+        data = f.read()
+        f.close()
+
+        start = int(range_header.split("=")[1].split("-")[0])
+
+        if start >= len(data):
+            self.send_error(416)
+            return None
+
+        self.send_response(206)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+
+        return io.BytesIO(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+def _write_fits(path, value):
+    hdu = fits.BinTableHDU.from_columns(
+        [fits.Column(name="COUNTS", format="D", array=np.full(1000, value))]
+    )
+    fits.HDUList([fits.PrimaryHDU(), hdu]).writeto(path, checksum=True)
+
+
+@pytest.mark.run(order=1)
+def test_prefetch(tmp_path, monkeypatch):
+    from gbmbkgpy.io.bulk_download import fetch_file, gbm_file_path, prefetch
+
+    archive = tmp_path / "archive"
+    day_dir = archive / "2018" / "04" / "07" / "current"
+    day_dir.mkdir(parents=True)
+
+    _write_fits(day_dir / "glg_ctime_n0_180407_v00.pha", 0)
+    _write_fits(day_dir / "glg_ctime_n0_180407_v01.pha", 1)
+    _write_fits(day_dir / "glg_ctime_n1_180407_v00.pha", 2)
+    _write_fits(day_dir / "glg_poshist_all_180407_v00.fit", 3)
+
+    monkeypatch.setenv("GBMDATA", str(tmp_path / "gbmdata"))
+
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", 0), partial(RangeRequestHandler, directory=str(archive))
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    try:
+        # continue a partial download
+        source = day_dir / "glg_ctime_n1_180407_v00.pha"
+        final_path = gbm_file_path("180407", "ctime", "n1")
+        final_path.parent.mkdir(parents=True)
+        part_path = final_path.with_name(final_path.name + ".part")
+        part_path.write_bytes(source.read_bytes()[:5000])
+
+        fetch_file(
+            f"{base_url}/2018/04/07/current/glg_ctime_n1_180407_v00.pha", final_path
+        )
+        assert final_path.read_bytes() == source.read_bytes()
+        assert not part_path.exists()
+
+        downloaded, failed = prefetch(
+            ["180407"],
+            data_types=["ctime", "poshist"],
+            detectors=["n0", "n1", "n2"],
+            base_url=base_url,
+            max_workers=2,
+        )
+
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # n1 was already downloaded, n2 does not exist
+    assert set(downloaded.keys()) == {
+        ("180407", "ctime", "n0"),
+        ("180407", "poshist", "all"),
+    }
+    assert set(failed.keys()) == {("180407", "ctime", "n2")}
+
+    # the latest version is saved as v00
+    with fits.open(gbm_file_path("180407", "ctime", "n0")) as f:
+        assert f[1].data["COUNTS"][0] == 1
+
+
+@pytest.mark.run(order=2)
+def test_file_index(tmp_path):
+    from gbmbkgpy.io.file_index import GBMDataIndex
+
+    for data_type, det, version, ext in [
+        ("ctime", "n0", 0, "pha"),
+        ("ctime", "n0", 1, "pha"),
+        ("cspec", "b1", 0, "pha"),
+        ("poshist", "all", 0, "fit"),
+    ]:
+        path = tmp_path / data_type / "180407"
+        path.mkdir(parents=True, exist_ok=True)
+        (path / f"glg_{data_type}_{det}_180407_v0{version}.{ext}").touch()
+
+    db_file = tmp_path / "index.sqlite"
+
+    index = GBMDataIndex(tmp_path, db_file=db_file)
+
+    assert len(index) == 4
+    assert index.lookup("180407", "ctime", "n0").endswith("_v01.pha")
+    assert index.lookup("180407", "ctime", "n0", version=0).endswith("_v00.pha")
+    assert index.lookup("180407", "ctime", "n1") is None
+    assert index.lookup("180408", "poshist") is None
+
+    new_file = tmp_path / "ctime" / "180407" / "glg_ctime_n1_180407_v00.pha"
+    new_file.touch()
+    index.add(new_file)
+
+    # a new index is read from the sqlite file instead of a scan
+    (tmp_path / "cspec" / "180407" / "glg_cspec_b1_180407_v00.pha").unlink()
+
+    index = GBMDataIndex(tmp_path, db_file=db_file)
+    assert index.lookup("180407", "ctime", "n1") == str(new_file)
+    # the file system is only probed with check
+    assert index.lookup("180407", "cspec", "b1") is not None
+
+    # the removed file is dropped from the index and the db
+    assert index.lookup("180407", "cspec", "b1", check=True) is None
+    assert len(GBMDataIndex(tmp_path, db_file=db_file)) == 4
+
+    # the db is only written after a scan
+    mtime = db_file.stat().st_mtime_ns
+    assert len(GBMDataIndex(tmp_path, db_file=db_file)) == 4
+    assert db_file.stat().st_mtime_ns == mtime
+
+    (tmp_path / "ctime" / "180407" / "glg_ctime_n1_180407_v00.pha").unlink()
+    index.refresh()
+    assert len(index) == 3
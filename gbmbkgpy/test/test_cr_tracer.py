@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+
+@pytest.mark.run(order=1)
+def test_cr_tracer_cache(tmp_path, monkeypatch):
+    from gbmbkgpy.geometry import cr_tracer
+
+    monkeypatch.setenv("GBMDATA", str(tmp_path))
+    monkeypatch.setattr(cr_tracer, "_memory_cache", {})
+
+    calls = []
+
+    def create(date, side):
+        calls.append((date, side))
+        time = np.linspace(0, 100, 11)
+        return time, time**2
+
+    tracer = cr_tracer.load_cr_tracer("BGO", "180407", 0, create)
+
+    assert np.allclose(tracer([0, 15, 100, 200]), [0, 250, 10000, 10000])
+    assert cr_tracer.cr_tracer_cache_file("BGO", "180407", 0).exists()
+
+    # from the memory cache
+    assert cr_tracer.load_cr_tracer("BGO", "180407", 0, create) is tracer
+
+    # from the cache file
+    monkeypatch.setattr(cr_tracer, "_memory_cache", {})
+    tracer = cr_tracer.load_cr_tracer("BGO", "180407", 0, create)
+    assert np.array_equal(tracer.values, np.linspace(0, 100, 11) ** 2)
+
+    # other side
+    cr_tracer.load_cr_tracer("BGO", "180407", 1, create)
+
+    assert calls == [("180407", 0), ("180407", 1)]
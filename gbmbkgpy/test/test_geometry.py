@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from astropy.coordinates import get_body
+from astropy.time import Time, TimeDelta
+
+from gbmbkgpy.geometry.position_interpolator import (
+    PoshistInterpolator,
+    quaternion_to_sc_matrix,
+    sun_direction_icrs,
+)
+
+
+@pytest.mark.run(order=1)
+def test_poshist_interpolator():
+    time = 5e8 + np.arange(0, 100.0)
+
+    # rotation around the z axis with 1 deg per second
+    angle = np.deg2rad(time - time[0])
+    quats = np.column_stack(
+        [0 * angle, 0 * angle, np.sin(angle / 2), np.cos(angle / 2)]
+    )
+    # the sign of a quaternion is arbitrary
+    quats[1::2] *= -1
+
+    sc_pos = np.column_stack([7000 + time - time[0], 0 * time, 0 * time])
+
+    interp = PoshistInterpolator(time, quats, sc_pos)
+
+    t = np.array([5e8 + 10.5, 5e8 + 20.25])
+
+    assert np.allclose(interp.sc_pos(t)[:, 0], [7010.5, 7020.25])
+    assert np.allclose(np.linalg.norm(interp.quaternion(t), axis=1), 1)
+
+    # the x axis of the satellite rotates with the quaternion
+    sc_matrix = interp.sc_matrix(t)
+    assert sc_matrix.shape == (2, 3, 3)
+    assert np.allclose(sc_matrix[:, 0, 0], np.cos(np.deg2rad([10.5, 20.25])), atol=1e-4)
+    assert np.allclose(sc_matrix[0], quaternion_to_sc_matrix(interp.quaternion(t[0])))
+
+    with pytest.raises(AssertionError):
+        interp.sc_pos(5e8 - 1)
+
+
+@pytest.mark.run(order=2)
+def test_sun_direction():
+    met = np.linspace(2e8, 8e8, 100)
+
+    time = Time("2001-01-01 00:00:00", scale="utc") + TimeDelta(met, format="sec")
+
+    # geocentric direction in the ICRS axes
+    sun = get_body("sun", time).cartesian.xyz.value.T
+    sun /= np.linalg.norm(sun, axis=1)[:, np.newaxis]
+
+    sep = np.rad2deg(
+        np.arccos(np.clip(np.sum(sun * sun_direction_icrs(met), axis=1), -1, 1))
+    )
+
+    assert np.max(sep) < 0.02
+
+
+@pytest.mark.run(order=3)
+def test_icrs_galactic():
+    import astropy.units as u
+    from astropy.coordinates import SkyCoord
+
+    from gbmbkgpy.geometry.geometry import galactic_to_icrs, icrs_to_galactic
+
+    rng = np.random.default_rng(0)
+    ra = rng.uniform(0, 360, 1000)
+    dec = np.rad2deg(np.arcsin(rng.uniform(-1, 1, 1000)))
+
+    coord = SkyCoord(ra=ra * u.deg, dec=dec * u.deg, frame="icrs")
+
+    l, b = icrs_to_galactic(ra, dec)
+    sep = coord.galactic.separation(SkyCoord(l=l * u.deg, b=b * u.deg, frame="galactic"))
+    assert np.max(sep.deg) < 1e-5
+    assert np.all((l > -180) & (l <= 180))
+
+    ra_back, dec_back = galactic_to_icrs(l, b)
+    sep = coord.separation(SkyCoord(ra=ra_back * u.deg, dec=dec_back * u.deg))
+    assert np.max(sep.deg) < 1e-9
@@ -0,0 +1,189 @@
+import collections
+import json
+import os
+
+import numpy as np
+import pytest
+
+from gbmbkgpy.minimizer.minimizer import Minimizer
+
+
+class _Parameter(object):
+    def __init__(self, name, value, bounds):
+        self.name = name
+        self.value = value
+        self.bounds = bounds
+        self.free = True
+
+
+class _Data(object):
+    def __init__(self, day):
+        self.dates = [day]
+        self.detectors = ["n0"]
+        self.echans = ["1"]
+
+
+class _QuadraticLike(object):
+    """
+    Cheap stand in for BackgroundLike: a quadratic in the free parameters
+    with the minimum at the target values
+    """
+
+    def __init__(self, day="201201", target=(2.0, -1.0, 0.5, 3.0), fail_all_free=False):
+        self._data = _Data(day)
+        self._target = dict(
+            zip(["norm_a", "norm_b", "saa_norm", "saa_decay"], target)
+        )
+        self._parameters = collections.OrderedDict(
+            (name, _Parameter(name, 1.0, (-10.0, 10.0))) for name in self._target
+        )
+        # simulate a killed fit in the first stage with all parameters free
+        self._fail_all_free = fail_all_free
+
+    @property
+    def _free(self):
+        return [p for p in self._parameters.values() if p.free]
+
+    @property
+    def get_normalization_parameter_list(self):
+        return ["norm_a", "norm_b"]
+
+    @property
+    def get_not_normalization_parameter_list(self):
+        return ["saa_norm", "saa_decay"]
+
+    def fix_parameters(self, names):
+        for name in names:
+            self._parameters[name].free = False
+
+    def unfix_parameters(self, names):
+        for name in names:
+            self._parameters[name].free = True
+
+    @property
+    def get_free_parameter_values(self):
+        return np.array([p.value for p in self._free])
+
+    @property
+    def get_free_parameter_bounds(self):
+        return [p.bounds for p in self._free]
+
+    def __call__(self, values):
+        if self._fail_all_free and len(self._free) == len(self._parameters):
+            raise RuntimeError("Killed")
+
+        for p, v in zip(self._free, values):
+            p.value = v
+
+        return sum(
+            (p.value - self._target[p.name]) ** 2 for p in self._parameters.values()
+        )
+
+
+def _run_stages(minimizer):
+    """
+    Record the stages that are fitted
+    """
+    run = []
+    fit_with_bounds = minimizer._fit_with_bounds
+    fit_without_bounds = minimizer._fit_without_bounds
+
+    def with_bounds(method, type, iter_nr):
+        run.append(iter_nr)
+        fit_with_bounds(method, type=type, iter_nr=iter_nr)
+
+    def without_bounds(method, iter_nr, options):
+        run.append(iter_nr)
+        fit_without_bounds(method, iter_nr=iter_nr, options=options)
+
+    minimizer._fit_with_bounds = with_bounds
+    minimizer._fit_without_bounds = without_bounds
+
+    return run
+
+
+@pytest.mark.run(order=1)
+def test_checkpoint_resume(tmp_path, monkeypatch):
+    monkeypatch.setenv("GBMDATA", str(tmp_path))
+
+    # killed in the third stage after the checkpoints of two stages
+    minimizer = Minimizer(_QuadraticLike(fail_all_free=True))
+
+    with pytest.raises(RuntimeError):
+        minimizer.fit(n_interations=3)
+
+    with open(minimizer.checkpoint_path, "r") as f:
+        checkpoint = json.load(f)
+
+    assert checkpoint["completed-stages"] == 2
+    assert np.allclose(checkpoint["param-values"][2:], [0.5, 3.0], atol=1e-3)
+
+    # without resume the fit starts from scratch
+    like = _QuadraticLike()
+    minimizer = Minimizer(like)
+    run = _run_stages(minimizer)
+    minimizer.fit(n_interations=3)
+    assert run == [1, 2, 3]
+    assert not os.path.exists(minimizer.checkpoint_path)
+
+    # the fit of the first run continues after its completed stages
+    with open(minimizer.checkpoint_path, "w") as f:
+        json.dump(checkpoint, f)
+
+    like = _QuadraticLike()
+    minimizer = Minimizer(like)
+    run = _run_stages(minimizer)
+    minimizer.fit(n_interations=3, resume=True)
+    assert run == [3]
+    assert np.allclose(
+        [p.value for p in like._parameters.values()], [2.0, -1.0, 0.5, 3.0], atol=1e-3
+    )
+
+    # a checkpoint with other parameters or stages is ignored
+    checkpoint["layout"]["param-names"] = ["a", "b", "c", "d"]
+    with open(minimizer.checkpoint_path, "w") as f:
+        json.dump(checkpoint, f)
+
+    minimizer = Minimizer(_QuadraticLike())
+    run = _run_stages(minimizer)
+    minimizer.fit(n_interations=3, resume=True)
+    assert run == [1, 2, 3]
+
+
+@pytest.mark.run(order=2)
+def test_warm_start_previous_day(tmp_path, monkeypatch):
+    monkeypatch.setenv("GBMDATA", str(tmp_path))
+
+    assert Minimizer(_QuadraticLike(day="201202")).find_previous_fit() is None
+
+    # two fits of the previous day, the latest is used
+    for target in [(1.0, 1.0, 1.0, 1.0), (2.0, -1.0, 0.5, 3.0)]:
+        Minimizer(_QuadraticLike(day="201201", target=target)).fit(n_interations=3)
+
+    like = _QuadraticLike(day="201202")
+    minimizer = Minimizer(like)
+
+    previous = minimizer.find_previous_fit()
+    assert previous.endswith("Fit_201201_n0_1.json")
+
+    assert minimizer.warm_start("auto")
+    assert np.allclose(
+        [p.value for p in like._parameters.values()], [2.0, -1.0, 0.5, 3.0], atol=1e-3
+    )
+
+    # fits with another echan layout are not used
+    like = _QuadraticLike(day="201202")
+    like._data.echans = ["2"]
+    assert not Minimizer(like).warm_start(previous)
+    assert all(p.value == 1.0 for p in like._parameters.values())
+
+    # a newer fit with another layout is skipped by the search
+    like = _QuadraticLike(day="201201", target=(5.0, 5.0, 5.0, 5.0))
+    like._data.echans = ["2"]
+    Minimizer(like).fit(n_interations=3)
+
+    assert Minimizer(_QuadraticLike(day="201202")).find_previous_fit() == previous
+
+    like = _QuadraticLike(day="201202")
+    like._data.echans = ["2"]
+    assert Minimizer(like).find_previous_fit().endswith("Fit_201201_n0_2.json")
@@ -0,0 +1,109 @@
+import os
+import shutil
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+import gbmbkgpy
+from gbmbkgpy.utils.mpi import (
+    split_range,
+    gatherv_array,
+    allgatherv_array,
+    allgatherv_shared,
+)
+
+
+@pytest.mark.run(order=1)
+def test_split_range():
+    ranges = [split_range(1003, r, 16) for r in range(16)]
+
+    assert ranges[0][0] == 0
+    assert ranges[-1][1] == 1003
+    assert all(a[1] == b[0] for a, b in zip(ranges[:-1], ranges[1:]))
+
+
+@pytest.mark.run(order=2)
+def test_gather_in_rounds():
+    pytest.importorskip("mpi4py")
+
+    array = np.arange(101 * 3 * 2, dtype=float).reshape(101, 3, 2)
+
+    # tiny messages to test the splitting in several rounds
+    for max_bytes in [None, 100, 1]:
+        assert np.array_equal(gatherv_array(array, max_bytes=max_bytes), array)
+        assert np.array_equal(allgatherv_array(array, max_bytes=max_bytes), array)
+
+    shared = allgatherv_shared(array.astype(np.uint32))
+    assert np.array_equal(shared.array, array)
+    assert shared.is_writer
+
+
+_cr_tracer_script = textwrap.dedent(
+    """
+    import os
+    import sys
+
+    import numpy as np
+    from mpi4py import MPI
+
+    comm = MPI.COMM_WORLD
+
+    # only rank 1 has a cache file of the tracer
+    os.environ["GBMDATA"] = os.path.join(sys.argv[1], f"rank_{comm.Get_rank()}")
+
+    from gbmbkgpy.geometry import cr_tracer
+
+    if comm.Get_rank() == 1:
+        cache_file = cr_tracer.cr_tracer_cache_file("MCL", "180407")
+        cache_file.parent.mkdir(parents=True)
+        np.savez(cache_file, time=[0.0, 1.0], values=[0.0, 0.0])
+
+    comm.Barrier()
+
+    def create(date, side):
+        # like the downloads, with a collective call
+        comm.Barrier()
+        return np.array([0.0, 1.0]), np.array([1.0, 2.0])
+
+    tracer = cr_tracer.load_cr_tracer("MCL", "180407", None, create)
+
+    assert np.array_equal(tracer.values, [1.0, 2.0])
+    """
+)
+
+
+@pytest.mark.run(order=3)
+def test_cr_tracer_same_path_on_all_ranks(tmp_path):
+    pytest.importorskip("mpi4py")
+
+    mpiexec = shutil.which("mpiexec")
+
+    if mpiexec is None:
+        pytest.skip("mpiexec is not available")
+
+    script = tmp_path / "cr_tracer_mpi.py"
+    script.write_text(_cr_tracer_script)
+
+    python_path = [str(Path(gbmbkgpy.__file__).parents[1])]
+    if "PYTHONPATH" in os.environ:
+        python_path.append(os.environ["PYTHONPATH"])
+
+    subprocess.run(
+        [
+            mpiexec,
+            "--allow-run-as-root",
+            "--oversubscribe",
+            "-n",
+            "2",
+            sys.executable,
+            str(script),
+            str(tmp_path),
+        ],
+        env=dict(os.environ, PYTHONPATH=os.pathsep.join(python_path)),
+        check=True,
+        timeout=120,
+    )
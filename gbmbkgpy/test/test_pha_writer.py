@@ -0,0 +1,156 @@
+import h5py
+import numpy as np
+import pytest
+
+
+def _write_result_file(path, detectors, echans, time_bins, data_type="cspec"):
+    n_bins = len(time_bins)
+    shape = (n_bins, len(detectors), len(echans))
+
+    # the counts encode the detector and echan
+    counts = np.zeros(shape)
+    for i, det in enumerate(detectors):
+        for j, echan in enumerate(echans):
+            counts[:, i, j] = 1000 * int(det[1:], 16) + int(echan)
+
+    with h5py.File(path, "w") as f:
+        f.attrs["dates"] = ["180407"]
+        f.attrs["data_type"] = data_type
+        f.attrs["detectors"] = detectors
+        f.attrs["echans"] = echans
+        f.create_dataset("time_bins_start", data=time_bins[:, 0])
+        f.create_dataset("time_bins_stop", data=time_bins[:, 1])
+        f.create_dataset("saa_mask", data=np.ones(n_bins, dtype=bool))
+        f.create_dataset("observed_counts", data=counts)
+        f.create_dataset("model_counts", data=counts + 0.5)
+        f.create_dataset("stat_err", data=np.ones(shape))
+
+
+@pytest.mark.run(order=1)
+def test_pha_writer_from_result_files(tmp_path):
+    from astropy.io import fits
+
+    from gbmbkgpy.io.export import PHAWriter
+
+    time_bins = np.column_stack([np.arange(100.0), np.arange(1.0, 101.0)])
+
+    files = []
+    for det in ["n0", "n1", "na"]:
+        for echans in [["0", "1"], ["100"]]:
+            files.append(tmp_path / f"{det}_{echans[0]}.h5")
+            _write_result_file(files[-1], [det], echans, time_bins)
+
+    output_path = tmp_path / "combined.h5"
+    pha_writer = PHAWriter.from_result_files(files, output_path=output_path, max_workers=2)
+
+    assert pha_writer._detectors == ["n0", "n1", "na"]
+    assert pha_writer._observed_counts.shape == (100, 14, 128)
+    assert np.all(pha_writer._observed_counts[:, 10, 100] == 10100)
+    assert np.all(pha_writer._model_counts[:, 1, 1] == 1001.5)
+    assert np.all(pha_writer._observed_counts[:, 2, :] == 0)
+
+    # the counts are read from the combined file
+    assert isinstance(pha_writer._observed_counts, h5py.Dataset)
+
+    combined = PHAWriter.from_combined_hdf5(output_path)
+    assert np.array_equal(combined._observed_counts, pha_writer._observed_counts)
+    assert np.array_equal(combined._time_bins, time_bins)
+
+    pha_writer.write_pha(str(tmp_path), 10, 20, trigger_time=0.0, file_name="h5")
+    combined.write_pha(str(tmp_path), 10, 20, trigger_time=0.0, file_name="mem")
+
+    with fits.open(tmp_path / "h5_na_bak.pha") as f_h5, fits.open(
+        tmp_path / "mem_na_bak.pha"
+    ) as f_mem:
+        assert np.array_equal(f_h5["SPECTRUM"].data["RATE"], f_mem["SPECTRUM"].data["RATE"])
+
+    pha_writer.close()
+    assert not pha_writer._observed_counts
+
+    # the combined file is closed after the with block
+    with PHAWriter.from_result_files(files, output_path=output_path) as pha_writer:
+        assert np.all(pha_writer._stat_err[:, 0, 1] == 1)
+    assert not pha_writer._stat_err
+
+    # detector/echan combinations can only be loaded once
+    with pytest.raises(AssertionError):
+        PHAWriter.from_result_files(files + files[:1])
+
+    # all files need the same time bins
+    _write_result_file(tmp_path / "shifted.h5", ["n2"], ["0"], time_bins + 1)
+    with pytest.raises(AssertionError):
+        PHAWriter.from_result_files(files + [tmp_path / "shifted.h5"])
+
+    # no half written combined file is left
+    failed_path = tmp_path / "failed.h5"
+    with pytest.raises(AssertionError):
+        PHAWriter.from_result_files(files + files[:1], output_path=failed_path)
+    assert not failed_path.exists()
+
+
+@pytest.mark.run(order=2)
+def test_write_phaii(tmp_path):
+    from astropy.io import fits
+
+    from gbmbkgpy.utils.pha import write_phaii
+
+    rng = np.random.default_rng(0)
+
+    n_rows = 1000
+    tstart = np.arange(n_rows) * 0.256
+    telapse = np.full(n_rows, 0.256)
+    rate = rng.random((n_rows, 8))
+    stat_err = rng.random((n_rows, 8))
+
+    for chunk_size, file_name in [(None, "all.pha"), (300, "chunks.pha")]:
+        write_phaii(
+            tmp_path / file_name,
+            tstart,
+            telapse,
+            np.arange(8),
+            rate,
+            telapse,
+            stat_err=stat_err,
+            telescope_name="Fermi",
+            chunk_size=chunk_size,
+        )
+
+    with fits.open(tmp_path / "all.pha") as f_all, fits.open(
+        tmp_path / "chunks.pha"
+    ) as f_chunks:
+        assert f_chunks["SPECTRUM"].header["NAXIS2"] == n_rows
+        assert f_chunks["SPECTRUM"].header["HDUCLAS4"] == "TYPEII"
+
+        for name in f_all["SPECTRUM"].columns.names:
+            assert np.array_equal(
+                f_all["SPECTRUM"].data[name], f_chunks["SPECTRUM"].data[name]
+            )
+
+        assert np.array_equal(f_chunks["SPECTRUM"].data["RATE"], rate)
+        assert np.array_equal(f_chunks["SPECTRUM"].data["SPEC_NUM"], np.arange(1, 1001))
+
+
+@pytest.mark.run(order=3)
+def test_pha_writer_write_pha(tmp_path):
+    from astropy.io import fits
+
+    from gbmbkgpy.io.export import PHAWriter
+
+    time_bins = np.column_stack([np.arange(100.0), np.arange(1.0, 101.0)])
+
+    files = []
+    for det in ["n0", "n1"]:
+        files.append(tmp_path / f"{det}.h5")
+        _write_result_file(files[-1], [det], ["1", "2"], time_bins, data_type="ctime")
+
+    pha_writer = PHAWriter.from_result_files(files)
+    pha_writer.write_pha(str(tmp_path), 10, 20, trigger_time=0.0, file_name="test")
+
+    with fits.open(tmp_path / "test_n1_bak.pha") as f:
+        data = f["SPECTRUM"].data
+        assert np.array_equal(data["CHANNEL"][0], [1, 2])
+        # model counts 1001.5 and 1002.5 per bin in 10 bins of 1 s
+        assert np.allclose(data["RATE"][0], [1001.5, 1002.5])
+        assert f["SPECTRUM"].header["INSTRUME"] == "GBM_NAI_01"
+
+    assert (tmp_path / "test_n0.pha").exists()
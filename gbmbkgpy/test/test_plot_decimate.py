@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from gbmbkgpy.io.plotting.decimate import decimate, min_max_indices
+
+
+@pytest.mark.run(order=1)
+def test_decimate():
+    x = np.arange(100000.0)
+    y = np.sin(x / 5000.0)
+    y[12345] = 10
+    y[54321] = -10
+    y[777] = np.nan
+
+    idx = min_max_indices(x, y, 100)
+
+    assert len(idx) <= 200
+    assert np.all(np.diff(idx) > 0)
+    assert 12345 in idx and 54321 in idx
+    assert 777 not in idx
+
+    # the extrema of every column are kept
+    column = np.minimum((x / (x[-1] / 100)).astype(int), 99)
+    for c in [0, 37, 99]:
+        in_column = np.flatnonzero((column == c) & np.isfinite(y))
+        assert in_column[np.argmax(y[in_column])] in idx
+        assert in_column[np.argmin(y[in_column])] in idx
+
+    z = np.cos(x / 5000.0)
+    idx_both = decimate(x, [y, z], 100)
+    assert np.all(np.isin(idx, idx_both))
+    assert np.all(np.isin(min_max_indices(x, z, 100), idx_both))
+
+    # short curves are not decimated
+    assert np.array_equal(decimate(x[:150], [y[:150]], 100), np.arange(150))
@@ -0,0 +1,159 @@
+import collections
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from astromodels import Constant, Exponential_cutoff
+
+from gbmbkgpy.modeling.functions import AstromodelFunctionVector
+from gbmbkgpy.modeling.model import ModelCombine, ModelDet
+from gbmbkgpy.modeling.ppc import PPCEngine
+from gbmbkgpy.modeling.source import NormOnlySource, SAASource
+
+
+class _TestData:
+    def __init__(self, num_bins=200, num_echan=3):
+        edges = np.linspace(0, 2000, num_bins + 1)
+        self.time_bins = np.stack((edges[:-1], edges[1:]), axis=-1)
+        self.fit_time_bins = self.time_bins
+        self.num_echan = num_echan
+        self.fit_counts = np.zeros((num_bins, num_echan))
+
+
+def _build_model():
+    data = _TestData()
+    model = ModelDet(data)
+
+    def rates(time_bins):
+        return 1 + 0.5 * np.sin(time_bins / 300.0)
+
+    cr = NormOnlySource("cr", rates, AstromodelFunctionVector(data.num_echan))
+    cr.fit_model.vector[1].k.fix = True
+    cr.fit_model.vector[1].k.value = 2.0
+    model.add_source(cr)
+
+    const = Constant()
+    model.add_source(NormOnlySource("const", lambda t: 0.1 * np.ones((len(t), 2, 3)), const))
+
+    saa = AstromodelFunctionVector(data.num_echan, Exponential_cutoff())
+    for f in saa.vector:
+        f.K.bounds = (0, None)
+        f.xc.value = 100.0
+    model.add_source(SAASource("saa", 0.0, saa))
+
+    return model
+
+
+@pytest.mark.run(order=1)
+def test_ppc_engine_matches_model():
+    model = _build_model()
+
+    rng = np.random.default_rng(1)
+    start_values = np.array([p.value for p in model.parameter.values()])
+    samples = start_values * rng.uniform(0.5, 1.5, (20, len(start_values)))
+
+    time_bins = model.data.time_bins[::3]
+    engine = PPCEngine(model, time_bins=time_bins, chunk_size=7, seed=2)
+
+    expected = engine.expected_counts(samples)
+
+    # parameters of the model are untouched
+    assert np.allclose([p.value for p in model.parameter.values()], start_values)
+
+    for i, s in enumerate(samples):
+        model.set_parameters(s)
+        assert np.allclose(
+            expected[i], model.get_model_counts(time_bins=time_bins)
+        )
+    model.set_parameters(start_values)
+
+    counts = engine.ppc_counts(samples, echans=[2])
+    assert counts.shape == (20, len(time_bins), 1)
+
+    percentiles = engine.ppc_percentiles([5, 95], samples, block_size=17)
+    assert percentiles.shape == (2, len(time_bins), model.data.num_echan)
+    assert np.all(percentiles[0] <= percentiles[1])
+
+
+@pytest.mark.run(order=2)
+def test_ppc_engine_model_combine():
+    model_dets = [_build_model(), _build_model()]
+    combined = ModelCombine(*model_dets)
+
+    # the detectors share the parameters with the same names
+    model_dets[1].parameter["const_k"].value = 0.5
+    names = list(combined.parameter.keys())
+    assert len(names) == len(model_dets[0].parameter)
+
+    rng = np.random.default_rng(3)
+    start_values = [
+        np.array([p.value for p in m.parameter.values()]) for m in model_dets
+    ]
+    samples = start_values[0] * rng.uniform(0.5, 1.5, (5, len(names)))
+
+    engine = PPCEngine(combined, chunk_size=2, seed=4)
+
+    expected = engine.expected_counts(samples, echans=[0, 2])
+    assert expected.shape == (5, len(model_dets[0].data.time_bins), 2, 2)
+
+    # parameters of the detectors are untouched
+    for m, values in zip(model_dets, start_values):
+        assert np.allclose([p.value for p in m.parameter.values()], values)
+
+    for i, s in enumerate(samples):
+        for d, m in enumerate(model_dets):
+            for name, value in zip(names, s):
+                m.parameter[name].value = value
+            assert np.allclose(expected[i, :, d], m.get_model_counts()[:, [0, 2]])
+
+    assert engine.ppc_counts(samples).shape == (5, 200, 2, 3)
+    percentiles = engine.ppc_percentiles([16, 84], samples, block_size=70)
+    assert percentiles.shape == (2, 200, 2, 3)
+
+    with pytest.raises(AssertionError):
+        PPCEngine(SimpleNamespace(parameter={}))
+
+
+class _LegacyModel:
+    """
+    Model of a model generator, the counts are linear in the free parameters
+    """
+
+    def __init__(self):
+        self.free_parameters = collections.OrderedDict(
+            (name, SimpleNamespace(value=1.0)) for name in ["a", "b"]
+        )
+
+    def get_counts(self, time_bins):
+        a, b = [p.value for p in self.free_parameters.values()]
+        return np.outer(a + b * time_bins[:, 0], [1.0, 10.0])
+
+
+@pytest.mark.run(order=3)
+def test_data_exporter_legacy_model():
+    from gbmbkgpy.io.export import DataExporter, _LegacyModelPPC
+
+    exporter = DataExporter.__new__(DataExporter)
+    exporter._model = _LegacyModel()
+    exporter._time_bins = np.column_stack([np.arange(100.0), np.arange(1.0, 101.0)])
+    exporter._ppc_engine = None
+
+    engine = exporter._get_ppc_engine()
+    assert isinstance(engine, _LegacyModelPPC)
+
+    samples = np.array([[1000.0, 0.0], [0.0, 50.0], [10.0, 1.0]])
+
+    counts = engine.ppc_counts(samples)
+    assert counts.shape == (3, 100, 2)
+    assert np.isclose(counts[0].mean(axis=0)[1], 10000, rtol=0.01)
+    assert np.all(counts[1, 0] == 0)
+
+    # the model of the model generator is untouched
+    assert [p.value for p in exporter._model.free_parameters.values()] == [1.0, 1.0]
+
+    assert exporter.get_synthetic_data(samples[2]).shape == (100, 2)
+
+    exporter._model = _build_model()
+    exporter._ppc_engine = None
+    assert isinstance(exporter._get_ppc_engine(), PPCEngine)
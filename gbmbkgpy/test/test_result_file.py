@@ -0,0 +1,72 @@
+import h5py
+import numpy as np
+import pytest
+
+from gbmbkgpy.io.result_file import (
+    ResultFile,
+    write_result_dataset,
+    write_time_bins,
+)
+
+
+@pytest.mark.run(order=1)
+def test_result_file_window(tmp_path):
+    n_bins = 5000
+    detectors = ["n0", "n1", "na", "b0"]
+
+    time_bins = np.column_stack([np.arange(n_bins), np.arange(1, n_bins + 1)]) + 5e8
+    # a gap in the data
+    time_bins[3000:] += 100
+
+    counts = np.arange(n_bins * 4 * 8, dtype=float).reshape((n_bins, 4, 8))
+    ppc = np.stack([counts, counts + 1])
+
+    file_path = tmp_path / "result.hdf5"
+    with h5py.File(file_path, "w") as f:
+        f.attrs["detectors"] = detectors
+        f.attrs["echans"] = [str(e) for e in range(8)]
+        f.attrs["data_type"] = "ctime"
+        f.attrs["dates"] = ["180407"]
+        write_time_bins(f, time_bins)
+        write_result_dataset(f, "saa_mask", np.ones(n_bins, dtype=bool))
+        write_result_dataset(f, "observed_counts", counts)
+        write_result_dataset(f.create_group("sources"), "cgb", counts * 2)
+        f.create_dataset("ppc_time_bins", data=time_bins)
+        write_result_dataset(f, "ppc_counts", ppc, time_axis=1)
+
+        assert f["observed_counts"].chunks[1:] == (4, 8)
+        assert f["ppc_counts"].chunks[0] == 2
+
+    with ResultFile(file_path) as result:
+        assert result.schema_version == 2
+
+        window = result.read_window(
+            5e8 + 2040.5,
+            5e8 + 3110,
+            detectors=["na", "n1"],
+            datasets=["observed_counts", "ppc_counts"],
+        )
+
+        # the bins 2040-2999 and 3000-3009 overlap with the window
+        idx = np.arange(2040, 3010)
+        assert window["detectors"] == ["n1", "na"]
+        assert np.array_equal(window["time_bins"], time_bins[idx])
+        assert np.array_equal(window["observed_counts"], counts[idx][:, [1, 2]])
+        assert np.array_equal(window["sources"]["cgb"], 2 * counts[idx][:, [1, 2]])
+        assert np.array_equal(window["ppc_counts"], ppc[:, idx][:, :, [1, 2]])
+
+        # window in the gap
+        window = result.read_window(5e8 + 3050, 5e8 + 3060, datasets=[])
+        assert len(window["time_bins"]) == 0
+
+    # result files without a time index
+    with h5py.File(file_path, "a") as f:
+        del f["time_index"]
+        del f.attrs["schema_version"]
+
+    with ResultFile(file_path) as result:
+        assert result.schema_version == 1
+        window = result.read_window(
+            5e8 + 10, 5e8 + 20, datasets=["observed_counts"], sources=False
+        )
+        assert np.array_equal(window["observed_counts"], counts[10:20])
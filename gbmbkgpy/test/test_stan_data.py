@@ -0,0 +1,396 @@
+import numpy as np
+import pytest
+
+from gbmbkgpy.stan.stan import _linear_interp, _linear_interp_weights
+
+
+@pytest.mark.run(order=1)
+def test_linear_interp():
+    xp = np.linspace(0, 100, 11)
+    values = np.random.default_rng(2).random((11, 3, 2))
+
+    x = np.array([0.0, 3.5, 50.0, 99.9, 100.0])
+
+    idx, weights = _linear_interp_weights(x, xp)
+    result = _linear_interp(values, idx, weights)
+
+    for i in range(3):
+        for j in range(2):
+            assert np.allclose(result[:, i, j], np.interp(x, xp, values[:, i, j]))
+
+    with pytest.raises(AssertionError):
+        _linear_interp_weights(np.array([101.0]), xp)
+
+
+@pytest.mark.run(order=2)
+def test_cmdstan_json_writer(tmp_path):
+    import json
+
+    from gbmbkgpy.stan.data_writer import CmdStanJSONWriter
+
+    rng = np.random.default_rng(3)
+
+    data = dict(
+        num_dets=3,
+        scale=0.5,
+        counts=rng.integers(0, 100, 20),
+        time_bins=rng.random((20, 2)),
+        mu_norm_saa=rng.random((2, 3, 4)),
+        empty=np.zeros(0),
+    )
+    response = rng.random((2, 10, 5)).astype(np.float32)
+
+    file_path = tmp_path / "data.json"
+
+    with CmdStanJSONWriter(file_path, block_size=3) as writer:
+        for name, value in data.items():
+            writer.write(name, value)
+
+        out = writer.create_array("response", response.shape, response.dtype)
+        for i in range(2):
+            for start in range(0, 10, 4):
+                out[i, start : start + 4] = response[i, start : start + 4]
+
+    with open(file_path) as f:
+        result = json.load(f)
+
+    for name, value in data.items():
+        assert np.array_equal(np.array(result[name]), value)
+
+    assert np.array_equal(np.array(result["response"], dtype=np.float32), response)
+
+
+@pytest.mark.run(order=3)
+def test_grainsize(tmp_path):
+    import json
+
+    from gbmbkgpy.stan.data_writer import CmdStanJSONWriter
+    from gbmbkgpy.stan.grainsize import (
+        GrainsizeCache,
+        heuristic_grainsize,
+        set_json_grainsize,
+    )
+
+    assert heuristic_grainsize(1000, 1) == 1
+    assert heuristic_grainsize(1000, 64) == 15
+
+    file_path = tmp_path / "data.json"
+
+    with CmdStanJSONWriter(file_path) as writer:
+        writer.write("counts", np.arange(10))
+        writer.write("grainsize", 1)
+
+    for grainsize in [12345, 3]:
+        set_json_grainsize(file_path, grainsize)
+
+        with open(file_path) as f:
+            data = json.load(f)
+
+        assert data["grainsize"] == grainsize
+        assert data["counts"] == list(range(10))
+
+    cache = GrainsizeCache(tmp_path / "grainsize.json")
+    assert cache.get("a") is None
+    cache.set("a", 7, {7: 0.1, 14: 0.2})
+    assert cache.get("a") == 7
+
+
+@pytest.mark.run(order=4)
+def test_block_layout():
+    from types import SimpleNamespace
+
+    from gbmbkgpy.stan.stan import StanDataConstructor
+
+    rng = np.random.default_rng(4)
+
+    num_bins, num_dets, num_echans, num_Ein = 7, 3, 2, 4
+    dets = ["n0", "n1", "n2"]
+
+    def effective_responses():
+        return {d: rng.random((11, num_Ein, num_echans)) for d in dets}
+
+    # constructor without data and model, only the attributes that are needed
+    sdc = StanDataConstructor.__new__(StanDataConstructor)
+    sdc._dets = dets
+    sdc._ndets = num_dets
+    sdc._nechans = num_echans
+    sdc._num_Ebins_in = num_Ein
+    sdc._dtype = np.dtype(np.float64)
+    sdc._chunk_size = 3
+    sdc._geometry = SimpleNamespace(geometry_times=np.linspace(0, 100, 11))
+    sdc._used_time_bins = np.column_stack(
+        (np.linspace(1, 80, num_bins), np.linspace(1, 80, num_bins) + 5)
+    )
+    sdc._free_spectrum_responses = dict(
+        base_response_array_free_ps=[effective_responses(), effective_responses()],
+        base_response_array_earth=[effective_responses()],
+    )
+    sdc._counts = rng.integers(0, 100, (num_bins, num_dets, num_echans))
+    sdc._mask_zeros = np.ones(num_bins, dtype=bool)
+    sdc._global_counts = rng.random((1, num_bins, num_dets, num_echans))
+    sdc._cont_counts = rng.random((2, num_bins, num_dets, num_echans))
+
+    data_dict = dict(base_counts_array=None, base_counts_array_cont=None)
+    sdc._to_block_layout(data_dict)
+
+    earth = sdc.build_response_array("base_response_array_earth")
+    free_ps = sdc.build_response_array("base_response_array_free_ps")
+    block = sdc.build_block_response_array()
+
+    assert data_dict["num_base_comp"] == 3
+    assert data_dict["num_free_comp"] == 3
+
+    for i in range(num_dets):
+        for j in range(num_echans):
+            b = i * num_echans + j
+            # row of (time bin t, det i, echan j) in the flattened layout
+            rows = np.arange(num_bins) * num_dets * num_echans + i * num_echans + j
+
+            assert np.array_equal(data_dict["counts"][b], sdc._counts[:, i, j])
+            assert np.array_equal(
+                data_dict["base_counts_block"][b, :, 0], sdc._global_counts[0, :, i, j]
+            )
+            assert np.array_equal(
+                data_dict["base_counts_block"][b, :, 2], sdc._cont_counts[1, :, i, j]
+            )
+
+            # earth first, then the free point sources
+            assert np.allclose(block[b, :, :num_Ein], earth[rows])
+            assert np.allclose(block[b, :, 2 * num_Ein :], free_ps[1, rows])
+
+
+@pytest.mark.run(order=5)
+def test_read_stan_arviz_result(tmp_path):
+    import arviz as av
+
+    from gbmbkgpy.stan.stan import ReadStanArvizResult
+
+    rng = np.random.default_rng(5)
+
+    num_points = 2 * 3 * 4
+    nc_files = []
+    samples = {"tot": [], "f_free_ps": [], "ppc": []}
+
+    for i in range(2):
+        predictions = dict(
+            tot=rng.random((2, 30, num_points)),
+            f_free_ps=rng.random((2, 30, 2, num_points)),
+        )
+        ppc = rng.poisson(10, (2, 30, num_points))
+
+        idata = av.from_dict(
+            posterior_predictive={"ppc": ppc},
+            predictions=predictions,
+            constant_data={
+                "time_bins": np.column_stack((np.arange(4.0), np.arange(4.0) + 1)),
+                "dets": np.array(["n0", "n1"]),
+                "echans": np.array([0, 1, 2]),
+            },
+            observed_data={"counts": rng.poisson(10, num_points)},
+        )
+
+        nc_files.append(str(tmp_path / f"result_{i}.nc"))
+        idata.to_netcdf(nc_files[-1])
+
+        for key, value in dict(predictions, ppc=ppc).items():
+            samples[key].append(value.reshape(-1, *value.shape[2:]))
+
+    # small blocks, so the values are read in several blocks of data points and draws
+    result = ReadStanArvizResult(nc_files, percentiles=(5, 50, 95), max_elements=100)
+
+    for key, value in samples.items():
+        expected = np.percentile(np.concatenate(value), (5, 50, 95), axis=0)
+        assert np.allclose(result.percentiles[key], expected)
+
+    # the second reader uses the cached percentiles
+    cached = ReadStanArvizResult(nc_files, percentiles=(5, 50, 95))
+    for key in samples.keys():
+        assert np.array_equal(cached.percentiles[key], result.percentiles[key])
+
+
+@pytest.mark.run(order=6)
+def test_thin_stan_csv(tmp_path):
+    from types import SimpleNamespace
+
+    from gbmbkgpy.stan.generated_quantities import (
+        num_sampling_draws,
+        run_generated_quantities,
+        thin_stan_csv,
+    )
+
+    csv_file = tmp_path / "fit.csv"
+    out_file = tmp_path / "fit_thin.csv"
+
+    lines = [
+        "# model = model_model",
+        "# method = sample (Default)",
+        "#   sample",
+        "#     num_samples = 10",
+        "#     num_warmup = 4",
+        "#     save_warmup = 1",
+        "#     thin = 1 (Default)",
+        "# random",
+        "#   seed = 4321",
+        "lp__,accept_stat__,a",
+    ]
+    lines += [f"-1,0.9,{-i}" for i in range(1, 5)]
+    lines += ["# Adaptation terminated", "# Step size = 0.5"]
+    lines += [f"-1,0.9,{i}" for i in range(1, 11)]
+    lines += ["# ", "#  Elapsed Time: 0.1 seconds (Warm-up)"]
+
+    csv_file.write_text("\n".join(lines) + "\n")
+
+    assert num_sampling_draws(csv_file) == 10
+
+    thin_stan_csv(csv_file, out_file, 3)
+
+    text = out_file.read_text()
+    draws = [l for l in text.splitlines() if not l.startswith("#")][1:]
+
+    assert [int(l.split(",")[-1]) for l in draws] == [1, 4, 7, 10]
+    assert "#     thin = 3\n" in text
+    assert "#     save_warmup = 0\n" in text
+    assert num_sampling_draws(out_file) == 4
+
+    # the generated quantities use the seed of the fit by default
+    calls = []
+
+    def generate_quantities(data, seed, gq_output_dir, previous_fit):
+        calls.append(seed)
+
+    model = SimpleNamespace(generate_quantities=generate_quantities)
+
+    run_generated_quantities(model, {}, [csv_file], output_dir=tmp_path / "gq")
+    run_generated_quantities(model, {}, [csv_file], seed=1, thin=2)
+    assert calls == [4321, 1]
+
+
+@pytest.mark.run(order=7)
+def test_build_sources_once():
+    from gbmbkgpy.stan.stan import StanDataConstructor
+
+    sdc = StanDataConstructor.__new__(StanDataConstructor)
+    sdc._param_lookup = []
+    sdc._sources_built = False
+
+    def builder(name):
+        def build():
+            sdc._param_lookup.append(dict(name=name))
+
+        return build
+
+    for name in ["global_sources", "continuum_sources", "saa_sources", "free_spectrum_sources"]:
+        setattr(sdc, name, builder(name))
+
+    # e.g. construct_data_dict followed by save_data_json
+    sdc._build_sources()
+    sdc._build_sources()
+
+    assert [p["name"] for p in sdc.param_lookup] == [
+        "global_sources",
+        "continuum_sources",
+        "saa_sources",
+        "free_spectrum_sources",
+    ]
+
+
+@pytest.mark.run(order=8)
+def test_gp_basis_frequencies():
+    from gbmbkgpy.stan.stan import StanModelConstructor, gp_basis_frequencies
+
+    omega = gp_basis_frequencies(10)
+
+    assert np.all(omega > 0)
+    assert len(np.unique(omega)) == 10
+    assert np.array_equal(omega, gp_basis_frequencies(10))
+
+    # the cos and sin columns of the basis are independent (range1 = 0.05)
+    tw = np.outer(np.linspace(0, 1, 500), omega / 0.05)
+    assert np.linalg.matrix_rank(np.hstack((np.cos(tw), np.sin(tw)))) == 20
+
+    # the precomputed basis has no random numbers in the transformed data
+    smc = StanModelConstructor.__new__(StanModelConstructor)
+    smc._gp_basis = "precomputed"
+    smc._gp_num_basis = 10
+
+    text = smc._gp_basis_trans_data()
+    assert "_rng" not in text
+    assert "omega1 = gp_omega" in text
+
+
+class _GeneratedQuantities:
+    """
+    CmdStanGQ of cmdstanpy>=1.0 with one chain
+    """
+
+    def __init__(self, draws, column_names):
+        self._draws = draws
+        self._column_names = tuple(column_names)
+
+    @property
+    def column_names(self):
+        return self._column_names
+
+    def draws(self, *, concat_chains=False):
+        if concat_chains:
+            return self._draws
+        return self._draws[:, np.newaxis]
+
+
+@pytest.mark.run(order=9)
+def test_exporter_from_generated_quantities():
+    import collections
+    from types import SimpleNamespace
+
+    import pandas as pd
+
+    from gbmbkgpy.io.export import StanDataExporter
+
+    num_bins, num_echans, num_draws = 10, 2, 6
+    num_values = num_bins * num_echans
+
+    time = np.arange(num_bins + 4.0)
+    model_generator = SimpleNamespace(
+        data=SimpleNamespace(
+            counts=np.ones((num_bins + 4, 1, num_echans)),
+            detectors=["n0"],
+            echans=["1", "2"],
+            time_bins=np.column_stack((time, time + 1)),
+        ),
+        saa_calc=SimpleNamespace(saa_mask=np.ones(num_bins + 4, dtype=bool)),
+        model=SimpleNamespace(
+            global_sources=collections.OrderedDict(cgb=None),
+            continuum_sources=collections.OrderedDict(),
+        ),
+    )
+
+    rng = np.random.default_rng(5)
+    tot = rng.random((num_draws, num_values)) * 100
+    ppc = rng.poisson(tot).astype(float)
+    cgb = tot / 2
+
+    column_names = (
+        [f"tot[{i}]" for i in range(1, num_values + 1)]
+        + [f"total_rate[{i}]" for i in range(1, num_values + 1)]
+        + [f"ppc[{i}]" for i in range(1, num_values + 1)]
+        + [f"f_fixed_global[1,{i}]" for i in range(1, num_values + 1)]
+    )
+    draws = np.hstack((tot, tot + 1, ppc, cgb))
+
+    stan_fit = SimpleNamespace(
+        summary=lambda: pd.DataFrame({"Mean": [3.0]}, index=["norm[1]"])
+    )
+    param_lookup = [dict(name="norm_cgb", stan_param_name="norm[1]", scale=2.0)]
+
+    exporter = StanDataExporter.from_generated_quantities(
+        model_generator,
+        _GeneratedQuantities(draws, column_names),
+        stan_fit,
+        param_lookup,
+    )
+
+    shape = (num_draws, num_bins, 1, num_echans)
+    assert np.array_equal(exporter._model_counts, tot.reshape(shape))
+    assert np.array_equal(exporter._sources["cgb"], cgb.reshape(shape))
+    assert exporter._num_ppc_samples == num_draws
+    assert np.allclose(exporter._best_fit_parameters, [6.0])
@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from gbmbkgpy.stan.driver import ParallelChains, chain_cpu_sets
+
+
+@pytest.mark.run(order=1)
+def test_parallel_chains(tmp_path):
+    assert chain_cpu_sets(2, 3, cpus=list(range(8))) == [[0, 1, 2], [3, 4, 5]]
+
+    with pytest.raises(AssertionError):
+        chain_cpu_sets(3, 3, cpus=list(range(8)))
+
+    # executable with the command line of CmdStan that writes the
+    # thread count, the cpu affinity and the seed to the output file
+    exe_file = tmp_path / "model"
+    exe_file.write_text(
+        f"#!{sys.executable}\n"
+        "import os, sys\n"
+        "args = dict(a.split('=', 1) for a in sys.argv[1:] if '=' in a)\n"
+        "print('Iteration: 10 / 10 [100%]  (Sampling)')\n"
+        "with open(args['file'], 'w') as f:\n"
+        "    f.write(os.environ['STAN_NUM_THREADS'] + ';')\n"
+        "    f.write(','.join(map(str, sorted(os.sched_getaffinity(0)))) + ';')\n"
+        "    f.write(args['seed'] + ';' + args['id'] + ';' + args['init'])\n"
+    )
+    exe_file.chmod(0o755)
+
+    data_file = tmp_path / "data.json"
+    data_file.write_text("{}")
+
+    cpus = sorted(os.sched_getaffinity(0))[:2]
+    chains = len(cpus)
+
+    driver = ParallelChains(
+        SimpleNamespace(exe_file=exe_file),
+        data_file,
+        chains=chains,
+        threads_per_chain=1,
+        output_dir=tmp_path / "chains",
+        cpus=cpus,
+    )
+
+    csv_files = driver.run(
+        seed=5, inits=[{"a": 1}, {"a": 2}][:chains], poll_interval=0.1
+    )
+
+    for chain, csv_file in enumerate(csv_files):
+        threads, cpu_set, seed, chain_id, init_file = open(csv_file).read().split(";")
+
+        assert threads == "1"
+        assert cpu_set == str(cpus[chain])
+        assert seed == "5"
+        assert chain_id == str(chain + 1)
+
+        with open(init_file) as f:
+            assert json.load(f) == {"a": chain + 1}
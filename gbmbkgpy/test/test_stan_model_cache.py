@@ -0,0 +1,33 @@
+import pytest
+
+from gbmbkgpy.stan.model_cache import StanModelCache, stan_model_hash
+
+
+@pytest.mark.run(order=1)
+def test_stan_model_hash(tmp_path, monkeypatch):
+    (tmp_path / "powerlaw.stan").write_text("real pl(real x) { return x; }\n")
+
+    code = "functions { \n\t#include powerlaw.stan\n}\n"
+
+    h = stan_model_hash(code, {"STAN_THREADS": "TRUE"}, include_paths=[tmp_path])
+
+    # independent of the order of the options
+    assert h == stan_model_hash(
+        code, dict(STAN_THREADS="TRUE"), include_paths=[tmp_path]
+    )
+    assert h != stan_model_hash(code, None, include_paths=[tmp_path])
+    assert h != stan_model_hash(code + " ", {"STAN_THREADS": "TRUE"}, include_paths=[tmp_path])
+
+    # changes of included files change the hash
+    (tmp_path / "powerlaw.stan").write_text("real pl(real x) { return 2*x; }\n")
+    assert h != stan_model_hash(code, {"STAN_THREADS": "TRUE"}, include_paths=[tmp_path])
+
+    cache = StanModelCache(cache_dir=tmp_path / "models")
+    assert not cache.is_compiled(h)
+
+    # the includes are searched in the working directory by default, like
+    # in StanModelCache.get_model
+    monkeypatch.chdir(tmp_path)
+    assert stan_model_hash(code, {"STAN_THREADS": "TRUE"}) == stan_model_hash(
+        code, {"STAN_THREADS": "TRUE"}, include_paths=[tmp_path]
+    )
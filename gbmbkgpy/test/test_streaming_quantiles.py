@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from gbmbkgpy.utils.statistics.streaming_quantiles import StreamingPercentiles
+
+
+@pytest.mark.run(order=1)
+def test_streaming_percentiles():
+    rng = np.random.default_rng(0)
+    data = rng.normal(0, 1, (5000, 50, 2))
+    percentiles = [0, 2.5, 16, 50, 84, 97.5, 100]
+    exact = np.percentile(data, percentiles, axis=0)
+
+    # exact as long as everything fits in the buffer
+    sp = StreamingPercentiles(percentiles, (50, 2), buffer_size=5000)
+    for start in range(0, len(data), 300):
+        sp.update(data[start : start + 300])
+
+    assert sp.exact
+    assert np.allclose(sp.percentiles, exact)
+    assert np.allclose(sp.mean, np.mean(data, axis=0))
+
+    # P² estimate after the buffer is full
+    sp = StreamingPercentiles(percentiles, (50, 2), buffer_size=100)
+    for start in range(0, len(data), 300):
+        sp.update(data[start : start + 300])
+
+    assert not sp.exact
+    assert sp.n == len(data)
+    assert np.allclose(sp.percentiles[[0, -1]], exact[[0, -1]])
+    assert np.mean(np.abs(sp.percentiles - exact)) < 0.05
@@ -0,0 +1,86 @@
+import collections
+import json
+
+import numpy as np
+import pytest
+from astromodels import Parameter
+from astromodels.functions.priors import Gaussian, Uniform_prior
+
+from gbmbkgpy.utils.warm_start import WarmStart, stan_parameter_shapes
+
+
+@pytest.mark.run(order=1)
+def test_warm_start(tmp_path):
+    rng = np.random.default_rng(0)
+
+    # posterior of the previous day in the MultiNest output format
+    post = np.column_stack(
+        [
+            rng.normal(2.0, 0.1, 500),
+            rng.normal(0.5, 0.01, 500),
+            rng.normal(-1000, 1, 500),
+        ]
+    )
+    np.savetxt(tmp_path / "fit_post_equal_weights.dat", post)
+
+    with open(tmp_path / "fit_params.json", "w") as f:
+        json.dump(["saa_0_norm", "saa_0_decay"], f)
+
+    warm_start = WarmStart.from_multinest(tmp_path)
+
+    parameters = collections.OrderedDict(
+        saa_0_norm=Parameter(
+            "norm", 1.0, min_value=0, max_value=10, prior=Gaussian(mu=1, sigma=5)
+        ),
+        saa_0_decay=Parameter(
+            "decay",
+            0.1,
+            min_value=0,
+            max_value=1,
+            prior=Uniform_prior(lower_bound=0, upper_bound=1),
+        ),
+        cr_norm=Parameter("norm", 3.0, min_value=0, max_value=10),
+    )
+
+    start = warm_start.start_values(parameters)
+    assert np.allclose(start, [2.0, 0.5, 3.0], atol=0.02)
+
+    points = warm_start.unit_cube_points(parameters, 100, seed=1)
+    assert points.shape == (100, 3)
+    assert np.all((points >= 0) & (points <= 1))
+    assert np.allclose(
+        [parameters["saa_0_decay"].prior.from_unit_cube(u) for u in points[:, 1]],
+        np.median(post[:, 1]),
+        atol=0.05,
+    )
+
+    changed = warm_start.tighten_priors(parameters, width=3)
+    assert changed == ["saa_0_norm", "saa_0_decay"]
+    assert parameters["saa_0_norm"].prior.sigma.value == pytest.approx(0.3, rel=0.1)
+    assert parameters["saa_0_decay"].prior.lower_bound.value == pytest.approx(
+        0.47, abs=0.01
+    )
+
+    # Stan inits via the param_lookup of the StanDataConstructor
+    stan_code = (
+        "parameters { \n"
+        "\treal log_norm_saa[num_saa_exits, num_dets_saa, num_echans];\n"
+        "\treal<lower=0.01,upper=10> decay_saa[num_saa_exits, num_dets_saa, num_echans];\n"
+        "\tvector<lower=0>[num_echans] raw_scale;\n"
+        "}\n"
+    )
+    shapes = stan_parameter_shapes(
+        stan_code, dict(num_saa_exits=1, num_dets_saa=1, num_echans=1)
+    )
+    assert shapes == dict(log_norm_saa=(1, 1, 1), decay_saa=(1, 1, 1), raw_scale=(1,))
+
+    param_lookup = [
+        dict(name="saa_0_norm", stan_param_name="norm_saa[1,1,1]", scale=1),
+        dict(name="saa_0_decay", stan_param_name="decay_saa[1,1,1]", scale=0.1),
+    ]
+
+    inits = warm_start.stan_inits(shapes, chains=2, param_lookup=param_lookup, seed=1)
+    assert len(inits) == 2
+    assert set(inits[0].keys()) == {"log_norm_saa", "decay_saa"}
+    assert np.exp(inits[0]["log_norm_saa"][0][0][0]) == pytest.approx(2.0, abs=0.5)
+    assert inits[0]["decay_saa"][0][0][0] == pytest.approx(5.0, abs=0.5)
@@ -1,3 +1,11 @@
+import numpy as np
+
+# Maximal size of one MPI message. Larger arrays are send in several rounds,
+# because the element counts of MPI are 32 bit integers and several MPI
+# implementations fail for messages above 2 GB.
+MAX_MESSAGE_BYTES = 2**31 - 1
+
+
 def check_mpi():
     """
     Check if mpi is available and which rank this thread is
@@ -23,3 +31,296 @@ def check_mpi():
         using_mpi = False
 
     return using_mpi, rank, size, comm
+
+
+def split_range(n, rank, size):
+    """
+    Split n elements in equal parts over all ranks
+    :param n: number of elements
+    :param rank: rank of this thread
+    :param size: size of the mpi cluster
+    :returns: lower and upper index of the elements of this rank
+    """
+    per_rank = float(n) / float(size)
+
+    return int(np.floor(per_rank * rank)), int(np.floor(per_rank * (rank + 1)))
+
+
+def _get_comm(comm):
+    if comm is None:
+        from mpi4py import MPI
+
+        comm = MPI.COMM_WORLD
+    return comm
+
+
+def _message_rounds(rows, row_bytes, max_bytes):
+    """
+    Number of rows every rank sends per round, so that the total message
+    of one round stays below max_bytes
+    """
+    if max_bytes is None:
+        max_bytes = MAX_MESSAGE_BYTES
+
+    rows_per_round = max(1, int(max_bytes // max(1, row_bytes * len(rows))))
+    num_rounds = max(1, int(np.ceil(np.max(rows) / rows_per_round)))
+
+    return rows_per_round, num_rounds
+
+
+def _varying(comm, local, all_ranks, root, max_bytes, out=None):
+    rank = comm.Get_rank()
+
+    local = np.ascontiguousarray(local)
+
+    rows = np.array(comm.allgather(len(local)), dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(rows)[:-1]))
+
+    row_shape = local.shape[1:]
+    row_size = int(np.prod(row_shape, dtype=np.int64))
+    row_bytes = row_size * local.dtype.itemsize
+
+    receive = all_ranks or rank == root
+
+    result = None
+    if receive:
+        if out is None:
+            result = np.empty((np.sum(rows), *row_shape), dtype=local.dtype)
+        else:
+            assert out.shape == (np.sum(rows), *row_shape) and out.flags[
+                "C_CONTIGUOUS"
+            ], "out must be a contiguous array with the shape of the result"
+            result = out
+
+    rows_per_round, num_rounds = _message_rounds(rows, row_bytes, max_bytes)
+
+    for k in range(num_rounds):
+        start = k * rows_per_round
+        round_rows = np.clip(rows - start, 0, rows_per_round)
+
+        send = local[start : start + round_rows[rank]]
+
+        if num_rounds == 1:
+            # receive directly in the result array
+            buffer = result
+        elif receive:
+            buffer = np.empty((np.sum(round_rows), *row_shape), dtype=local.dtype)
+
+        recvbuf = None
+        if receive:
+            round_offsets = np.concatenate(([0], np.cumsum(round_rows)[:-1]))
+            recvbuf = [buffer, (round_rows * row_size, round_offsets * row_size)]
+
+        if all_ranks:
+            comm.Allgatherv(send, recvbuf)
+        else:
+            comm.Gatherv(send, recvbuf, root=root)
+
+        if receive and num_rounds > 1:
+            # copy the parts of all ranks to their place in the result
+            pos = 0
+            for r in range(len(rows)):
+                result[
+                    offsets[r] + start : offsets[r] + start + round_rows[r]
+                ] = buffer[pos : pos + round_rows[r]]
+                pos += round_rows[r]
+
+    return result
+
+
+def gatherv_array(local, root=0, comm=None, max_bytes=None, out=None):
+    """
+    Gather numpy arrays with a different number of rows on every rank to
+    one array on the root rank. The arrays are send as buffers (no pickling)
+    and split in several messages if they are larger than max_bytes.
+    :param local: array of this rank, all arrays must have the same row shape and dtype
+    :param root: rank that receives the array
+    :param comm: MPI communicator, default COMM_WORLD
+    :param max_bytes: maximal size of one message, default MAX_MESSAGE_BYTES
+    :param out: preallocated array for the result on root
+    :returns: concatenated array on root, None on all other ranks
+    """
+    return _varying(_get_comm(comm), local, False, root, max_bytes, out=out)
+
+
+def allgatherv_array(local, comm=None, max_bytes=None):
+    """
+    Gather numpy arrays with a different number of rows on every rank to
+    one array on all ranks. The arrays are send as buffers (no pickling)
+    and split in several messages if they are larger than max_bytes.
+    :param local: array of this rank, all arrays must have the same row shape and dtype
+    :param comm: MPI communicator, default COMM_WORLD
+    :param max_bytes: maximal size of one message, default MAX_MESSAGE_BYTES
+    :returns: concatenated array
+    """
+    return _varying(_get_comm(comm), local, True, 0, max_bytes)
+
+
+def bcast_array(array, root=0, comm=None, max_bytes=None):
+    """
+    Broadcast a contiguous numpy array in place, split in several messages
+    if it is larger than max_bytes. The array must already have the right
+    shape and dtype on all ranks.
+    :param array: array to broadcast
+    :param root: rank that sends the array
+    :param comm: MPI communicator, default COMM_WORLD
+    :param max_bytes: maximal size of one message, default MAX_MESSAGE_BYTES
+    """
+    comm = _get_comm(comm)
+
+    flat = array.reshape(-1)
+
+    if max_bytes is None:
+        max_bytes = MAX_MESSAGE_BYTES
+
+    step = max(1, int(max_bytes // array.dtype.itemsize))
+
+    for start in range(0, max(len(flat), 1), step):
+        comm.Bcast(flat[start : start + step], root=root)
+
+
+class SharedArray(object):
+    def __init__(self, shape, dtype=float, comm=None):
+        """
+        Numpy array that is allocated only once per node in an MPI-3
+        shared memory window and can be read by all ranks of this node.
+        Only the first rank of every node should write to it, followed
+        by a call of barrier(). Without MPI this is a normal numpy array.
+        :param shape: shape of the array
+        :param dtype: dtype of the array
+        :param comm: MPI communicator, default COMM_WORLD if MPI is used
+        """
+        _, _, _, world = check_mpi()
+
+        self._shape = tuple(shape)
+        self._dtype = np.dtype(dtype)
+
+        self._win = None
+        self._node_comm = None
+        self._leader_comm = None
+
+        if comm is None:
+            comm = world
+
+        if comm is None:
+            self._array = np.empty(self._shape, dtype=self._dtype)
+            return
+
+        from mpi4py import MPI
+
+        self._comm = comm
+        self._node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+
+        itemsize = self._dtype.itemsize
+
+        nbytes = 0
+        if self._node_comm.Get_rank() == 0:
+            nbytes = int(np.prod(self._shape, dtype=np.int64)) * itemsize
+
+        self._win = MPI.Win.Allocate_shared(nbytes, itemsize, comm=self._node_comm)
+
+        buf, _ = self._win.Shared_query(0)
+
+        self._array = np.ndarray(buffer=buf, dtype=self._dtype, shape=self._shape)
+
+        # communicator of the first ranks of all nodes
+        color = 0 if self._node_comm.Get_rank() == 0 else MPI.UNDEFINED
+        self._leader_comm = comm.Split(color, comm.Get_rank())
+        if self._leader_comm == MPI.COMM_NULL:
+            self._leader_comm = None
+
+    def barrier(self):
+        """
+        Synchronize all ranks of this node after writing to the array
+        """
+        if self._node_comm is not None:
+            self._node_comm.Barrier()
+
+    def bcast_from(self, root=0):
+        """
+        Broadcast the array from the node of rank root to all other nodes.
+        Root has to be the first rank of its node.
+        """
+        if self._leader_comm is not None:
+            # rank of root in the communicator of the node leaders
+            world_ranks = self._leader_comm.allgather(self._comm.Get_rank())
+            assert root in world_ranks, "root must be the first rank of its node"
+
+            bcast_array(
+                self._array, root=world_ranks.index(root), comm=self._leader_comm
+            )
+
+        self.barrier()
+
+    def free(self):
+        """
+        Free the shared memory window
+        """
+        if self._win is not None:
+            self._win.Free()
+            self._win = None
+            self._array = None
+
+    @property
+    def array(self):
+        return self._array
+
+    @property
+    def node_rank(self):
+        """
+        Rank of this thread within its node
+        """
+        return 0 if self._node_comm is None else self._node_comm.Get_rank()
+
+    @property
+    def node_size(self):
+        """
+        Number of ranks on this node
+        """
+        return 1 if self._node_comm is None else self._node_comm.Get_size()
+
+    @property
+    def is_writer(self):
+        """
+        If this rank has to fill the array
+        """
+        return self._node_comm is None or self._node_comm.Get_rank() == 0
+
+
+def allgatherv_shared(local, comm=None, max_bytes=None):
+    """
+    Like allgatherv_array, but the result is stored only once per node
+    in a SharedArray.
+    :param local: array of this rank, all arrays must have the same row shape and dtype
+    :param comm: MPI communicator, default COMM_WORLD
+    :param max_bytes: maximal size of one message, default MAX_MESSAGE_BYTES
+    :returns: SharedArray with the concatenated array
+    """
+    _, _, _, world = check_mpi()
+
+    if comm is None:
+        comm = world
+
+    local = np.ascontiguousarray(local)
+
+    if comm is None:
+        shared = SharedArray(local.shape, local.dtype)
+        shared.array[:] = local
+        return shared
+
+    num_rows = sum(comm.allgather(len(local)))
+
+    shared = SharedArray((num_rows, *local.shape[1:]), local.dtype, comm=comm)
+
+    # gather directly into the shared memory of the first node
+    gatherv_array(
+        local,
+        root=0,
+        comm=comm,
+        max_bytes=max_bytes,
+        out=shared.array if comm.Get_rank() == 0 else None,
+    )
+
+    shared.bcast_from(root=0)
+
+    return shared
@@ -0,0 +1,320 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from gbmbkgpy import __version__
+from gbmbkgpy.io.fits_file import FITSFile
+
+
+def _spectrum_dtype(n_channels, is_poisson):
+    """
+    Big endian record of one row of an OGIP PHA type II SPECTRUM table
+    """
+    fields = [
+        ("SPEC_NUM", ">i4"),
+        ("TSTART", ">f8"),
+        ("TELAPSE", ">f8"),
+        ("EXPOSURE", ">f8"),
+        ("CHANNEL", ">i2", (n_channels,)),
+        ("RATE", ">f8", (n_channels,)),
+    ]
+
+    if not is_poisson:
+        fields.append(("STAT_ERR", ">f8", (n_channels,)))
+
+    fields += [
+        ("SYS_ERR", ">f8", (n_channels,)),
+        ("QUALITY", ">i2", (n_channels,)),
+        ("GROUPING", ">i2", (n_channels,)),
+    ]
+
+    return np.dtype(fields)
+
+
+_units = {
+    "TSTART": "s",
+    "TELAPSE": "s",
+    "EXPOSURE": "s",
+    "RATE": "count/s",
+    "STAT_ERR": "count/s",
+}
+
+
+def _spectrum_records(
+    spec_num,
+    tstart,
+    telapse,
+    exposure,
+    channel,
+    rate,
+    stat_err=None,
+    sys_err=None,
+    quality=None,
+    grouping=None,
+):
+    """
+    Rows of the SPECTRUM table, all arguments are broadcast to the shape
+    of the rates (n_rows, n_channels) or (n_rows,)
+    """
+    rate = np.atleast_2d(rate)
+
+    records = np.zeros(len(rate), dtype=_spectrum_dtype(rate.shape[1], stat_err is None))
+
+    records["SPEC_NUM"] = spec_num + np.arange(1, len(rate) + 1)
+    records["TSTART"] = np.ravel(tstart)
+    records["TELAPSE"] = np.ravel(telapse)
+    records["EXPOSURE"] = np.ravel(exposure)
+    records["CHANNEL"] = channel
+    records["RATE"] = rate
+
+    if stat_err is not None:
+        records["STAT_ERR"] = np.atleast_2d(stat_err)
+
+    if sys_err is not None:
+        records["SYS_ERR"] = sys_err
+
+    if quality is not None:
+        records["QUALITY"] = quality
+
+    records["GROUPING"] = 1 if grouping is None else grouping
+
+    return records
+
+
+class SPECTRUM(object):
+    def __init__(
+        self,
+        tstart,
+        telapse,
+        channel,
+        rate,
+        quality,
+        grouping,
+        exposure,
+        backscale,
+        respfile,
+        ancrfile,
+        back_file,
+        sys_err,
+        stat_err,
+        is_poisson=False,
+        instrument_name="",
+        telescope_name="",
+    ):
+        """
+        SPECTRUM extension of a PHA type II file with one row per spectrum.
+        The columns are built directly from the arrays, rate and stat_err
+        have the shape (n_spectra, n_channels) or (n_channels,) for a
+        single spectrum.
+        """
+        records = _spectrum_records(
+            0,
+            tstart,
+            telapse,
+            exposure,
+            np.asarray(channel, dtype=int),
+            rate,
+            stat_err=None if is_poisson else stat_err,
+            sys_err=sys_err,
+            quality=quality,
+            grouping=grouping,
+        )
+
+        self._hdu = fits.BinTableHDU(data=records, name="SPECTRUM")
+
+        _update_spectrum_header(
+            self._hdu.header,
+            n_channels=records["RATE"].shape[1],
+            is_poisson=is_poisson,
+            backscale=backscale,
+            respfile=respfile,
+            ancrfile=ancrfile,
+            back_file=back_file,
+            instrument_name=instrument_name,
+            telescope_name=telescope_name,
+        )
+
+    @property
+    def hdu(self):
+        return self._hdu
+
+
+def _update_spectrum_header(
+    header,
+    n_channels,
+    is_poisson,
+    backscale,
+    respfile,
+    ancrfile,
+    back_file,
+    instrument_name,
+    telescope_name,
+):
+    for i in range(1, header["TFIELDS"] + 1):
+        unit = _units.get(header[f"TTYPE{i}"])
+        if unit is not None:
+            header[f"TUNIT{i}"] = unit
+
+    header["HDUCLASS"] = "OGIP"
+    header["HDUCLAS1"] = "SPECTRUM"
+    header["HDUCLAS2"] = "TOTAL"
+    header["HDUCLAS3"] = "RATE"
+    header["HDUCLAS4"] = "TYPEII"
+    header["HDUVERS"] = "1.2.0"
+    header["TELESCOP"] = telescope_name
+    header["INSTRUME"] = instrument_name
+    header["CHANTYPE"] = "PHA"
+    header["DETCHANS"] = n_channels
+    header["POISSERR"] = bool(is_poisson)
+    header["BACKSCAL"] = 1.0 if backscale is None else float(backscale)
+    header["AREASCAL"] = 1.0
+    header["CORRSCAL"] = 1.0
+    header["RESPFILE"] = "none" if respfile is None else respfile
+    header["ANCRFILE"] = "none" if ancrfile is None else ancrfile
+    header["BACKFILE"] = "none" if back_file is None else back_file
+    header["CORRFILE"] = "none"
+    header["CREATOR"] = f"gbmbkgpy v.{__version__}"
+
+
+class PHAII(FITSFile):
+    def __init__(
+        self,
+        instrument_name,
+        telescope_name,
+        tstart,
+        telapse,
+        channel,
+        rate,
+        quality,
+        grouping,
+        exposure,
+        backscale,
+        respfile,
+        ancrfile,
+        back_file,
+        sys_err,
+        stat_err,
+        is_poisson=False,
+    ):
+        """
+        PHA type II file with a SPECTRUM extension
+        """
+        spectrum = SPECTRUM(
+            tstart=tstart,
+            telapse=telapse,
+            channel=channel,
+            rate=rate,
+            quality=quality,
+            grouping=grouping,
+            exposure=exposure,
+            backscale=backscale,
+            respfile=respfile,
+            ancrfile=ancrfile,
+            back_file=back_file,
+            sys_err=sys_err,
+            stat_err=stat_err,
+            is_poisson=is_poisson,
+            instrument_name=instrument_name,
+            telescope_name=telescope_name,
+        )
+
+        super(PHAII, self).__init__(fits_extensions=[spectrum])
+
+
+def write_phaii(
+    path,
+    tstart,
+    telapse,
+    channel,
+    rate,
+    exposure,
+    stat_err=None,
+    backscale=1.0,
+    respfile=None,
+    ancrfile=None,
+    back_file=None,
+    instrument_name="",
+    telescope_name="",
+    chunk_size=None,
+    overwrite=False,
+):
+    """
+    Write a PHA type II file with one spectrum per row. With a chunk_size
+    the rows are written to the file in chunks, so the table is never
+    built as a whole in memory.
+    :param tstart: start times (n_rows,)
+    :param telapse: widths of the time bins (n_rows,)
+    :param channel: channel numbers (n_channels,)
+    :param rate: rates (n_rows, n_channels)
+    :param exposure: exposures (n_rows,)
+    :param stat_err: errors of the rates (n_rows, n_channels), None for
+    poisson distributed rates
+    :param chunk_size: number of rows per chunk, None writes all at once
+    """
+    is_poisson = stat_err is None
+
+    if chunk_size is None:
+        PHAII(
+            instrument_name=instrument_name,
+            telescope_name=telescope_name,
+            tstart=tstart,
+            telapse=telapse,
+            channel=channel,
+            rate=rate,
+            quality=None,
+            grouping=None,
+            exposure=exposure,
+            backscale=backscale,
+            respfile=respfile,
+            ancrfile=ancrfile,
+            back_file=back_file,
+            sys_err=None,
+            stat_err=stat_err,
+            is_poisson=is_poisson,
+        ).writeto(path, overwrite=overwrite)
+        return
+
+    n_rows, n_channels = np.shape(rate)
+
+    # header of the table with the number of rows of the full file
+    empty = np.zeros(0, dtype=_spectrum_dtype(n_channels, is_poisson))
+    header = fits.BinTableHDU(data=empty, name="SPECTRUM").header
+    header["NAXIS2"] = n_rows
+
+    _update_spectrum_header(
+        header,
+        n_channels=n_channels,
+        is_poisson=is_poisson,
+        backscale=backscale,
+        respfile=respfile,
+        ancrfile=ancrfile,
+        back_file=back_file,
+        instrument_name=instrument_name,
+        telescope_name=telescope_name,
+    )
+
+    # StreamingHDU only appends to existing files given as str
+    path = os.fspath(path)
+
+    fits.PrimaryHDU().writeto(path, overwrite=overwrite)
+
+    stream = fits.StreamingHDU(path, header)
+
+    for start in range(0, n_rows, chunk_size):
+        rows = slice(start, min(start + chunk_size, n_rows))
+
+        records = _spectrum_records(
+            start,
+            tstart[rows],
+            telapse[rows],
+            exposure[rows],
+            channel,
+            rate[rows],
+            stat_err=None if is_poisson else stat_err[rows],
+        )
+
+        # the table data is written as raw bytes
+        stream.write(records.view(np.uint8))
+
+    stream.close()
@@ -0,0 +1,213 @@
+import numpy as np
+
+
+class StreamingPercentiles(object):
+    """
+    Online estimate of percentiles along the sample axis of a stream of
+    arrays, e.g. the poisson realizations of a posterior predictive check.
+
+    The first buffer_size realizations are kept and the percentiles are exact
+    as long as no more realizations are added. Once the buffer is full the
+    P² algorithm (Jain & Chlamtac 1985) is started from the buffered values
+    and continued for every further realization, vectorized over all
+    elements. The memory is therefore bounded by buffer_size realizations,
+    independent of the number of samples.
+    """
+
+    def __init__(self, percentiles, shape, buffer_size=100, dtype=float):
+        """
+        :param percentiles: list of percentiles in [0, 100]
+        :param shape: shape of one realization
+        :param buffer_size: number of realizations with exact percentiles
+        :param dtype: dtype of the buffer
+        """
+        self._percentiles = np.atleast_1d(np.array(percentiles, dtype=float))
+
+        assert np.all(self._percentiles >= 0) and np.all(
+            self._percentiles <= 100
+        ), "Percentiles must be in [0, 100]"
+
+        assert buffer_size >= 5, "The buffer must hold at least 5 realizations"
+
+        self._shape = tuple(shape)
+        self._buffer_size = int(buffer_size)
+        self._buffer = np.empty((self._buffer_size, *self._shape), dtype=dtype)
+
+        self._n = 0
+        self._sum = np.zeros(self._shape)
+        self._min = None
+        self._max = None
+
+        # P² state, only used once the buffer is full
+        self._heights = None
+        self._positions = None
+        self._desired = None
+        self._increments = None
+
+        # only the percentiles strictly inside (0, 100) need markers
+        self._inner = (self._percentiles > 0) & (self._percentiles < 100)
+
+    def update(self, batch):
+        """
+        Add a batch of realizations
+        :param batch: array with shape (n, *shape)
+        """
+        batch = np.asarray(batch)
+
+        assert (
+            batch.shape[1:] == self._shape
+        ), f"Realizations must have the shape {self._shape}"
+
+        if len(batch) == 0:
+            return
+
+        self._sum += np.sum(batch, axis=0)
+
+        batch_min = np.min(batch, axis=0)
+        batch_max = np.max(batch, axis=0)
+        if self._min is None:
+            self._min = batch_min
+            self._max = batch_max
+        else:
+            np.minimum(self._min, batch_min, out=self._min)
+            np.maximum(self._max, batch_max, out=self._max)
+
+        # fill the buffer first
+        n_buffer = min(len(batch), self._buffer_size - self._n)
+        if n_buffer > 0:
+            self._buffer[self._n : self._n + n_buffer] = batch[:n_buffer]
+            self._n += n_buffer
+            batch = batch[n_buffer:]
+
+        if len(batch) == 0:
+            return
+
+        if self._heights is None:
+            self._init_markers()
+
+        for realization in batch:
+            self._p2_step(realization)
+            self._n += 1
+
+    def _init_markers(self):
+        """
+        Start the P² markers from the sorted buffer
+        """
+        inner = self._percentiles[self._inner] / 100.0
+        m = self._buffer_size
+
+        sorted_buffer = np.sort(self._buffer, axis=0)
+
+        self._increments = np.array(
+            [[0.0, p / 2.0, p, (1.0 + p) / 2.0, 1.0] for p in inner]
+        ).reshape(len(inner), 5)
+
+        self._desired = 1.0 + (m - 1) * self._increments
+
+        positions = np.rint(self._desired).astype(int)
+        # the marker positions have to be strictly increasing
+        positions[:, 0] = 1
+        positions[:, 4] = m
+        for i in range(1, 4):
+            positions[:, i] = np.clip(
+                positions[:, i], positions[:, i - 1] + 1, m - (4 - i)
+            )
+
+        self._heights = np.array(
+            [sorted_buffer[pos - 1].astype(float) for pos in positions]
+        ).reshape(len(inner), 5, *self._shape)
+
+        expand = (slice(None), slice(None)) + (None,) * len(self._shape)
+        self._positions = np.broadcast_to(
+            positions.astype(float)[expand], self._heights.shape
+        ).copy()
+
+        # the buffer is not needed anymore
+        self._buffer = None
+
+    def _p2_step(self, x):
+        q = self._heights
+        n = self._positions
+
+        x = np.asarray(x, dtype=float)[np.newaxis]
+
+        # update the extreme markers
+        np.minimum(q[:, 0], x, out=q[:, 0])
+        np.maximum(q[:, 4], x, out=q[:, 4])
+
+        # increase the positions of the markers above x
+        n[:, 1:4] += x[:, np.newaxis] < q[:, 1:4]
+        n[:, 4] += 1
+
+        self._desired += self._increments
+
+        expand = (slice(None),) + (None,) * len(self._shape)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i in range(1, 4):
+                d = self._desired[:, i][expand] - n[:, i]
+
+                up = (d >= 1) & (n[:, i + 1] - n[:, i] > 1)
+                down = (d <= -1) & (n[:, i - 1] - n[:, i] < -1)
+                move = up | down
+
+                if not np.any(move):
+                    continue
+
+                s = np.where(up, 1.0, -1.0)
+
+                q_i, q_m, q_p = q[:, i], q[:, i - 1], q[:, i + 1]
+                n_i, n_m, n_p = n[:, i], n[:, i - 1], n[:, i + 1]
+
+                parabolic = q_i + s / (n_p - n_m) * (
+                    (n_i - n_m + s) * (q_p - q_i) / (n_p - n_i)
+                    + (n_p - n_i - s) * (q_i - q_m) / (n_i - n_m)
+                )
+
+                linear = np.where(
+                    up,
+                    q_i + (q_p - q_i) / (n_p - n_i),
+                    q_i - (q_m - q_i) / (n_m - n_i),
+                )
+
+                new = np.where((q_m < parabolic) & (parabolic < q_p), parabolic, linear)
+
+                q[:, i] = np.where(move, new, q_i)
+                n[:, i] = np.where(move, n_i + s, n_i)
+
+    @property
+    def percentiles(self):
+        """
+        Current estimate of the percentiles
+        :return: array with shape (len(percentiles), *shape)
+        """
+        assert self._n > 0, "No realizations added yet"
+
+        if self._heights is None:
+            return np.percentile(self._buffer[: self._n], self._percentiles, axis=0)
+
+        result = np.empty((len(self._percentiles), *self._shape))
+        result[self._inner] = self._heights[:, 2]
+        result[self._percentiles == 0] = self._min
+        result[self._percentiles == 100] = self._max
+
+        return result
+
+    @property
+    def percentile_levels(self):
+        return self._percentiles
+
+    @property
+    def exact(self):
+        """
+        True as long as the percentiles are computed from all realizations
+        """
+        return self._heights is None
+
+    @property
+    def n(self):
+        return self._n
+
+    @property
+    def mean(self):
+        return self._sum / self._n
@@ -0,0 +1,415 @@
+import collections
+import json
+import os
+import re
+
+import numpy as np
+
+from astromodels.functions.priors import (
+    Gaussian,
+    Log_normal,
+    Log_uniform_prior,
+    Truncated_gaussian,
+    Uniform_prior,
+)
+
+# Parameters of the generated Stan models that are sampled in log space,
+# transformed parameter -> (sampled parameter, transformation)
+_stan_log_parameters = {
+    "norm_fixed": ("log_norm_fixed", np.log10),
+    "norm_cont": ("log_norm_cont", np.log10),
+    "norm_saa": ("log_norm_saa", np.log),
+}
+
+_stan_types = (
+    "real",
+    "vector",
+    "row_vector",
+    "ordered",
+    "positive_ordered",
+    "simplex",
+    "unit_vector",
+    "matrix",
+)
+
+_stan_declaration = re.compile(
+    r"^\s*(?P<type>\w+)\s*(<[^>]*>)?\s*(\[(?P<type_dims>[^\]]*)\])?"
+    r"\s+(?P<name>\w+)\s*(\[(?P<dims>[^\]]*)\])?\s*;"
+)
+
+
+def _stan_dim(expression, data):
+    expression = expression.strip()
+
+    if expression in data:
+        return int(data[expression])
+
+    # simple expressions like num_dets-1
+    return int(eval(expression, {"__builtins__": {}}, dict(data)))
+
+
+def stan_parameter_shapes(stan_code, data):
+    """
+    Shapes of the variables in the parameters block of a Stan model
+    :param stan_code: code of the model as string
+    :param data: data dict of the fit with the sizes of the model
+    :returns: OrderedDict name -> shape
+    """
+    shapes = collections.OrderedDict()
+
+    in_block = False
+
+    for line in stan_code.splitlines():
+        line = line.split("//")[0]
+
+        if not in_block:
+            in_block = re.match(r"^\s*parameters\s*\{", line) is not None
+            continue
+
+        if line.strip().startswith("}"):
+            break
+
+        match = _stan_declaration.match(line)
+
+        if match is None or match.group("type") not in _stan_types:
+            continue
+
+        shape = []
+
+        if match.group("dims") is not None:
+            shape += [_stan_dim(d, data) for d in match.group("dims").split(",")]
+
+        if match.group("type_dims") is not None:
+            shape += [_stan_dim(d, data) for d in match.group("type_dims").split(",")]
+
+        shapes[match.group("name")] = tuple(shape)
+
+    return shapes
+
+
+def _element_name(name, index):
+    if len(index) == 0:
+        return name
+
+    return f"{name}[{','.join(str(i + 1) for i in index)}]"
+
+
+class WarmStart(object):
+    def __init__(self, samples, source=None):
+        """
+        Posterior samples of a previous fit to start a new fit of the same
+        source layout. The parameters are matched by name, so parameters
+        that are not in the previous fit keep their default start values.
+        :param samples: dict parameter name -> array of posterior draws,
+        elements of Stan arrays are named like param_lookup, e.g. "norm_saa[1,2,3]"
+        :param source: description of the origin of the samples
+        """
+        self._samples = collections.OrderedDict(
+            (name, np.atleast_1d(np.asarray(s, dtype=float)))
+            for name, s in samples.items()
+        )
+
+        assert len(self._samples) > 0, "No samples for the warm start"
+
+        num_draws = {len(s) for s in self._samples.values()}
+
+        assert len(num_draws) == 1, "All parameters must have the same number of draws"
+
+        self._num_draws = num_draws.pop()
+        self._source = source
+
+        self._median = collections.OrderedDict(
+            (name, float(np.median(s))) for name, s in self._samples.items()
+        )
+
+    @classmethod
+    def from_multinest(cls, output_dir, param_names=None, basename="fit_"):
+        """
+        Warm start from the equal weighted posterior of a MultiNest fit
+        :param output_dir: output dir of ModelDet.minimize_multinest
+        :param param_names: names of the parameters in the order of the fit,
+        default is the params.json written by ModelDet.minimize_multinest
+        :param basename: outputfiles_basename of the fit in the output dir
+        """
+        output_dir = str(output_dir)
+
+        if param_names is None:
+            with open(os.path.join(output_dir, f"{basename}params.json"), "r") as f:
+                param_names = json.load(f)
+
+        post = np.atleast_2d(
+            np.loadtxt(os.path.join(output_dir, f"{basename}post_equal_weights.dat"))
+        )
+
+        # the last column is the log likelihood
+        assert post.shape[1] == len(param_names) + 1, (
+            "The number of parameter names does not match the posterior "
+            f"of {output_dir}"
+        )
+
+        samples = collections.OrderedDict(
+            (name, post[:, i]) for i, name in enumerate(param_names)
+        )
+
+        return cls(samples, source=output_dir)
+
+    @classmethod
+    def from_arviz(cls, nc_file, group="posterior"):
+        """
+        Warm start from an ArviZ netcdf file of a Stan fit. The elements of
+        array parameters are named like in the param_lookup of the
+        StanDataConstructor, e.g. "norm_saa[1,2,3]".
+        :param nc_file: path of the netcdf file
+        :param group: group with the draws
+        """
+        import xarray as xr
+
+        samples = collections.OrderedDict()
+
+        with xr.open_dataset(nc_file, group=group, cache=False) as ds:
+            for name, var in ds.data_vars.items():
+                values = var.transpose("chain", "draw", ...).values
+                values = values.reshape((-1,) + values.shape[2:])
+
+                for index in np.ndindex(values.shape[1:]):
+                    samples[_element_name(name, index)] = values[(slice(None),) + index]
+
+        return cls(samples, source=str(nc_file))
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        Warm start from the samples of a fitted or loaded ModelDet
+        """
+        return cls(model.samples, source="model")
+
+    def start_values(self, parameters):
+        """
+        Start vector for a fit, the posterior median of every parameter
+        with a matching name and the current value otherwise. The values
+        are clipped to the bounds of the parameters.
+        :param parameters: dict name -> parameter, e.g. ModelDet.parameter
+        :returns: array of start values in the order of the parameters
+        """
+        values = np.zeros(len(parameters))
+
+        for i, (name, parameter) in enumerate(parameters.items()):
+            value = self._median.get(name, parameter.value)
+
+            lower, upper = _parameter_bounds(parameter)
+
+            if lower is not None:
+                value = max(value, lower)
+            if upper is not None:
+                value = min(value, upper)
+
+            values[i] = value
+
+        return values
+
+    def set_start_values(self, parameters):
+        """
+        Set the values of the parameters to the start values
+        :returns: number of parameters that were found in the warm start
+        """
+        for value, parameter in zip(
+            self.start_values(parameters), parameters.values()
+        ):
+            parameter.value = value
+
+        found = len(set(parameters.keys()) & set(self._median.keys()))
+
+        print(f"Warm start of {found} of {len(parameters)} parameters from {self._source}")
+
+        return found
+
+    def unit_cube_points(self, parameters, n_points, seed=None):
+        """
+        Posterior draws mapped to the unit cube of the priors, e.g. as
+        initial live points of a nested sampling run. Parameters that are
+        not in the warm start are drawn uniformly.
+        :param parameters: dict name -> parameter with a prior, e.g. ModelDet.parameter
+        :param n_points: number of points
+        :param seed: seed of the random draws
+        :returns: array (n_points, number of parameters)
+        """
+        rng = np.random.default_rng(seed)
+
+        draws = rng.integers(self._num_draws, size=n_points)
+
+        points = rng.uniform(size=(n_points, len(parameters)))
+
+        for i, (name, parameter) in enumerate(parameters.items()):
+            if name in self._samples:
+                points[:, i] = _to_unit_cube(
+                    parameter.prior, self._samples[name][draws]
+                )
+
+        return points
+
+    def stan_inits(self, shapes, chains=1, param_lookup=None, seed=None):
+        """
+        Inits for CmdStan, one random posterior draw per chain. Only
+        parameters with all elements in the warm start are set, the others
+        get the default random inits of Stan.
+        :param shapes: shapes of the parameters of the new model, see stan_parameter_shapes
+        :param chains: number of chains
+        :param param_lookup: param_lookup of the StanDataConstructor, needed
+        if the samples are named like the model parameters (e.g. a MultiNest fit)
+        :param seed: seed of the draws
+        :returns: list of dicts, one per chain, for inits= of cmdstanpy
+        """
+        samples = self._samples
+
+        if param_lookup is not None:
+            samples = self._stan_samples(param_lookup)
+
+        rng = np.random.default_rng(seed)
+
+        inits = []
+
+        for chain in range(chains):
+            draw = rng.integers(self._num_draws)
+
+            init = {}
+
+            for name, shape in shapes.items():
+                value = np.zeros(shape)
+
+                complete = True
+                for index in np.ndindex(shape):
+                    element = samples.get(_element_name(name, index))
+
+                    if element is None:
+                        complete = False
+                        break
+
+                    value[index] = element[draw]
+
+                if complete:
+                    init[name] = value.tolist() if len(shape) > 0 else float(value)
+
+            inits.append(init)
+
+        missing = [name for name in shapes if name not in inits[0]]
+        if len(missing) > 0:
+            print(f"No warm start for the Stan parameters {', '.join(missing)}")
+
+        return inits
+
+    def _stan_samples(self, param_lookup):
+        """
+        Samples named like the sampled Stan parameters
+        """
+        samples = collections.OrderedDict()
+
+        for param_info in param_lookup:
+            if param_info["name"] not in self._samples:
+                continue
+
+            values = self._samples[param_info["name"]] / param_info["scale"]
+
+            name, index = param_info["stan_param_name"].split("[", 1)
+
+            if name in _stan_log_parameters:
+                name, transform = _stan_log_parameters[name]
+                values = transform(np.clip(values, 1e-30, None))
+
+            samples[f"{name}[{index}"] = values
+
+        return samples
+
+    def tighten_priors(self, parameters, width=3.0):
+        """
+        Narrow the priors of the parameters around the posterior of the
+        warm start, for sampling of consecutive days with the same layout.
+        Gaussian priors get the posterior median as mean and a sigma of at
+        most width times the posterior std, uniform priors are cut to the
+        median +- width*std. The prior family and the old bounds are kept.
+        :param parameters: dict name -> parameter with a prior, e.g. ModelDet.parameter
+        :param width: width of the new priors in units of the posterior std
+        :returns: names of the changed parameters
+        """
+        changed = []
+
+        for name, parameter in parameters.items():
+            if name not in self._samples or self._num_draws < 2:
+                continue
+
+            s = self._samples[name]
+            prior = parameter.prior
+
+            median = np.median(s)
+            std = np.std(s)
+
+            if std == 0:
+                continue
+
+            if isinstance(prior, (Gaussian, Truncated_gaussian)):
+                prior.mu.value = median
+                prior.sigma.value = min(prior.sigma.value, width * std)
+
+            elif isinstance(prior, Log_normal):
+                log_s = np.log(s[s > 0])
+                prior.mu.value = np.median(log_s)
+                prior.sigma.value = min(prior.sigma.value, width * np.std(log_s))
+
+            elif isinstance(prior, (Uniform_prior, Log_uniform_prior)):
+                lower = max(prior.lower_bound.value, median - width * std)
+                upper = min(prior.upper_bound.value, median + width * std)
+
+                if lower >= upper:
+                    continue
+
+                prior.lower_bound.value = lower
+                prior.upper_bound.value = upper
+
+            else:
+                continue
+
+            changed.append(name)
+
+        print(f"Tightened the priors of {len(changed)} parameters")
+
+        return changed
+
+    @property
+    def samples(self):
+        return self._samples
+
+    @property
+    def median(self):
+        return self._median
+
+    @property
+    def num_draws(self):
+        return self._num_draws
+
+    @property
+    def source(self):
+        return self._source
+
+
+def _parameter_bounds(parameter):
+    if getattr(parameter, "bounds", None) is not None:
+        return parameter.bounds
+
+    return getattr(parameter, "min_value", None), getattr(parameter, "max_value", None)
+
+
+def _to_unit_cube(prior, values, n_iter=60):
+    """
+    Invert prior.from_unit_cube by bisection, it is monotonic for all priors
+    """
+    lower = np.zeros(len(values))
+    upper = np.ones(len(values))
+
+    for _ in range(n_iter):
+        mid = 0.5 * (lower + upper)
+
+        above = np.array([prior.from_unit_cube(m) for m in mid]) > values
+
+        upper = np.where(above, mid, upper)
+        lower = np.where(above, lower, mid)
+
+    return 0.5 * (lower + upper)